@@ -0,0 +1,112 @@
+"""Данные для JSON API только на чтение (posts.views, адреса api/).
+
+Записи, группы, профили и комментарии читаются через values(): Django
+не создаёт моделей, а строки сразу превращаются в словари ответа.
+Ленты листаются курсором (см. posts.paginator.encode_key) от последней
+записи предыдущей страницы. Неизменившаяся лента отдаётся как 304,
+см. posts.freshness.
+"""
+from functools import wraps
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import JsonResponse
+
+from posts.paginator import decode_cursor, encode_key
+
+POST_FIELDS = ('id', 'text', 'pub_date', 'author__username', 'group__slug',
+               'image', 'thumbnail_url', 'comment_count')
+COMMENT_FIELDS = ('id', 'text', 'created', 'author__username')
+GROUP_FIELDS = ('id', 'title', 'slug', 'description')
+PROFILE_FIELDS = ('id', 'username', 'first_name', 'last_name',
+                  'stats__posts_count', 'stats__followers_count',
+                  'stats__following_count')
+
+
+def page_size():
+    return getattr(settings, 'API_PAGE_SIZE', 20)
+
+
+def page_max():
+    return getattr(settings, 'API_PAGE_MAX', 100)
+
+
+def limit_from(request):
+    try:
+        limit = int(request.GET.get('limit', page_size()))
+    except ValueError:
+        limit = page_size()
+    return max(1, min(limit, page_max()))
+
+
+def _media_url(name):
+    return settings.MEDIA_URL + name if name else None
+
+
+def post_json(row):
+    return {'id': row['id'],
+            'text': row['text'],
+            'pub_date': row['pub_date'].isoformat(),
+            'author': row['author__username'],
+            'group': row['group__slug'],
+            'image': _media_url(row['image']),
+            'thumbnail': row['thumbnail_url'] or None,
+            'comments': row['comment_count']}
+
+
+def comment_json(row):
+    return {'id': row['id'],
+            'text': row['text'],
+            'created': row['created'].isoformat(),
+            'author': row['author__username']}
+
+
+def profile_json(row):
+    return {'username': row['username'],
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'posts': row['stats__posts_count'] or 0,
+            'followers': row['stats__followers_count'] or 0,
+            'following': row['stats__following_count'] or 0}
+
+
+def _page(queryset, fields, date_field, serialize, after, limit,
+          newest_first=True):
+    """Страница строк от курсора after: (список словарей, курсор или None)."""
+    later = 'lt' if newest_first else 'gt'
+    order = ['-' + date_field, '-pk'] if newest_first else [date_field, 'pk']
+    position = decode_cursor(after)
+    if position is not None:
+        moment, pk = position
+        queryset = queryset.filter(
+            Q(**{f'{date_field}__{later}': moment})
+            | Q(**{date_field: moment, f'pk__{later}': pk}))
+    # лишняя строка показывает, есть ли следующая страница
+    rows = list(queryset.order_by(*order).values(*fields)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_key(rows[-1][date_field], rows[-1]['id'])
+    return [serialize(row) for row in rows], next_cursor
+
+
+def post_page(queryset, after=None, limit=None):
+    """Записи ленты от новых к старым."""
+    return _page(queryset, POST_FIELDS, 'pub_date', post_json, after,
+                 limit or page_size())
+
+
+def comment_page(queryset, after=None, limit=None):
+    """Комментарии от старых к новым, как на странице записи."""
+    return _page(queryset, COMMENT_FIELDS, 'created', comment_json, after,
+                 limit or page_size(), newest_first=False)
+
+
+def login_required_json(view):
+    """Анонимному пользователю — 401 в JSON, а не переход на вход."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Нужно войти'}, status=401)
+        return view(request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,258 @@
+"""ASGI-приложение поверх синхронного Django.
+
+Django 2.2 не умеет ASGI (оно появилось в Django 3.0), а asgiref в
+зависимостях проекта нет. ASGIHandler принимает запросы в цикле
+asyncio и выполняет обычный WSGI-обработчик Django в пуле из
+ASGI_THREADS потоков; view остаются синхронными.
+
+Поток пула занят, пока Django обрабатывает запрос, но не ждёт
+медленного клиента, если запрос и ответ небольшие:
+
+- тело запроса до BODY_BUFFER байт читается в цикле событий, прежде
+  чем запрос попадёт в поток; большее тело (загрузка изображения)
+  поток читает по мере надобности и ждёт клиента;
+- ответ поток отдаёт в ResponseBuffer и ждёт клиента, только когда
+  неотправленных байт набралось больше RESPONSE_BUFFER.
+
+Открытый поток событий (posts.events) занимает поток пула всё время,
+пока открыт.
+"""
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+# сколько тела запроса читать из сокета за раз
+CHUNK_SIZE = 64 * 1024
+# тело не больше этого читается до передачи запроса в поток
+BODY_BUFFER = 1024 * 1024
+# сколько байт ответа поток отдаёт, не дожидаясь клиента
+RESPONSE_BUFFER = 256 * 1024
+
+
+def workers():
+    return getattr(settings, 'ASGI_THREADS', 8)
+
+
+def _latin1(value):
+    return value.decode('latin1')
+
+
+def environ_for(scope, body):
+    """WSGI environ для запроса из ASGI scope."""
+    root = scope.get('root_path', '')
+    path = scope['path']
+    if root and path.startswith(root):
+        path = path[len(root):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root,
+        # WSGI передаёт путь байтами в latin-1, как они пришли
+        'PATH_INFO': path.encode('utf-8').decode('latin1'),
+        'QUERY_STRING': _latin1(scope.get('query_string', b'')),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = (
+            scope['client'][0], str(scope['client'][1]))
+    for name, value in scope.get('headers', []):
+        name = _latin1(name).upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = _latin1(value)
+        if name in environ:
+            separator = '; ' if name == 'HTTP_COOKIE' else ','
+            value = environ[name] + separator + value
+        environ[name] = value
+    return environ
+
+
+class RequestBody(io.RawIOBase):
+    """Тело запроса, которое читается из receive по мере надобности.
+
+    call(coroutine) выполняет корутину в цикле событий и ждёт
+    результата из потока пула.
+    """
+
+    def __init__(self, receive, call):
+        super().__init__()
+        self._receive = receive
+        self._call = call
+        self._buffer = b''
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self._buffer and self._more:
+            message = self._call(self._receive())
+            if message['type'] == 'http.disconnect':
+                self._more = False
+                break
+            self._buffer = message.get('body', b'')
+            self._more = message.get('more_body', False)
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class ResponseBuffer:
+    """Сообщения ответа от потока пула к клиенту.
+
+    Поток кладёт сообщения через put(), run() в цикле событий по
+    очереди отдаёт их send. put() ждёт, только пока неотправленных
+    байт больше limit; ошибка send (клиент ушёл) повторяется в put().
+    """
+
+    def __init__(self, loop, send, limit=RESPONSE_BUFFER):
+        self.loop = loop
+        self.send = send
+        self.limit = limit
+        self.queue = asyncio.Queue()
+        self.pending = 0
+        self.error = None
+        self.condition = threading.Condition()
+
+    def put(self, message):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.pending < self.limit or self.error)
+            if self.error is not None:
+                raise self.error
+            self.pending += len(message.get('body', b''))
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+    def finish(self):
+        """Конец ответа; вызывается в цикле событий."""
+        self.queue.put_nowait(None)
+
+    async def run(self):
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            try:
+                await self.send(message)
+            except BaseException as error:
+                with self.condition:
+                    self.error = error
+                    self.condition.notify_all()
+                raise
+            with self.condition:
+                self.pending -= len(message.get('body', b''))
+                self.condition.notify_all()
+
+
+async def read_body(scope, receive):
+    """Небольшое тело запроса целиком или None, если читать по частям."""
+    length = dict(scope.get('headers', [])).get(b'content-length')
+    if length is None or not length.isdigit() or int(length) > BODY_BUFFER:
+        return None
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+class ASGIHandler:
+    """ASGI 3 приложение, которое выполняет WSGI-приложение в пуле."""
+
+    def __init__(self, application, threads=None):
+        self.application = application
+        self.executor = ThreadPoolExecutor(max_workers=threads or workers(),
+                                           thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            loop = asyncio.get_running_loop()
+            body = await read_body(scope, receive)
+            response = ResponseBuffer(loop, send)
+            sender = loop.create_task(response.run())
+            try:
+                await loop.run_in_executor(self.executor, self.handle, loop,
+                                           scope, receive, response, body)
+            finally:
+                response.finish()
+                await sender
+        else:
+            raise ValueError(f'Запросы {scope["type"]} не поддерживаются')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def handle(self, loop, scope, receive, response, body=None):
+        """Выполняет запрос в потоке пула; весь запрос в одном потоке.
+
+        body — тело, уже прочитанное в цикле событий, или None.
+        """
+        def call(coroutine):
+            return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+        if body is not None:
+            body = io.BytesIO(body)
+        else:
+            body = io.BufferedReader(RequestBody(receive, call), CHUNK_SIZE)
+        start = {'type': 'http.response.start'}
+
+        def start_response(status, headers, exc_info=None):
+            start['status'] = int(status.split(' ', 1)[0])
+            start['headers'] = [(name.lower().encode('latin1'),
+                                 value.encode('latin1'))
+                                for name, value in headers]
+
+        chunks = self.application(environ_for(scope, body), start_response)
+        try:
+            # последний кусок уходит с more_body=False, обычный ответ
+            # Django — это заголовки и одно сообщение с телом
+            started, pending = False, None
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if pending is not None:
+                    if not started:
+                        response.put(start)
+                        started = True
+                    response.put({'type': 'http.response.body',
+                                  'body': pending, 'more_body': True})
+                pending = chunk
+            if not started:
+                response.put(start)
+            response.put({'type': 'http.response.body',
+                          'body': pending or b''})
+        finally:
+            # close() вызывает request_finished, а тот закрывает
+            # соединения с базой этого потока
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,670 @@
+"""Нагрузочный прогон всех адресов posts.urls и users.urls.
+
+Каждый сценарий — один адрес и метод. Запросы идут через
+django.test.Client (весь стек middleware, но без HTTP), через
+локальный WSGI-сервер в том же процессе или через локальный
+ASGI-сервер (serve_asgi с posts.asgi) — одна и та же нагрузка для
+обоих путей.
+Для каждого сценария считаются перцентили времени ответа, число
+SQL-запросов на запрос и пропускная способность; отчёт сохраняется в
+JSON и сравнивается с сохранённым ранее эталоном.
+
+Сценарии с POST создают записи, комментарии и подписки, поэтому
+команда benchmark по умолчанию прогоняет их на временной базе
+(posts.synthetic.scratch_database).
+
+render_templates() отдельно меряет рендер index.html без HTTP и базы:
+с загрузчиками по умолчанию, которые разбирают шаблоны при каждом
+рендере, и с кэширующим загрузчиком боевого профиля.
+
+run_cache() сравнивает бэкенды кэша (LocMemCache, SQLiteCache и
+DatabaseCache) под одновременными чтениями и записями из нескольких
+потоков; у SQLite и базы каждый поток работает через своё соединение,
+как отдельные процессы.
+"""
+import asyncio
+import http.client
+import json
+import math
+import os
+import random
+import statistics
+import string
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http import HTTPStatus
+from urllib.parse import unquote, urlencode
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.core.paginator import Paginator
+from django.core.servers.basehttp import (ThreadedWSGIServer,
+                                          WSGIRequestHandler)
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.template.backends.django import DjangoTemplates
+from django.test.client import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from posts import asgi, synthetic, warmup
+from posts.models import Post
+
+User = get_user_model()
+
+QUERIES_HEADER = 'X-Benchmark-Queries'
+
+# status — код ответа, который сценарий ждёт; без него ошибкой
+# считается любой ответ 5xx
+Scenario = namedtuple('Scenario', 'name route method login build status',
+                      defaults=[None])
+
+
+class Sample:
+    """Данные, из которых сценарии выбирают адреса.
+
+    Свежие записи выбираются чаще старых, как в настоящих лентах.
+    """
+
+    def __init__(self, prefix='bench', size=1000):
+        posts = list(Post.objects
+                     .filter(author__username__startswith=f'{prefix}_')
+                     .order_by('-pub_date', '-pk')
+                     .values_list('pk', 'author__username')[:size])
+        if not posts:
+            raise ValueError('в базе нет синтетических записей')
+        self.posts = posts
+        self.weights = synthetic.zipf_weights(len(posts))
+        self.own_posts = {}
+        for pk, username in posts:
+            self.own_posts.setdefault(username, []).append(pk)
+        self.usernames = list(User.objects
+                              .filter(username__startswith=f'{prefix}_')
+                              .values_list('username', flat=True))
+        self.slugs = list(Post.objects
+                          .filter(pk__in=[pk for pk, _ in posts],
+                                  group__isnull=False)
+                          .values_list('group__slug', flat=True)
+                          .distinct())
+        self.words = synthetic.vocabulary(200)
+
+    def post(self, rng):
+        return rng.choices(self.posts, cum_weights=self.weights)[0]
+
+    def viewer(self, rng):
+        """Пользователь, у которого есть записи для post_edit."""
+        return rng.choice(sorted(self.own_posts))
+
+
+def _post_args(sample, viewer, rng):
+    pk, username = sample.post(rng)
+    return [username, pk]
+
+
+def _own_post_args(sample, viewer, rng):
+    return [viewer, rng.choice(sample.own_posts[viewer])]
+
+
+def _other_user(sample, viewer, rng):
+    return rng.choice([name for name in sample.usernames if name != viewer])
+
+
+def _get(name, args=None, query=None):
+    def build(sample, viewer, rng):
+        path = reverse(name, args=args(sample, viewer, rng) if args else None)
+        if query:
+            path += '?' + urlencode(query(sample, viewer, rng))
+        return path, None
+    return build
+
+
+def _post(name, args, data):
+    def build(sample, viewer, rng):
+        path = reverse(name, args=args(sample, viewer, rng) if args else None)
+        return path, data(sample, viewer, rng)
+    return build
+
+
+def _text(sample, viewer, rng):
+    return {'text': ' '.join(rng.choices(sample.words, k=12))}
+
+
+def _follow_batch(sample, viewer, rng):
+    # строка уходит как есть с Content-Type: application/json
+    names = [name for name in sample.usernames if name != viewer]
+    half = rng.sample(names, min(len(names), 20))
+    return json.dumps({'follow': half[:10], 'unfollow': half[10:]})
+
+
+def _edit(sample, viewer, rng):
+    return {'text': ' '.join(rng.choices(sample.words, k=12)), 'group': ''}
+
+
+SCENARIOS = [
+    Scenario('index', '', 'GET', False, _get('index')),
+    Scenario('index page 2', '', 'GET', False,
+             _get('index', query=lambda *args: {'page': 2})),
+    Scenario('404', '404/', 'GET', False,
+             lambda *args: ('/404/', None)),
+    Scenario('500', '500/', 'GET', False,
+             lambda *args: ('/500/', None), status=500),
+    Scenario('api_posts', 'api/posts/', 'GET', False, _get('api_posts')),
+    Scenario('api_comments', 'api/posts/<int:post_id>/comments/', 'GET',
+             False, _get('api_comments', lambda sample, viewer, rng: [
+                 sample.post(rng)[0]])),
+    Scenario('api_groups', 'api/groups/', 'GET', False, _get('api_groups')),
+    Scenario('api_group', 'api/groups/<slug:slug>/', 'GET', False,
+             _get('api_group', lambda sample, viewer, rng: [
+                 rng.choice(sample.slugs)])),
+    Scenario('api_profile', 'api/profiles/<str:username>/', 'GET', False,
+             _get('api_profile', lambda sample, viewer, rng: [
+                 sample.post(rng)[1]])),
+    Scenario('api_follow', 'api/follow/', 'GET', True, _get('api_follow')),
+    Scenario('follow_index', 'follow/', 'GET', True, _get('follow_index')),
+    Scenario('post_events', 'events/', 'GET', True,
+             _get('post_events', query=lambda sample, viewer, rng: {
+                 'feed': 'follow'})),
+    Scenario('follow_batch', 'follow/batch/', 'POST', True,
+             _post('follow_batch', None, _follow_batch)),
+    Scenario('group', 'group/<slug:slug>/', 'GET', False,
+             _get('group', lambda sample, viewer, rng: [
+                 rng.choice(sample.slugs)])),
+    Scenario('new_post', 'new/', 'GET', True, _get('new_post')),
+    Scenario('new_post submit', 'new/', 'POST', True,
+             _post('new_post', None, _text)),
+    Scenario('search', 'search/', 'GET', False,
+             _get('search', query=lambda sample, viewer, rng: {
+                 'q': rng.choice(sample.words)})),
+    Scenario('profile', '<str:username>/', 'GET', False,
+             _get('profile', lambda sample, viewer, rng: [
+                 sample.post(rng)[1]])),
+    Scenario('post', '<str:username>/<int:post_id>/', 'GET', False,
+             _get('post', _post_args)),
+    Scenario('post_comments', '<str:username>/<int:post_id>/comments/',
+             'GET', False, _get('post_comments', _post_args)),
+    Scenario('add_comment', '<str:username>/<int:post_id>/comment/',
+             'POST', True, _post('add_comment', _post_args, _text)),
+    Scenario('post_edit', '<str:username>/<int:post_id>/edit/', 'GET',
+             True, _get('post_edit', _own_post_args)),
+    Scenario('post_edit submit', '<str:username>/<int:post_id>/edit/',
+             'POST', True, _post('post_edit', _own_post_args, _edit)),
+    Scenario('profile_follow', '<str:username>/follow/', 'GET', True,
+             _get('profile_follow', lambda sample, viewer, rng: [
+                 _other_user(sample, viewer, rng)])),
+    Scenario('profile_unfollow', '<str:username>/unfollow/', 'GET', True,
+             _get('profile_unfollow', lambda sample, viewer, rng: [
+                 _other_user(sample, viewer, rng)])),
+    Scenario('signup', 'signup/', 'GET', False, _get('signup')),
+]
+
+
+class ClientTransport:
+    """Запросы через django.test.Client, SQL считается в том же потоке."""
+
+    def session(self, username):
+        client = Client()
+        if username is not None:
+            client.force_login(User.objects.get(username=username))
+
+        def send(method, path, data):
+            with CaptureQueriesContext(connection) as queries:
+                try:
+                    if isinstance(data, str):
+                        response = client.post(
+                            path, data, content_type='application/json')
+                    elif method == 'POST':
+                        response = client.post(path, data)
+                    else:
+                        response = client.get(path)
+                    if response.streaming:
+                        # поток читаем до конца, как браузер
+                        b''.join(response.streaming_content)
+                    status = response.status_code
+                except Exception:
+                    # Client пробрасывает исключения view наружу
+                    status = 500
+            return status, len(queries)
+        return send
+
+    def close(self):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def count_queries(application):
+    """WSGI-обёртка, которая отдаёт число SQL-запросов в заголовке."""
+    def wrapper(environ, start_response):
+        queries = []
+
+        def counter(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        def start(status, headers, exc_info=None):
+            headers = list(headers) + [(QUERIES_HEADER, str(len(queries)))]
+            return start_response(status, headers, exc_info)
+
+        with connection.execute_wrapper(counter):
+            return application(environ, start)
+    return wrapper
+
+
+class ServerTransport:
+    """Запросы по HTTP к WSGI-серверу, запущенному в этом же процессе."""
+
+    def __init__(self):
+        self.server = ThreadedWSGIServer(('127.0.0.1', 0),
+                                         QuietRequestHandler)
+        self.server.set_app(count_queries(get_wsgi_application()))
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def session(self, username):
+        # CsrfViewMiddleware сверяет токен из cookie и из заголовка
+        token = ''.join(random.choices(string.ascii_letters, k=32))
+        cookies = {settings.CSRF_COOKIE_NAME: token}
+        if username is not None:
+            client = Client()
+            client.force_login(User.objects.get(username=username))
+            cookies[settings.SESSION_COOKIE_NAME] = (
+                client.cookies[settings.SESSION_COOKIE_NAME].value)
+        headers = {
+            'Cookie': '; '.join(f'{k}={v}' for k, v in cookies.items()),
+            'X-CSRFToken': token,
+        }
+
+        def send(method, path, data):
+            conn = http.client.HTTPConnection('127.0.0.1', self.port)
+            body = None
+            request_headers = dict(headers)
+            if isinstance(data, str):
+                body = data.encode()
+                request_headers['Content-Type'] = 'application/json'
+            elif data is not None:
+                body = urlencode(data)
+                request_headers['Content-Type'] = (
+                    'application/x-www-form-urlencoded')
+            try:
+                conn.request(method, path, body, request_headers)
+                response = conn.getresponse()
+                response.read()
+                return (response.status,
+                        int(response.getheader(QUERIES_HEADER, 0)))
+            finally:
+                conn.close()
+        return send
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+async def _asgi_connection(application, reader, writer):
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.close()
+        return
+    lines = head.decode('latin1').split('\r\n')
+    method, target, version = lines[0].split(' ', 2)
+    headers = [tuple(part.strip() for part in line.split(':', 1))
+               for line in lines[1:] if ':' in line]
+    length = int(dict((name.lower(), value) for name, value in headers)
+                 .get('content-length') or 0)
+    path, _, query = target.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': version[len('HTTP/'):],
+        'method': method,
+        'scheme': 'http',
+        'path': unquote(path),
+        'raw_path': path.encode('latin1'),
+        'query_string': query.encode('latin1'),
+        'root_path': '',
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in headers],
+        'server': writer.get_extra_info('sockname')[:2],
+        'client': writer.get_extra_info('peername')[:2],
+    }
+
+    async def receive():
+        nonlocal length
+        chunk = (await reader.read(min(length, asgi.CHUNK_SIZE))
+                 if length else b'')
+        if length and not chunk:
+            return {'type': 'http.disconnect'}
+        length -= len(chunk)
+        return {'type': 'http.request', 'body': chunk,
+                'more_body': length > 0}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            try:
+                reason = HTTPStatus(status).phrase
+            except ValueError:
+                reason = ''
+            lines = [f'HTTP/1.1 {status} {reason}']
+            lines += [f"{name.decode('latin1')}: {value.decode('latin1')}"
+                      for name, value in message.get('headers', [])]
+            lines += ['Connection: close', '', '']
+            writer.write('\r\n'.join(lines).encode('latin1'))
+        elif method != 'HEAD':
+            writer.write(message.get('body', b''))
+        await writer.drain()
+
+    try:
+        await application(scope, receive, send)
+    finally:
+        writer.close()
+
+
+async def serve_asgi(application, host='127.0.0.1', port=0):
+    """Запускает HTTP-сервер для ASGI-приложения, возвращает его.
+
+    Сервер простой, одно соединение — один запрос: он нужен только
+    замерам, в бою yatube.asgi запускает настоящий ASGI-сервер.
+    """
+    return await asyncio.start_server(
+        partial(_asgi_connection, application), host, port)
+
+
+class AsgiServerTransport(ServerTransport):
+    """Запросы по HTTP к ASGI-серверу posts.asgi в этом же процессе."""
+
+    def __init__(self, threads=None):
+        self.handler = asgi.ASGIHandler(
+            count_queries(get_wsgi_application()), threads)
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(serve_asgi(self.handler))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        async def stop():
+            self.server.close()
+            await self.server.wait_closed()
+            # дожидаемся запросов, которые ещё закрываются в пуле
+            await asyncio.gather(*(asyncio.all_tasks()
+                                   - {asyncio.current_task()}))
+
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.handler.close()
+
+
+def percentile(values, percent):
+    """Перцентиль по ближайшему рангу."""
+    ordered = sorted(values)
+    index = max(math.ceil(percent / 100 * len(ordered)) - 1, 0)
+    return ordered[index]
+
+
+def _failed(status, expected):
+    if expected is not None:
+        return status != expected
+    return status >= 500
+
+
+def summarize(results, elapsed, expected=None):
+    timings = [duration * 1000 for duration, _, _ in results]
+    queries = [count for _, count, _ in results]
+    return {
+        'requests': len(results),
+        'errors': sum(_failed(status, expected) for _, _, status in results),
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'mean_ms': round(statistics.mean(timings), 2),
+        'queries_mean': round(statistics.mean(queries), 2),
+        'queries_max': max(queries),
+        'rps': round(len(results) / elapsed, 1) if elapsed else None,
+    }
+
+
+def _worker(scenario, sample, transport, count, seed, threaded):
+    rng = random.Random(seed)
+    viewer = sample.viewer(rng)
+    results = []
+    try:
+        send = transport.session(viewer if scenario.login else None)
+        for _ in range(count):
+            path, data = scenario.build(sample, viewer, rng)
+            start = time.perf_counter()
+            status, queries = send(scenario.method, path, data)
+            results.append((time.perf_counter() - start, queries, status))
+    finally:
+        if threaded:
+            # у каждого потока пула своё соединение с базой
+            connection.close()
+    return results
+
+
+def run_scenario(scenario, sample, transport, requests, concurrency,
+                 seed=0):
+    """Выполняет requests запросов сценария в concurrency потоков."""
+    shares = [requests // concurrency + (number < requests % concurrency)
+              for number in range(concurrency)]
+    shares = [share for share in shares if share]
+    start = time.perf_counter()
+    if len(shares) == 1:
+        results = _worker(scenario, sample, transport, shares[0], seed,
+                          threaded=False)
+    else:
+        results = []
+        with ThreadPoolExecutor(max_workers=len(shares)) as pool:
+            futures = [pool.submit(_worker, scenario, sample, transport,
+                                   share, seed + number, True)
+                       for number, share in enumerate(shares)]
+            for future in futures:
+                results += future.result()
+    return summarize(results, time.perf_counter() - start, scenario.status)
+
+
+def run(scenarios, sample, transport, requests=50, concurrency=4, seed=0,
+        progress=None):
+    """Прогоняет сценарии по очереди, возвращает отчёт по каждому."""
+    report = {}
+    # меряем запись комментариев, а не ограничитель частоты, и
+    # открытие потока событий, а не ожидание новых записей
+    with override_settings(COMMENT_RATE_LIMIT=0, EVENTS_MAX_AGE=0):
+        for scenario in scenarios:
+            report[scenario.name] = run_scenario(scenario, sample, transport,
+                                                 requests, concurrency, seed)
+            if progress is not None:
+                progress(scenario.name, report[scenario.name])
+    return report
+
+
+def compare(routes, baseline, tolerance=0.2, noise_ms=1.0):
+    """Ухудшения относительно эталона в виде списка строк.
+
+    Время считается ухудшившимся, если p95 выросло больше чем на
+    tolerance и больше чем на noise_ms. Среднее число запросов немного
+    плавает из-за попаданий в кэш, поэтому ухудшением считается рост
+    хотя бы на один запрос; число ошибок — любой рост.
+    """
+    regressions = []
+    for name, current in routes.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        grown = current['p95_ms'] - base['p95_ms']
+        if (grown > noise_ms
+                and current['p95_ms'] > base['p95_ms'] * (1 + tolerance)):
+            regressions.append(f'{name}: p95 {base["p95_ms"]} -> '
+                               f'{current["p95_ms"]} мс')
+        if current['queries_mean'] - base['queries_mean'] >= 1:
+            regressions.append(f'{name}: запросов {base["queries_mean"]} -> '
+                               f'{current["queries_mean"]}')
+        if current['errors'] > base['errors']:
+            regressions.append(f'{name}: ошибок {base["errors"]} -> '
+                               f'{current["errors"]}')
+    return regressions
+
+
+LOADERS = ['django.template.loaders.filesystem.Loader',
+           'django.template.loaders.app_directories.Loader']
+
+
+def template_engine(cached):
+    """Движок шаблонов проекта с обычными или кэширующим загрузчиком."""
+    config = settings.TEMPLATES[0]
+    loaders = [('django.template.loaders.cached.Loader', LOADERS)]
+    return DjangoTemplates({
+        'NAME': 'cached' if cached else 'uncached',
+        'DIRS': config['DIRS'],
+        'APP_DIRS': False,
+        'OPTIONS': dict(config['OPTIONS'],
+                        loaders=loaders if cached else LOADERS),
+    })
+
+
+def _render_posts(count):
+    # записи в памяти: id далеко за пределами настоящих, чтобы не
+    # пересечься с их карточками в кэше
+    now = timezone.now()
+    posts = []
+    for number in range(count):
+        author = User(pk=10 ** 9 + number, username=f'render_{number}')
+        post = Post(pk=10 ** 9 + number, author=author, pub_date=now,
+                    text=f'Запись {number}\nвторая строка',
+                    thumbnail_url='/media/cache/render.jpg',
+                    thumbnail_width=960, thumbnail_height=339)
+        post.card_version = 'render'
+        posts.append(post)
+    return posts
+
+
+def render_templates(sizes=(4, 100), rounds=50):
+    """Время рендера index.html для страниц из sizes записей.
+
+    Карточки записей после первого рендера берутся из кэша фрагментов,
+    как в рабочем режиме, так что разница между движками — это в
+    основном разбор шаблонов. Возвращает
+    {движок: {записей: {'mean_ms', 'p95_ms'}}}.
+    """
+    request = RequestFactory().get('/')
+    request.user = AnonymousUser()
+    report = {}
+    for cached in (False, True):
+        engine = template_engine(cached)
+        if cached:
+            warmup.warm(engine.engine)
+        rows = report[engine.name] = {}
+        for size in sizes:
+            paginator = Paginator(_render_posts(size), size)
+            context = {'page': paginator.page(1), 'paginator': paginator}
+            timings = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                engine.get_template('index.html').render(context, request)
+                timings.append((time.perf_counter() - start) * 1000)
+            rows[size] = {'mean_ms': round(statistics.mean(timings), 2),
+                          'p95_ms': round(percentile(timings, 95), 2)}
+    return report
+
+
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'benchmark'),
+    'sqlite': ('posts.sqlite_cache.SQLiteCache', 'cache.sqlite3'),
+    'db': ('django.core.cache.backends.db.DatabaseCache', 'benchmark_cache'),
+}
+
+
+def cache_backend(name, directory):
+    """Пустой кэш для прогона; для sqlite файл создаётся в directory."""
+    path, location = CACHE_BACKENDS[name]
+    if name == 'sqlite':
+        location = os.path.join(directory, location)
+    elif name == 'db':
+        call_command('createcachetable', location, verbosity=0)
+    backend = import_string(path)(location, {
+        'TIMEOUT': None, 'OPTIONS': {'MAX_ENTRIES': 10 ** 6}})
+    backend.clear()
+    return backend
+
+
+def _cache_worker(backend, operations, keys, value, writes, seed):
+    rng = random.Random(seed)
+    names = [f'benchmark:{number}' for number in range(keys)]
+    weights = synthetic.zipf_weights(keys)
+    results = []
+    try:
+        for name in rng.choices(names, cum_weights=weights, k=operations):
+            start = time.perf_counter()
+            hit = False
+            try:
+                if rng.random() < writes:
+                    backend.set(name, value)
+                else:
+                    # как get_or_set: промах сразу заполняется
+                    hit = backend.get(name) is not None
+                    if not hit:
+                        backend.set(name, value)
+                status = 200
+            except Exception:
+                status = 500
+            results.append((time.perf_counter() - start, hit, status))
+    finally:
+        connection.close()
+    return results
+
+
+def run_cache(backends=('locmem', 'sqlite', 'db'), threads=4,
+              operations=2000, keys=1000, value_size=2048, writes=0.1,
+              seed=0):
+    """Отчёт по каждому бэкенду: задержки, операций в секунду, попадания.
+
+    Ключи выбираются по закону Ципфа, как популярные страницы лент;
+    operations — число операций на поток.
+    """
+    value = 'x' * value_size
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in backends:
+            backend = cache_backend(name, directory)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                futures = [pool.submit(_cache_worker, backend, operations,
+                                       keys, value, writes, seed + number)
+                           for number in range(threads)]
+                results = [row for future in futures
+                           for row in future.result()]
+            elapsed = time.perf_counter() - start
+
+            timings = [duration * 1000 for duration, _, _ in results]
+            reads = operations * threads - round(operations * threads
+                                                 * writes)
+            row = report[name] = {
+                'operations': len(results),
+                'errors': sum(status >= 500 for _, _, status in results),
+                'p50_ms': round(percentile(timings, 50), 3),
+                'p95_ms': round(percentile(timings, 95), 3),
+                'p99_ms': round(percentile(timings, 99), 3),
+                'ops': round(len(results) / elapsed),
+                'hit_rate': round(sum(hit for _, hit, _ in results)
+                                  / max(reads, 1), 3),
+            }
+            if hasattr(backend, 'stats'):
+                row['stats'] = backend.stats()
+    return report
@@ -0,0 +1,66 @@
+"""Версии данных для кэша лент и карточек записей.
+
+Вместо того чтобы искать и удалять все ключи, которые мог затронуть
+новый пост или комментарий, ключи кэша включают номер версии, а
+сигналы post_save/post_delete Post, Comment и Group его увеличивают.
+Старые ключи после этого никто не читает, и они вытесняются сами.
+
+Общая версия данных меняется при любой правке и годится для страниц
+лент. Карточка записи (includes/post_item.html) кэшируется по версии
+самой записи: её меняют только правка записи, её изображения, группы
+и комментарии к ней, так что одна и та же карточка в главной ленте,
+группе, профиле и лентах подписок переживает чужие записи.
+"""
+import time
+
+from django.core.cache import cache
+
+VERSION_KEY = 'posts:data_version'
+POST_VERSION_KEY = 'posts:post_version:{}'
+
+
+def _new_version():
+    return int(time.time() * 1000)
+
+
+def data_version(key=VERSION_KEY):
+    version = cache.get(key)
+    if version is None:
+        # начинаем с текущего времени, а не с единицы: если ключ версии
+        # вытеснили, новая версия не совпадёт со старыми ключами
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key=VERSION_KEY):
+    """Увеличивает версию и возвращает новую."""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return data_version(key)
+
+
+def post_versions(posts):
+    """Проставляет записям card_version одним обращением к кэшу."""
+    posts = list(posts)
+    keys = {post.pk: POST_VERSION_KEY.format(post.pk) for post in posts}
+    versions = cache.get_many(keys.values())
+    missing = {key: _new_version() for key in keys.values()
+               if key not in versions}
+    if missing:
+        # гонка с другим запросом безопасна: обе версии новые
+        cache.set_many(missing, None)
+        versions.update(missing)
+    for post in posts:
+        post.card_version = versions[keys[post.pk]]
+    return posts
+
+
+def bump_posts(post_ids):
+    for post_id in post_ids:
+        try:
+            cache.incr(POST_VERSION_KEY.format(post_id))
+        except ValueError:
+            # версии нет, её заведёт следующее чтение
+            pass
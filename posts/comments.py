@@ -0,0 +1,161 @@
+"""Вывод и запись комментариев записи.
+
+Комментарии выбираются по ключу (created, id) от курсора последнего
+показанного комментария, а не через OFFSET, и вместе с авторами одним
+JOIN. Страница записи выводит только первую страницу комментариев,
+остальные подгружаются через views.post_comments, который отдаёт не
+больше COMMENTS_PAGE_MAX комментариев за раз, сколько бы ни попросили.
+
+Все комментарии сохраняет add(). Повторная отправка той же формы
+(обновление страницы, двойной щелчок) узнаётся по токену формы вместе
+с текстом: страница записи отдаётся из кэша и по ETag, и один токен
+может достаться нескольким разным комментариям. Тот же текст того же
+автора к той же записи узнаётся и без токена в течение
+COMMENT_DUPLICATE_WINDOW секунд; в обоих случаях новой строки нет.
+Кроме того, один пользователь может оставить не больше
+COMMENT_RATE_LIMIT комментариев за COMMENT_RATE_WINDOW секунд. Всё
+это проверяется по кэшу, без запросов к базе.
+"""
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from posts.paginator import decode_cursor, encode_key
+
+# сколько помнить токены отправленных форм
+TOKEN_TIMEOUT = 60 * 60 * 24
+
+
+class RateLimited(Exception):
+    """Пользователь оставил слишком много комментариев подряд."""
+
+
+def page_size():
+    return getattr(settings, 'COMMENTS_PAGE_SIZE', 50)
+
+
+def page_max():
+    return getattr(settings, 'COMMENTS_PAGE_MAX', 200)
+
+
+def encode_cursor(comment):
+    return encode_key(comment.created, comment.pk)
+
+
+def _after(comments, created, pk):
+    return comments.filter(Q(created__gt=created)
+                           | Q(created=created, pk__gt=pk))
+
+
+def thread_page(post, after=None, limit=None):
+    """Возвращает (комментарии, курсор следующей страницы или None).
+
+    Комментарии — уже выполненный QuerySet. after — курсор из
+    предыдущей страницы, испорченный курсор означает начало обсуждения.
+    """
+    if limit is None:
+        limit = page_size()
+    limit = max(1, min(limit, page_max()))
+
+    thread = (post.comments.select_related('author')
+              .order_by('created', 'pk'))
+    position = decode_cursor(after)
+    if position is not None:
+        thread = _after(thread, *position)
+
+    page = thread[:limit]
+    if len(page) < limit:
+        return page, None
+    last = page[limit - 1]
+    # полная страница: проверяем по индексу, есть ли что-то за ней
+    if not _after(thread, last.created, last.pk).exists():
+        return page, None
+    return page, encode_cursor(last)
+
+
+def as_json(comment):
+    return {'id': comment.pk,
+            'author': comment.author.username,
+            'text': comment.text,
+            'created': comment.created.isoformat()}
+
+
+def rate_limit():
+    return getattr(settings, 'COMMENT_RATE_LIMIT', 10)
+
+
+def rate_window():
+    return getattr(settings, 'COMMENT_RATE_WINDOW', 60)
+
+
+def duplicate_window():
+    return getattr(settings, 'COMMENT_DUPLICATE_WINDOW', 5 * 60)
+
+
+def new_token():
+    """Токен для скрытого поля формы комментария."""
+    return uuid.uuid4().hex
+
+
+def _check_rate(user_id):
+    limit = rate_limit()
+    if not limit:
+        return
+    window = rate_window()
+    key = f'comment_rate:{user_id}:{int(time.time() // window)}'
+    cache.add(key, 0, window)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # ключ вытеснили между add и incr
+        cache.set(key, 1, window)
+        count = 1
+    if count > limit:
+        raise RateLimited
+
+
+def _digest(text):
+    return hashlib.sha1(' '.join(text.split()).encode()).hexdigest()
+
+
+def _text_key(user_id, post_id, text):
+    return f'comment_text:{user_id}:{post_id}:{_digest(text)}'
+
+
+def add(user, post, form, token=None):
+    """Сохраняет комментарий из проверенной формы CommentForm.
+
+    Возвращает новый комментарий или None, если это повтор уже
+    отправленного. Бросает RateLimited, если пользователь превысил
+    ограничение.
+    """
+    text = form.cleaned_data['text']
+    keys = []
+    if token:
+        keys.append((f'comment_token:{user.pk}:{token}:{_digest(text)}',
+                     TOKEN_TIMEOUT))
+    keys.append((_text_key(user.pk, post.pk, text), duplicate_window()))
+
+    # cache.add атомарен: из двух одновременных повторов проходит один
+    added = []
+    for key, timeout in keys:
+        if not cache.add(key, True, timeout):
+            cache.delete_many(added)
+            return None
+        added.append(key)
+
+    try:
+        _check_rate(user.pk)
+        comment = form.save(commit=False)
+        comment.author = user
+        comment.post = post
+        comment.save()
+    except BaseException:
+        # несохранённый комментарий можно отправить ещё раз
+        cache.delete_many(added)
+        raise
+    return comment
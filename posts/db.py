@@ -0,0 +1,85 @@
+"""Настройка соединений SQLite и чтение лент с реплики.
+
+PRAGMA из настройки SQLITE_PRAGMAS выполняются на каждом новом
+соединении SQLite (см. posts.signals). В боевом профиле
+(yatube.settings_production) это WAL, при котором читатели не ждут
+писателей, а писатели — читателей. Реплика открыта только на чтение,
+поэтому PRAGMA, которые меняют сам файл базы (FILE_PRAGMAS), на ней не
+выполняются: файл переводит в WAL соединение основной базы.
+
+ReplicaRouter отправляет чтения на алиас REPLICA_DATABASE, но только
+внутри read_from_replica(): так на реплику попадают лишь ленты,
+которым не страшно отставание. После первой записи в том же потоке
+чтения возвращаются на основную базу, чтобы запрос видел собственные
+изменения.
+"""
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+_local = threading.local()
+
+# записываются в файл базы, а не действуют на одно соединение
+FILE_PRAGMAS = {'journal_mode', 'auto_vacuum', 'page_size'}
+
+
+def replica_alias():
+    return getattr(settings, 'REPLICA_DATABASE', 'replica')
+
+
+def apply_pragmas(connection):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    read_only = connection.alias == replica_alias()
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            if read_only and name in FILE_PRAGMAS:
+                continue
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@contextmanager
+def read_from_replica():
+    """Чтения внутри блока идут на реплику, если она настроена."""
+    previous = getattr(_local, 'replica', False)
+    _local.replica = True
+    _local.wrote = False
+    try:
+        yield
+    finally:
+        _local.replica = previous
+        _local.wrote = False
+
+
+def replica_view(view):
+    """Читает ленту с реплики; POST и прочие запросы — с основной базы."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        with read_from_replica():
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if (getattr(_local, 'replica', False)
+                and not getattr(_local, 'wrote', False)
+                and replica_alias() in settings.DATABASES):
+            return replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        _local.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплика — копия основной базы, объекты из них связываются
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db != replica_alias()
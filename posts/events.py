@@ -0,0 +1,229 @@
+"""Поток новых записей для открытых лент (server-sent events).
+
+Вместо того чтобы раз за разом перезагружать главную страницу или
+ленту подписок, браузер держит открытым post_events и получает id и
+готовую карточку каждой новой записи своей ленты: общей, группы или
+авторов, на которых подписан зритель.
+
+Источник событий — сигнал post_save Post (posts.signals): после
+фиксации транзакции запись загружается один раз и раздаётся через
+broker всем подписчикам этого процесса, чья лента её включает.
+Карточку каждый подписчик рисует сам, со своими кнопками; общая часть
+карточки берётся из кэша фрагментов.
+
+Медленный клиент не задерживает остальных: у подписчика очередь на
+EVENTS_QUEUE_SIZE событий, и если он не успевает их забирать, лишние
+события отбрасываются, а клиент получает событие overflow и
+перезагружает ленту сам. Каждый открытый поток занимает поток
+сервера, поэтому их число в процессе ограничено
+EVENTS_MAX_CONNECTIONS, а через EVENTS_MAX_AGE секунд поток
+закрывается, и браузер переподключается с Last-Event-ID, не теряя
+записей.
+"""
+import json
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from posts.cache import post_versions
+from posts.feeds import feed_posts
+from posts.models import Post
+
+# через сколько миллисекунд браузеру переподключаться
+RETRY_MS = 3000
+
+Event = namedtuple('Event', 'post')
+
+
+def max_connections():
+    return getattr(settings, 'EVENTS_MAX_CONNECTIONS', 32)
+
+
+def queue_size():
+    return getattr(settings, 'EVENTS_QUEUE_SIZE', 20)
+
+
+def keepalive():
+    return getattr(settings, 'EVENTS_KEEPALIVE', 15)
+
+
+def max_age():
+    return getattr(settings, 'EVENTS_MAX_AGE', 5 * 60)
+
+
+def replay_limit():
+    return getattr(settings, 'EVENTS_REPLAY', 20)
+
+
+class Subscription:
+    """Очередь событий одной ленты одного клиента.
+
+    group — slug группы, authors — id авторов ленты подписок; без них
+    подписка получает все новые записи.
+    """
+
+    def __init__(self, broker, group=None, authors=None):
+        self.broker = broker
+        self.group = group
+        self.authors = authors
+        self.overflowed = False
+        self._queue = queue.Queue(queue_size())
+
+    def matches(self, post):
+        if self.authors is not None:
+            return post.author_id in self.authors
+        if self.group is not None:
+            return post.group is not None and post.group.slug == self.group
+        return True
+
+    def queryset(self):
+        posts = Post.objects.all()
+        if self.authors is not None:
+            return posts.filter(author_id__in=self.authors)
+        if self.group is not None:
+            return posts.filter(group__slug=self.group)
+        return posts
+
+    def push(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Следующее событие или None, если за timeout их не было."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def reset(self):
+        """Забывает накопленное после переполнения."""
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self.overflowed = False
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Подписчики этого процесса и раздача им событий."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, group=None, authors=None):
+        """Новая подписка или None, если потоков уже слишком много."""
+        with self._lock:
+            if len(self._subscriptions) >= max_connections():
+                return None
+            subscription = Subscription(self, group, authors)
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, post):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        event = Event(post)
+        for subscription in subscriptions:
+            if subscription.matches(post):
+                subscription.push(event)
+
+
+broker = Broker()
+
+
+def publish_post(post_id):
+    """Раздаёт новую запись подписчикам этого процесса.
+
+    Пока подписчиков нет, база не читается.
+    """
+    if not len(broker):
+        return
+    post = feed_posts(Post.objects).filter(pk=post_id).first()
+    if post is not None:
+        post_versions([post])
+        broker.publish(post)
+
+
+def message(event, data='', event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {data}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def post_message(request, post):
+    html = render_to_string('includes/post_item.html', {'post': post},
+                            request)
+    return message('post', json.dumps({'id': post.pk, 'html': html}),
+                   post.pk)
+
+
+def stream(request, subscription, last_id=None):
+    """Текст потока событий; подписка закрывается вместе с ним."""
+    try:
+        yield f'retry: {RETRY_MS}\n\n'
+        if last_id is not None:
+            # записи, вышедшие, пока клиент переподключался
+            missed = list(feed_posts(subscription.queryset())
+                          .filter(pk__gt=last_id)
+                          .order_by('-pk')[:replay_limit()])
+            for post in reversed(post_versions(missed)):
+                yield post_message(request, post)
+            if missed:
+                last_id = missed[0].pk
+
+        deadline = time.monotonic() + max_age()
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            event = subscription.get(min(keepalive(), left))
+            if subscription.overflowed:
+                subscription.reset()
+                yield message('overflow')
+            elif event is None:
+                # комментарий не даёт прокси закрыть тихое соединение
+                yield ': ping\n\n'
+            elif last_id is None or event.post.pk > last_id:
+                yield post_message(request, event.post)
+    finally:
+        subscription.close()
+
+
+class EventStream:
+    """Содержимое StreamingHttpResponse с потоком событий.
+
+    Django вызывает close() при закрытии ответа, даже если поток так
+    и не начали читать, и место подписки освобождается.
+    """
+
+    def __init__(self, request, subscription, last_id=None):
+        self.request = request
+        self.subscription = subscription
+        self.last_id = last_id
+
+    def __iter__(self):
+        return stream(self.request, self.subscription, self.last_id)
+
+    def close(self):
+        self.subscription.close()
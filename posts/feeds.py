@@ -0,0 +1,30 @@
+"""Загрузка лент записей для шаблона includes/post_item.html.
+
+Все ленты проходят через load_feed: автор и группа подтягиваются
+одним JOIN, а количество комментариев хранится в самой записи
+(Post.comment_count), поэтому страница ленты стоит постоянное число
+запросов независимо от количества записей на ней. Версии карточек
+записей страницы читаются из кэша одним обращением.
+"""
+from posts.cache import data_version, post_versions
+from posts.paginator import paginate
+
+
+def feed_posts(queryset):
+    """Добавляет к записям всё, что читает post_item.html."""
+    return queryset.select_related('author', 'group')
+
+
+def load_feed(request, queryset, per_page, key=None, cache_pages=False):
+    """Возвращает (paginator, page) с подготовленными записями.
+
+    cache_pages включает кэш страниц по версии данных; подходит только
+    лентам, которые меняются вместе с Post, Comment и Group.
+    """
+    page_key = None
+    if cache_pages and key is not None:
+        page_key = f'feed_page:{data_version()}:{key}'
+    paginator, page = paginate(request, feed_posts(queryset), per_page, key,
+                               count_queryset=queryset, page_key=page_key)
+    post_versions(page.object_list)
+    return paginator, page
@@ -0,0 +1,170 @@
+"""Подписки: кто на кого подписан и пакетные изменения.
+
+FollowState отвечает, подписан ли зритель на автора, по множеству id
+авторов из кэша: на страницу уходит не больше одного запроса, сколько
+бы авторов на ней ни было. Множество сбрасывают сигналы Follow и apply.
+
+Сигналы Follow обновляют счётчики и ленты по одной подписке, то есть
+несколькими запросами на каждую. Здесь подписки создаются одним
+bulk_create, удаляются одним DELETE без сигналов, а счётчики, ленты и
+закэшированные количества обновляются следом для всех авторов сразу.
+Закэшированные подписки сбрасываются после фиксации транзакции: иначе
+параллельный запрос успел бы положить в кэш старое множество.
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+
+from posts import stats, timeline
+from posts.models import Follow
+from posts.paginator import count_key
+
+User = get_user_model()
+
+# больше авторов за один запрос не принимаем
+BATCH_LIMIT = 100
+
+# сколько хранить множество подписок пользователя
+FOLLOWING_TIMEOUT = 60 * 60
+
+
+def following_key(user_id):
+    return f'following:{user_id}'
+
+
+def following_ids(user_id):
+    """Множество id авторов, на которых подписан пользователь."""
+    key = following_key(user_id)
+    ids = cache.get(key)
+    if ids is None:
+        ids = frozenset(Follow.objects.filter(user_id=user_id)
+                        .values_list('author_id', flat=True))
+        cache.set(key, ids, FOLLOWING_TIMEOUT)
+    return ids
+
+
+def forget(user_id):
+    """Сбрасывает закэшированные подписки и размер ленты подписок."""
+    cache.delete_many([following_key(user_id), count_key('follow', user_id)])
+
+
+def _delete(user_id, author_ids):
+    """Удаляет подписки одним DELETE, без сбора объектов и сигналов.
+
+    Сигналы Follow обновили бы счётчики и ленты второй раз.
+    """
+    meta = Follow._meta
+    placeholders = ', '.join(['%s'] * len(author_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(meta.db_table)} '
+            f'WHERE {meta.get_field("user").column} = %s '
+            f'AND {meta.get_field("author").column} IN ({placeholders})',
+            [user_id, *author_ids])
+
+
+def _create(user_id, author_ids):
+    """Создаёт подписки одним INSERT.
+
+    INSERT выполняется в своей точке сохранения: если он упадёт на
+    уникальности, транзакция вызывающего останется рабочей.
+    """
+    with transaction.atomic():
+        Follow.objects.bulk_create(
+            [Follow(user_id=user_id, author_id=author_id)
+             for author_id in author_ids])
+
+
+class FollowState:
+    """Подписки зрителя, загружаются при первом вопросе.
+
+    Проверка «post.author_id in state» работает и в шаблонах;
+    анонимный зритель ни на кого не подписан.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._ids = None
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = (following_ids(self.user.pk)
+                         if self.user.is_authenticated else frozenset())
+        return self._ids
+
+    def __contains__(self, author):
+        return getattr(author, 'pk', author) in self.ids
+
+    def follows(self, author):
+        return author in self
+
+
+def state_for(request):
+    """Один FollowState на запрос, общий для view и шаблонов."""
+    state = getattr(request, 'follow_state', None)
+    if state is None:
+        state = request.follow_state = FollowState(request.user)
+    return state
+
+
+def apply(user, follow=(), unfollow=()):
+    """Подписывает user на авторов follow и отписывает от unfollow.
+
+    Повторная подписка и отписка от тех, на кого user не подписан,
+    ничего не меняют. Возвращает словарь с новыми и снятыми подписками,
+    ненайденными именами и итоговым состоянием по всем именам.
+    """
+    names = set(follow) | set(unfollow)
+    authors = dict(User.objects
+                   .filter(username__in=names)
+                   .exclude(pk=user.pk)
+                   .values_list('username', 'pk'))
+    to_follow = {authors[name] for name in follow if name in authors}
+    to_unfollow = {authors[name] for name in unfollow
+                   if name in authors} - to_follow
+
+    with transaction.atomic():
+        current = Follow.objects.filter(user=user,
+                                        author_id__in=authors.values())
+        existing = set(current.values_list('author_id', flat=True))
+        while True:
+            created = to_follow - existing
+            try:
+                _create(user.pk, created)
+                break
+            except IntegrityError:
+                # параллельный запрос вставил часть подписок между SELECT
+                # и INSERT и уже учёл их в счётчиках: перечитываем
+                # подписки и вставляем только недостающие
+                fresh = set(current.values_list('author_id', flat=True))
+                if fresh == existing:
+                    raise
+                existing = fresh
+        removed = to_unfollow & existing
+
+        if removed:
+            _delete(user.pk, sorted(removed))
+
+        if created:
+            stats.bump_many(created, create=True, followers_count=1)
+            stats.bump_user(user.pk, create=True,
+                            following_count=len(created))
+            timeline.follow_many(user.pk, created)
+        if removed:
+            stats.bump_many(removed, followers_count=-1)
+            stats.bump_user(user.pk, following_count=-len(removed))
+            timeline.unfollow_many(user.pk, removed)
+        if created or removed:
+            user_id = user.pk
+            transaction.on_commit(lambda: forget(user_id))
+
+    names_by_pk = {pk: name for name, pk in authors.items()}
+    following = (existing | created) - removed
+    return {
+        'followed': sorted(names_by_pk[pk] for pk in created),
+        'unfollowed': sorted(names_by_pk[pk] for pk in removed),
+        'not_found': sorted(names - set(authors) - {user.username}),
+        'following': {name: pk in following
+                      for name, pk in sorted(authors.items())},
+    }
@@ -1,6 +1,8 @@
+from django.conf import settings
 from django.forms import ModelForm, Textarea
 
 from posts.models import Comment, Post
+from posts.uploads import check_header, downscale, read_header
 
 
 class PostForm(ModelForm):
@@ -19,6 +21,42 @@ class PostForm(ModelForm):
             'image': 'Изображение'
         }
 
+    image_errors = {
+        'too_large': 'Файл изображения слишком большой',
+        'too_many_pixels': 'Изображение слишком большое по размерам',
+    }
+
+    def full_clean(self):
+        # ImageField проверяет картинку, открывая её Pillow, поэтому
+        # заголовок проверяем раньше и плохой файл до поля не доходит
+        error = self.image_header_error()
+        if error:
+            self.files = self.files.copy()
+            del self.files['image']
+        super().full_clean()
+        if error:
+            messages = dict(self.fields['image'].error_messages,
+                            **self.image_errors)
+            self.add_error('image', messages[error])
+
+    def image_header_error(self):
+        """Код ошибки из ImageUploadHandler или по заголовку файла."""
+        if not self.is_bound or not self.files.get('image'):
+            return None
+        uploaded = self.files['image']
+        if hasattr(uploaded, 'upload_error'):
+            return uploaded.upload_error
+        error = check_header(read_header(uploaded))
+        uploaded.seek(0)
+        return error
+
+    def clean_image(self):
+        image = self.cleaned_data.get('image')
+        max_side = getattr(settings, 'POST_IMAGE_MAX_SIDE', None)
+        if image and max_side and image is self.files.get('image'):
+            image = downscale(image, max_side)
+        return image
+
 
 class CommentForm(ModelForm):
     class Meta:
@@ -0,0 +1,172 @@
+"""Условные запросы к лентам: ETag и 304.
+
+conditional() до выполнения view считает дешёвый ключ свежести: дату
+последней записи или комментария (один запрос по индексу) и версию
+данных (posts.cache), которая меняется при правке записей, их
+миниатюр, комментариях и правке групп. Если ETag совпал с тем, что
+прислал клиент, отвечаем 304, не выбирая и не рисуя ленту. Даты,
+которые зависят только от записей и комментариев (versioned), хранятся
+в кэше до смены версии данных, и повторный запрос обходится без базы.
+
+Last-Modified не отдаётся: дата самой свежей записи не меняется при
+правке, комментарии и подписке, а удаление записи сдвигает её назад,
+и клиент с одним If-Modified-Since получал бы устаревшую ленту.
+
+HTML-страница зависит ещё и от зрителя: вошедшему пользователю видны
+его имя, кнопки подписки и форма комментария. Для таких view
+(per_viewer=True) в ETag входят пользователь и его подписки, ответ
+вошедшему помечается private, а анонимный — public с max-age
+FEED_CACHE_MAX_AGE, чтобы его мог хранить обратный прокси. Vary: Cookie
+не даёт прокси отдать анонимную страницу вошедшему пользователю.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import (get_conditional_response,
+                                patch_cache_control, patch_vary_headers)
+from django.utils.http import quote_etag
+
+from posts.cache import data_version
+from posts.follows import following_ids
+from posts.models import Comment, Post, UserStats
+from posts.timeline import follow_feed
+
+
+# сколько хранить даты лент одной версии данных
+MODIFIED_TIMEOUT = 60 * 60
+
+
+def max_age():
+    return getattr(settings, 'FEED_CACHE_MAX_AGE', 0)
+
+
+def versioned(last_modified):
+    """Кэширует дату ленты до смены версии данных.
+
+    Годится для функций, результат которых зависит только от
+    аргументов адреса и от записей и комментариев: их сигналы меняют
+    версию данных.
+    """
+    @wraps(last_modified)
+    def wrapper(request, *args, **kwargs):
+        arguments = repr((args, sorted(kwargs.items()))).encode()
+        key = 'freshness:{}:{}:{}'.format(
+            data_version(), last_modified.__name__,
+            hashlib.md5(arguments).hexdigest())
+        cached = cache.get(key)
+        if cached is None:
+            cached = (last_modified(request, *args, **kwargs),)
+            cache.set(key, cached, MODIFIED_TIMEOUT)
+        return cached[0]
+    return wrapper
+
+
+def latest(queryset, field='pub_date'):
+    """Дата самой свежей строки, один запрос по индексу."""
+    return (queryset.order_by('-' + field)
+            .values_list(field, flat=True).first())
+
+
+@versioned
+def index_modified(request):
+    return latest(Post.objects)
+
+
+@versioned
+def group_modified(request, slug):
+    return latest(Post.objects.filter(group__slug=slug))
+
+
+@versioned
+def profile_modified(request, username):
+    return latest(Post.objects.filter(author__username=username))
+
+
+def profile_counters(request, username):
+    # подписки не меняют версию данных, а счётчики есть в ответе
+    return (UserStats.objects.filter(user__username=username)
+            .values_list('followers_count', 'following_count').first())
+
+
+@versioned
+def post_modified(request, username, post_id):
+    """Дата записи или её последнего комментария."""
+    # запись одна, сортировка не нужна
+    row = (Post.objects.filter(pk=post_id, author__username=username)
+           .order_by().values_list('pub_date', flat=True)[:1])
+    if not row:
+        return None
+    published = row[0]
+    commented = latest(Comment.objects.filter(post_id=post_id), 'created')
+    return max(published, commented or published)
+
+
+def post_counters(request, username, post_id):
+    # страница записи показывает счётчики автора, как профиль
+    return profile_counters(request, username)
+
+
+@versioned
+def comments_modified(request, post_id):
+    return latest(Comment.objects.filter(post_id=post_id), 'created')
+
+
+def follow_modified(request):
+    return latest(follow_feed(request.user))
+
+
+def follow_authors(request):
+    return ','.join(map(str, sorted(following_ids(request.user.pk))))
+
+
+def viewer(request):
+    """Часть ETag страницы, которая зависит от зрителя."""
+    if not request.user.is_authenticated:
+        return ''
+    return f'{request.user.pk}:{follow_authors(request)}'
+
+
+def conditional(last_modified, extra=None, per_viewer=False):
+    """ETag для view; неизменившаяся лента — 304.
+
+    last_modified(request, *args, **kwargs) возвращает дату последней
+    записи ленты или None, extra — то же для дополнительной части ETag
+    (например, подписок зрителя). per_viewer — для HTML-страниц, вид
+    которых зависит от вошедшего пользователя. Запросы, кроме GET и
+    HEAD, передаются view как есть.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            modified = last_modified(request, *args, **kwargs)
+            parts = [modified.isoformat() if modified else '',
+                     str(data_version())]
+            if extra is not None:
+                parts.append(str(extra(request, *args, **kwargs)))
+            if per_viewer:
+                parts.append(viewer(request))
+            etag = quote_etag(hashlib.md5(
+                ':'.join(parts).encode()).hexdigest())
+
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            if response.status_code not in (200, 304):
+                return response
+            response.setdefault('ETag', etag)
+            if per_viewer:
+                if request.user.is_authenticated:
+                    patch_cache_control(response, private=True,
+                                        no_cache=True)
+                else:
+                    patch_cache_control(response, public=True,
+                                        max_age=max_age())
+                patch_vary_headers(response, ('Cookie',))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,120 @@
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from posts import benchmark, synthetic
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный прогон всех адресов posts.urls и users.urls на '
+            'временной базе с синтетическими данными')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--groups', type=int, default=20)
+        parser.add_argument('--posts', type=int, default=20000)
+        parser.add_argument('--comments', type=int, default=50000)
+        parser.add_argument('--follows', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--requests', type=int, default=50,
+                            help='запросов на каждый сценарий')
+        parser.add_argument('--concurrency', type=int, default=4)
+        transport = parser.add_mutually_exclusive_group()
+        transport.add_argument('--server', action='store_true',
+                               help='слать запросы локальному '
+                                    'WSGI-серверу, а не через тестовый '
+                                    'клиент')
+        transport.add_argument('--asgi', action='store_true',
+                               help='слать запросы локальному '
+                                    'ASGI-серверу (posts.asgi)')
+        parser.add_argument('--only', nargs='+', metavar='SCENARIO',
+                            help='прогнать только эти сценарии')
+        parser.add_argument('--output', help='сохранить отчёт в JSON')
+        parser.add_argument('--baseline',
+                            help='сравнить с сохранённым отчётом')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='допустимый рост p95, доля от эталона')
+        parser.add_argument('--yes-populate', action='store_true',
+                            help='мерить на настроенной базе: дописать в '
+                                 'неё синтетические данные и менять её '
+                                 'сценариями с POST')
+
+    def handle(self, *args, **options):
+        scenarios = benchmark.SCENARIOS
+        if options['only']:
+            scenarios = [scenario for scenario in scenarios
+                         if scenario.name in options['only']]
+            if not scenarios:
+                raise CommandError('Нет таких сценариев')
+
+        if options['yes_populate']:
+            routes, name = self.measure(scenarios, options)
+        else:
+            self.stdout.write('Создаём временную базу...')
+            with synthetic.scratch_database():
+                routes, name = self.measure(scenarios, options)
+
+        report = {
+            'meta': {
+                'created': timezone.now().isoformat(),
+                'transport': name,
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'python': platform.python_version(),
+                'django': django.get_version(),
+            },
+            'routes': routes,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, ensure_ascii=False, indent=2)
+            self.stdout.write(f'Отчёт сохранён в {options["output"]}')
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                base = json.load(baseline)
+            for field in ('transport', 'requests', 'concurrency'):
+                if base['meta'].get(field) != report['meta'][field]:
+                    self.stdout.write(self.style.WARNING(
+                        f'Эталон снят с другим {field}: '
+                        f'{base["meta"].get(field)}'))
+            regressions = benchmark.compare(routes, base['routes'],
+                                            options['tolerance'])
+            if regressions:
+                raise CommandError('Ухудшения относительно эталона:\n'
+                                   + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS(
+                'Ухудшений относительно эталона нет'))
+
+    def measure(self, scenarios, options):
+        """Наполняет базу и прогоняет сценарии: (отчёт, транспорт)."""
+        synthetic.populate(options['users'], options['groups'],
+                           options['posts'], options['comments'],
+                           options['follows'], seed=options['seed'],
+                           progress=self.stdout.write)
+
+        if options['asgi']:
+            transport, name = benchmark.AsgiServerTransport(), 'asgi'
+        elif options['server']:
+            transport, name = benchmark.ServerTransport(), 'server'
+        else:
+            transport, name = benchmark.ClientTransport(), 'client'
+        self.stdout.write(f'{"сценарий":<20}{"p50":>9}{"p95":>9}{"p99":>9}'
+                          f'{"SQL":>7}{"rps":>8}{"ошибки":>8}')
+        try:
+            routes = benchmark.run(scenarios, benchmark.Sample(), transport,
+                                   requests=options['requests'],
+                                   concurrency=options['concurrency'],
+                                   seed=options['seed'],
+                                   progress=self.write_row)
+        finally:
+            transport.close()
+        return routes, name
+
+    def write_row(self, name, row):
+        self.stdout.write(f'{name:<20}{row["p50_ms"]:>9}{row["p95_ms"]:>9}'
+                          f'{row["p99_ms"]:>9}{row["queries_mean"]:>7}'
+                          f'{row["rps"]:>8}{row["errors"]:>8}')
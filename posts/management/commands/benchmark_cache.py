@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from posts import benchmark, synthetic
+
+
+class Command(BaseCommand):
+    help = ('Сравнение бэкендов кэша под одновременным доступом '
+            'из нескольких потоков. DatabaseCache создаёт таблицу '
+            'benchmark_cache во временной базе')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backends', nargs='+',
+                            choices=sorted(benchmark.CACHE_BACKENDS),
+                            default=['locmem', 'sqlite', 'db'])
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--operations', type=int, default=2000,
+                            help='операций на поток')
+        parser.add_argument('--keys', type=int, default=1000)
+        parser.add_argument('--value-size', type=int, default=2048)
+        parser.add_argument('--writes', type=float, default=0.1,
+                            help='доля записей среди операций')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--yes-populate', action='store_true',
+                            help='создать таблицу benchmark_cache в '
+                                 'настроенной базе')
+
+    def handle(self, *args, **options):
+        arguments = (options['backends'], options['threads'],
+                     options['operations'], options['keys'],
+                     options['value_size'], options['writes'],
+                     options['seed'])
+        if options['yes_populate'] or 'db' not in options['backends']:
+            report = benchmark.run_cache(*arguments)
+        else:
+            with synthetic.scratch_database():
+                report = benchmark.run_cache(*arguments)
+        self.stdout.write(f'{"бэкенд":<8}{"p50, мс":>10}{"p95, мс":>10}'
+                          f'{"p99, мс":>10}{"оп/с":>9}{"попадания":>11}'
+                          f'{"ошибки":>8}')
+        for name, row in report.items():
+            self.stdout.write(
+                f'{name:<8}{row["p50_ms"]:>10}{row["p95_ms"]:>10}'
+                f'{row["p99_ms"]:>10}{row["ops"]:>9}{row["hit_rate"]:>11}'
+                f'{row["errors"]:>8}')
+            if 'stats' in row:
+                self.stdout.write(f'        {row["stats"]}')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from posts import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Время рендера index.html с обычными и кэширующим '
+            'загрузчиком шаблонов')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[4, 100],
+                            help='записей на странице')
+        parser.add_argument('--rounds', type=int, default=50)
+
+    def handle(self, *args, **options):
+        report = benchmark.render_templates(options['sizes'],
+                                            options['rounds'])
+        self.stdout.write(f'{"загрузчик":<12}{"записей":>9}'
+                          f'{"среднее, мс":>13}{"p95, мс":>10}')
+        for engine, rows in report.items():
+            for size, row in rows.items():
+                self.stdout.write(f'{engine:<12}{size:>9}'
+                                  f'{row["mean_ms"]:>13}{row["p95_ms"]:>10}')
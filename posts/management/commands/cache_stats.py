@@ -0,0 +1,17 @@
+import json
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Размер и счётчики попаданий общего кэша (SQLiteCache)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--alias', default='default')
+
+    def handle(self, *args, **options):
+        cache = caches[options['alias']]
+        if not hasattr(cache, 'stats'):
+            raise CommandError(f'{type(cache).__name__} не ведёт счётчиков')
+        self.stdout.write(json.dumps(cache.stats(), indent=2))
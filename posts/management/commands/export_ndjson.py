@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from posts import ndjson
+
+
+class Command(BaseCommand):
+    help = ('Выгружает группы, пользователей, записи, комментарии и '
+            'подписки в NDJSON (файл .gz сжимается)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="файл или '-' для stdout")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--media-to',
+                            help='скопировать изображения в этот каталог')
+
+    def handle(self, *args, **options):
+        # при выгрузке в stdout прогресс не должен попасть в файл
+        write = self.stderr.write if options['path'] == '-' else (
+            self.stdout.write)
+        progress = ndjson.Throughput(write)
+        with ndjson.open_file(options['path'], 'w') as output:
+            count = ndjson.export(output, options['chunk_size'],
+                                  options['media_to'], progress)
+        progress(count)
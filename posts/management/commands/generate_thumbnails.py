@@ -0,0 +1,50 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from posts import thumbnails
+from posts.models import Post
+
+
+def generate_chunk(post_ids):
+    """Выполняется в дочернем процессе со своим соединением к базе."""
+    try:
+        return sum(thumbnails.generate(post_id) for post_id in post_ids)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Создаёт миниатюры изображений записей на всех ядрах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--chunk-size', type=int, default=100)
+        parser.add_argument('--all', action='store_true',
+                            help='пересоздать и уже готовые миниатюры')
+
+    def handle(self, *args, **options):
+        posts = Post.objects.exclude(image='').exclude(image=None)
+        if not options['all']:
+            posts = posts.filter(thumbnail_url='')
+        post_ids = list(posts.order_by('pk').values_list('pk', flat=True))
+        size = options['chunk_size']
+        chunks = [post_ids[i:i + size] for i in range(0, len(post_ids), size)]
+
+        # дочерние процессы не должны унаследовать открытые соединения;
+        # fork, как и в tasks: при spawn дочерний процесс не знает о
+        # настройках Django
+        connections.close_all()
+        done = 0
+        with ProcessPoolExecutor(
+                max_workers=options['workers'],
+                mp_context=multiprocessing.get_context('fork')) as pool:
+            for count in pool.map(generate_chunk, chunks):
+                done += count
+                self.stdout.write(f'{done} из {len(post_ids)}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано миниатюр: {done}'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import ndjson
+
+
+class Command(BaseCommand):
+    help = ('Загружает NDJSON, выгруженный export_ndjson. Пользователи '
+            'сопоставляются по username, группы по slug')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="файл или '-' для stdin")
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--media-from',
+                            help='каталог с изображениями из --media-to')
+
+    def handle(self, *args, **options):
+        progress = ndjson.Throughput(self.stdout.write)
+        importer = ndjson.Importer(options['batch_size'],
+                                   options['media_from'], progress)
+        try:
+            with ndjson.open_file(options['path'], 'r') as lines:
+                count = importer.run(lines)
+        except (KeyError, ValueError) as error:
+            raise CommandError(f'Файл не удалось загрузить, ничего не '
+                               f'загружено: {error!r}')
+        self.stdout.write(self.style.SUCCESS(f'Загружено строк: {count}'))
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from posts import metrics
+
+
+class Command(BaseCommand):
+    help = ('Самые дорогие представления по метрикам запросов '
+            'из общего кэша')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=None,
+                            help='окно отчёта, по умолчанию '
+                                 'REQUEST_METRICS_WINDOW')
+        parser.add_argument('--sort', choices=('total', 'p95', 'sql'),
+                            default='total')
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--json', action='store_true')
+
+    def handle(self, *args, **options):
+        rows = metrics.report(options['minutes'],
+                              options['sort'])[:options['limit']]
+        if options['json']:
+            self.stdout.write(json.dumps(rows, ensure_ascii=False, indent=2))
+            return
+        if not rows:
+            self.stdout.write('Метрик пока нет')
+            return
+
+        self.stdout.write(f'{"представление":<40}{"запросов":>9}'
+                          f'{"всего, мс":>11}{"p50":>7}{"p95":>7}'
+                          f'{"p99":>7}{"шабл.":>8}{"SQL":>6}{"SQL, мс":>9}')
+        for row in rows:
+            self.stdout.write(
+                f'{row["view"][:39]:<40}{row["count"]:>9}'
+                f'{row["total_ms"]:>11}{row["p50_ms"]:>7}{row["p95_ms"]:>7}'
+                f'{row["p99_ms"]:>7}{row["template_ms"]:>8}'
+                f'{row["sql_count"]:>6}{row["sql_ms"]:>9}')
+            for duplicate in row['duplicates'][:3]:
+                self.stdout.write(self.style.WARNING(
+                    f'    x{duplicate["count"]} {duplicate["sql"][:100]}'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from posts import tasks
+
+
+class Command(BaseCommand):
+    help = ('Выполняет задачи из очереди posts.tasks. Без --once '
+            'работает, пока его не остановят')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=1,
+                            help='потоков в каждом процессе')
+        parser.add_argument('--processes', type=int, default=0,
+                            help='дочерних процессов; 0 — выполнять '
+                                 'задачи в этом процессе')
+        parser.add_argument('--once', action='store_true',
+                            help='выполнить готовые задачи и выйти')
+
+    def handle(self, *args, **options):
+        try:
+            if options['processes']:
+                tasks.work_processes(options['processes'],
+                                     options['threads'])
+                return
+            done = tasks.work(options['threads'], once=options['once'])
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(f'Выполнено задач: {done}')
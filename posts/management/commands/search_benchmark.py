@@ -0,0 +1,69 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from posts import search, synthetic
+from posts.models import Post
+
+User = get_user_model()
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает полнотекстовый поиск с icontains на временной '
+            'базе с синтетическими записями')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument('--yes-populate', action='store_true',
+                            help='мерить на настроенной базе и дописать '
+                                 'в неё недостающие записи')
+
+    def handle(self, *args, **options):
+        if options['yes_populate']:
+            self.benchmark(options)
+            return
+        self.stdout.write('Создаём временную базу...')
+        with synthetic.scratch_database():
+            self.benchmark(options)
+
+    def benchmark(self, options):
+        author, _ = User.objects.get_or_create(username='search_benchmark')
+        missing = options['posts'] - Post.objects.count()
+        if missing > 0:
+            self.stdout.write(f'Создаём {missing} записей...')
+            synthetic.create_posts(
+                missing, [author], seed=Post.objects.count(),
+                progress=lambda done: self.stdout.write(f'  {done}'))
+            search.get_backend().rebuild()
+
+        backend = type(search.get_backend()).__name__
+        words = synthetic.vocabulary()
+        limit = options['limit']
+        self.stdout.write(f'Записей: {Post.objects.count()}, '
+                          f'индекс: {backend}')
+        self.stdout.write(f'{"слово":<12}{"ранг":>8}'
+                          f'{"индекс, мс":>14}{"icontains, мс":>16}')
+        for rank in (1, 10, 100, 1000, 4000):
+            word = words[rank - 1]
+            indexed = measure(lambda: search.search(word, limit),
+                              options['repeat'])
+            scanned = measure(
+                lambda: list(Post.objects
+                             .filter(text__icontains=word)
+                             .order_by('-pub_date')[:limit]),
+                options['repeat'])
+            self.stdout.write(f'{word:<12}{rank:>8}'
+                              f'{indexed:>14.2f}{scanned:>16.2f}')
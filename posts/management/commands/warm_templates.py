@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from posts import warmup
+
+
+class Command(BaseCommand):
+    help = ('Разбирает все шаблоны проекта и выводит время разбора '
+            'каждого, самые медленные первыми')
+
+    def handle(self, *args, **options):
+        timings = sorted(warmup.warm(), key=lambda row: row[1], reverse=True)
+        for name, seconds in timings:
+            self.stdout.write(f'{seconds * 1000:>8.2f} мс  {name}')
+        total = sum(seconds for _, seconds in timings)
+        self.stdout.write(f'{total * 1000:>8.2f} мс  всего, '
+                          f'шаблонов: {len(timings)}')
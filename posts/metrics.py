@@ -0,0 +1,262 @@
+"""Метрики запросов: время ответа, шаблоны, SQL и повторы SQL.
+
+RequestMetricsMiddleware (posts.middleware) отдаёт сюда каждый запрос.
+Время ответа учитывается у всех запросов, а время шаблонов, число и
+время SQL и повторяющиеся SQL (признак N+1) — только у доли
+REQUEST_METRICS_SAMPLE_RATE запросов, чтобы метрики можно было
+оставить включёнными в бою.
+
+Данные копятся в памяти процесса по минутам и раз в
+REQUEST_METRICS_FLUSH_INTERVAL секунд записываются в кэш под ключом
+процесса. Отчёт собирает последние REQUEST_METRICS_WINDOW минут всех
+процессов, которые пишут в общий кэш.
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.base import Template
+
+WORKERS_KEY = 'request_metrics:workers'
+
+# верхние границы корзин гистограммы времени ответа, мс
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# сколько повторяющихся SQL хранить на одно представление
+DUPLICATES_KEPT = 10
+
+_local = threading.local()
+
+
+def sample_rate():
+    return getattr(settings, 'REQUEST_METRICS_SAMPLE_RATE', 0.1)
+
+
+def window():
+    return getattr(settings, 'REQUEST_METRICS_WINDOW', 60)
+
+
+def flush_interval():
+    return getattr(settings, 'REQUEST_METRICS_FLUSH_INTERVAL', 10)
+
+
+class Probe:
+    """Счётчики одного запроса; вызывается как execute_wrapper."""
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.depth = 0
+        self.statements = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.sql_count += 1
+            # параметры в sql не подставлены, поэтому одинаковые запросы
+            # с разными id совпадают — так и выглядит N+1
+            self.statements[sql] = self.statements.get(sql, 0) + 1
+
+    def duplicates(self):
+        return {sql: count for sql, count in self.statements.items()
+                if count > 1}
+
+
+def start(probe):
+    _local.probe = probe
+
+
+def stop():
+    _local.probe = None
+
+
+_original_render = None
+
+
+def _render(self, context):
+    probe = getattr(_local, 'probe', None)
+    if probe is None:
+        return _original_render(self, context)
+    # {% include %} вызывает _render вложенного шаблона, учитываем
+    # только внешний, чтобы не считать время дважды
+    probe.depth += 1
+    started = time.perf_counter()
+    try:
+        return _original_render(self, context)
+    finally:
+        probe.depth -= 1
+        if not probe.depth:
+            probe.template_time += time.perf_counter() - started
+
+
+def install():
+    """Подменяет Template._render, чтобы мерить время шаблонов."""
+    global _original_render
+    if Template._render is not _render:
+        _original_render = Template._render
+        Template._render = _render
+
+
+def empty():
+    return {'count': 0, 'sampled': 0, 'time': 0.0, 'max': 0.0,
+            'template': 0.0, 'sql': 0, 'sql_time': 0.0,
+            'buckets': [0] * (len(BUCKETS) + 1), 'duplicates': {}}
+
+
+def merge(total, item):
+    """Добавляет к total метрики item, оба в формате empty()."""
+    for field in ('count', 'sampled', 'time', 'template', 'sql',
+                  'sql_time'):
+        total[field] += item[field]
+    total['max'] = max(total['max'], item['max'])
+    total['buckets'] = [a + b for a, b in zip(total['buckets'],
+                                              item['buckets'])]
+    _add_duplicates(total, item['duplicates'])
+    return total
+
+
+def _add_duplicates(stats, duplicates):
+    """Для каждого SQL хранится наибольшее число повторов за запрос."""
+    kept = stats['duplicates']
+    for sql, count in duplicates.items():
+        kept[sql] = max(kept.get(sql, 0), count)
+    if len(kept) > DUPLICATES_KEPT:
+        top = sorted(kept.items(), key=lambda item: -item[1])
+        stats['duplicates'] = dict(top[:DUPLICATES_KEPT])
+
+
+def _bucket(ms):
+    for index, bound in enumerate(BUCKETS):
+        if ms <= bound:
+            return index
+    return len(BUCKETS)
+
+
+class Recorder:
+    """Метрики процесса по минутам: {минута: {представление: метрики}}."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.minutes = {}
+        self.flushed = time.monotonic()
+
+    def key(self):
+        return f'request_metrics:{os.getpid()}'
+
+    def record(self, view, duration, probe=None):
+        minute = int(time.time() // 60)
+        ms = duration * 1000
+        with self.lock:
+            views = self.minutes.setdefault(minute, {})
+            stats = views.get(view)
+            if stats is None:
+                stats = views[view] = empty()
+            stats['count'] += 1
+            stats['time'] += ms
+            stats['max'] = max(stats['max'], ms)
+            stats['buckets'][_bucket(ms)] += 1
+            if probe is not None:
+                stats['sampled'] += 1
+                stats['template'] += probe.template_time * 1000
+                stats['sql'] += probe.sql_count
+                stats['sql_time'] += probe.sql_time * 1000
+                _add_duplicates(stats, probe.duplicates())
+            due = time.monotonic() - self.flushed >= flush_interval()
+        if due:
+            self.flush()
+
+    def flush(self):
+        oldest = int(time.time() // 60) - window()
+        with self.lock:
+            for minute in [minute for minute in self.minutes
+                           if minute <= oldest]:
+                del self.minutes[minute]
+            snapshot = {minute: {view: dict(stats, duplicates=dict(
+                                     stats['duplicates']))
+                                 for view, stats in views.items()}
+                        for minute, views in self.minutes.items()}
+            self.flushed = time.monotonic()
+
+        key = self.key()
+        cache.set(key, snapshot, window() * 60)
+        # список процессов только дополняется: если параллельный
+        # сброс его перезапишет, ключ вернётся при следующем сбросе
+        workers = cache.get(WORKERS_KEY) or []
+        if key not in workers:
+            cache.set(WORKERS_KEY, workers + [key], None)
+
+    def reset(self):
+        with self.lock:
+            self.minutes = {}
+
+
+recorder = Recorder()
+
+
+def collect(minutes=None):
+    """Метрики всех процессов за последние minutes минут по view."""
+    minutes = window() if minutes is None else minutes
+    oldest = int(time.time() // 60) - minutes
+    workers = cache.get(WORKERS_KEY) or []
+    snapshots = cache.get_many(workers)
+    if len(snapshots) != len(workers):
+        # процессы, чьи ключи истекли, больше не пишут
+        cache.set(WORKERS_KEY, [key for key in workers if key in snapshots],
+                  None)
+
+    views = {}
+    for snapshot in snapshots.values():
+        for minute, items in snapshot.items():
+            if minute <= oldest:
+                continue
+            for view, stats in items.items():
+                merge(views.setdefault(view, empty()), stats)
+    return views
+
+
+def _percentile(stats, percent):
+    """Верхняя граница корзины, в которую попал перцентиль."""
+    needed = stats['count'] * percent / 100
+    seen = 0
+    for index, count in enumerate(stats['buckets']):
+        seen += count
+        if count and seen >= needed:
+            return BUCKETS[index] if index < len(BUCKETS) else stats['max']
+    return stats['max']
+
+
+def report(minutes=None, sort='total'):
+    """Строки отчёта, самые дорогие представления первыми.
+
+    sort: total — суммарное время, p95 — 95-й перцентиль, sql — среднее
+    число SQL-запросов.
+    """
+    rows = []
+    for view, stats in collect(minutes).items():
+        sampled = stats['sampled'] or 1
+        rows.append({
+            'view': view,
+            'count': stats['count'],
+            'sampled': stats['sampled'],
+            'total_ms': round(stats['time'], 1),
+            'mean_ms': round(stats['time'] / stats['count'], 2),
+            'p50_ms': _percentile(stats, 50),
+            'p95_ms': _percentile(stats, 95),
+            'p99_ms': _percentile(stats, 99),
+            'max_ms': round(stats['max'], 2),
+            'template_ms': round(stats['template'] / sampled, 2),
+            'sql_count': round(stats['sql'] / sampled, 2),
+            'sql_ms': round(stats['sql_time'] / sampled, 2),
+            'duplicates': [{'sql': sql, 'count': count}
+                           for sql, count in sorted(
+                               stats['duplicates'].items(),
+                               key=lambda item: -item[1])],
+        })
+    field = {'total': 'total_ms', 'p95': 'p95_ms', 'sql': 'sql_count'}[sort]
+    return sorted(rows, key=lambda row: -row[field])
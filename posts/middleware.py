@@ -0,0 +1,50 @@
+import random
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+
+from posts import metrics
+
+
+def view_name(request):
+    """Полное имя view, например posts.views.profile."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    func = getattr(match.func, 'view_class', match.func)
+    return f'{func.__module__}.{func.__qualname__}'
+
+
+class RequestMetricsMiddleware:
+    """Собирает метрики запросов в posts.metrics.
+
+    Ставится первым в MIDDLEWARE, чтобы время включало остальные
+    middleware. SQL и шаблоны измеряются только у выборки запросов.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        metrics.install()
+
+    def __call__(self, request):
+        if random.random() >= metrics.sample_rate():
+            start = time.perf_counter()
+            response = self.get_response(request)
+            metrics.recorder.record(view_name(request),
+                                    time.perf_counter() - start)
+            return response
+
+        probe = metrics.Probe()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(probe))
+            metrics.start(probe)
+            try:
+                response = self.get_response(request)
+            finally:
+                metrics.stop()
+        metrics.recorder.record(view_name(request),
+                                time.perf_counter() - start, probe)
+        return response
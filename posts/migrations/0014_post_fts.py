@@ -0,0 +1,38 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+
+def create_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute('CREATE VIRTUAL TABLE posts_post_fts USING '
+                           'fts5(text, group_title, group_description)')
+        except OperationalError:
+            # SQLite собран без FTS5, поиск будет по индексу в памяти
+            return
+        cursor.execute(
+            "INSERT INTO posts_post_fts "
+            "(rowid, text, group_title, group_description) "
+            "SELECT p.id, p.text, COALESCE(g.title, ''), "
+            "COALESCE(g.description, '') "
+            "FROM posts_post p LEFT JOIN posts_group g ON p.group_id = g.id")
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS posts_post_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0013_post_thumbnail'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
@@ -1,5 +1,8 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils.functional import cached_property
+
+from posts.cache import post_versions
 
 
 User = get_user_model()
@@ -17,6 +20,15 @@ class Group(models.Model):
 class Post(models.Model):
     class Meta:
         ordering = ['-pub_date']
+        # ленты выбираются по (pub_date, id), см. posts.paginator
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'],
+                         name='post_feed_idx'),
+            models.Index(fields=['group', '-pub_date', '-id'],
+                         name='post_group_feed_idx'),
+            models.Index(fields=['author', '-pub_date', '-id'],
+                         name='post_author_feed_idx'),
+        ]
 
     text = models.TextField()
     pub_date = models.DateTimeField("date published", auto_now_add=True)
@@ -29,12 +41,34 @@ class Post(models.Model):
                               blank=True,
                               null=True)
     image = models.ImageField(upload_to='posts/', blank=True, null=True)
+    # денормализованный счётчик, обновляется сигналами Comment
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    # готовая миниатюра для ленты, см. posts.thumbnails
+    thumbnail_url = models.CharField(max_length=255,
+                                     blank=True,
+                                     editable=False)
+    thumbnail_width = models.PositiveIntegerField(blank=True,
+                                                  null=True,
+                                                  editable=False)
+    thumbnail_height = models.PositiveIntegerField(blank=True,
+                                                   null=True,
+                                                   editable=False)
 
     def __str__(self):
         return self.text
 
+    @cached_property
+    def card_version(self):
+        # ленты проставляют версии всей странице сразу, см. posts.feeds
+        return post_versions([self])[0].card_version
+
 
 class Comment(models.Model):
+    class Meta:
+        # комментарии записи выводятся по (created, id), см. posts.comments
+        indexes = [models.Index(fields=['post', 'created', 'id'],
+                                name='comment_thread_idx')]
+
     post = models.ForeignKey(Post,
                              on_delete=models.CASCADE,
                              related_name="comments",
@@ -61,3 +95,65 @@ class Follow(models.Model):
 
     class Meta:
         unique_together = ['user', 'author']
+
+
+class UserStats(models.Model):
+    """Денормализованные счётчики пользователя для карточки профиля."""
+    user = models.OneToOneField(User,
+                                on_delete=models.CASCADE,
+                                primary_key=True,
+                                related_name="stats")
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    posts_count = models.PositiveIntegerField(default=0)
+
+
+class TimelineEntry(models.Model):
+    """Запись в ленте подписок пользователя (fan-out-on-write)."""
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             related_name="timeline")
+    post = models.ForeignKey(Post,
+                             on_delete=models.CASCADE,
+                             related_name="timeline_entries")
+    # копия Post.pub_date, чтобы обрезать ленту без JOIN
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ['user', 'post']
+        indexes = [models.Index(fields=['user', '-pub_date'])]
+
+
+class Job(models.Model):
+    """Отложенная задача, см. posts.tasks."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'ждёт'), (RUNNING, 'выполняется'),
+                (FAILED, 'не удалась')]
+
+    name = models.CharField(max_length=200)
+    # именованные аргументы задачи в JSON
+    payload = models.TextField(default='{}')
+    # из ждущих задач с одним ключом в очереди остаётся одна
+    dedup_key = models.CharField(max_length=200, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES,
+                              default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField()
+    # взявший задачу обработчик и срок, после которого её можно забрать
+    token = models.CharField(max_length=32, blank=True, db_index=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'],
+                                name='job_queue_idx')]
+        constraints = [models.UniqueConstraint(
+            fields=['dedup_key'], condition=models.Q(status='pending'),
+            name='job_pending_dedup')]
+
+    def __str__(self):
+        return f'{self.name} #{self.pk}'
@@ -0,0 +1,147 @@
+"""Постраничный вывод лент по ключу (pub_date, id).
+
+Django Paginator на каждый запрос делает COUNT(*) и выбирает страницу
+через OFFSET, который тем медленнее, чем дальше страница. Здесь
+Paginator остаётся прежним (шаблоны и контекст не меняются), но
+получает обёртку над queryset'ом: количество записей берётся из кэша,
+а страница, на которую пришли по ссылке "Следующая"/"Предыдущая",
+выбирается поиском по индексу от курсора соседней страницы.
+"""
+import datetime as dt
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+# сколько секунд хранить посчитанное количество записей ленты
+COUNT_TIMEOUT = 60 * 5
+# и сами страницы, если ключ страницы включает версию данных
+PAGE_TIMEOUT = 60 * 60
+
+
+def encode_key(moment, pk):
+    """Курсор по паре (дата, id): микросекунды и id через точку."""
+    delta = moment - EPOCH
+    micro = (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+    return f'{micro}.{pk}'
+
+
+def encode_cursor(post):
+    """Курсор записи по pub_date и id."""
+    return encode_key(post.pub_date, post.pk)
+
+
+def decode_cursor(value):
+    """Разбирает курсор, для испорченного значения возвращает None."""
+    try:
+        micro, pk = value.split('.')
+        return EPOCH + dt.timedelta(microseconds=int(micro)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def count_key(*parts):
+    return ':'.join(['feed_count'] + [str(part) for part in parts])
+
+
+class KeysetList:
+    """Список записей ленты для django Paginator.
+
+    Paginator вызывает только count() и срез [bottom:top], поэтому
+    их достаточно, чтобы подменить COUNT(*) на кэш, а OFFSET на поиск
+    по курсору.
+    """
+
+    ordered = True
+
+    def __init__(self, queryset, per_page, key=None,
+                 cursor_start=None, after=None, before=None,
+                 count_queryset=None, page_key=None):
+        self.queryset = queryset.order_by('-pub_date', '-pk')
+        if count_queryset is None:
+            count_queryset = queryset
+        self.count_queryset = count_queryset
+        self.per_page = per_page
+        self.key = key
+        self.cursor_start = cursor_start
+        self.after = after
+        self.before = before
+        self.page_key = page_key
+
+    def count(self):
+        if self.key is None:
+            return self.count_queryset.count()
+        return cache.get_or_set(self.key, self.count_queryset.count,
+                                COUNT_TIMEOUT)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.queryset[index]
+
+        start = index.start or 0
+        if self.page_key is None:
+            return self._fetch(start)
+        cursors = [encode_key(*cursor) if cursor else ''
+                   for cursor in (self.after, self.before)]
+        key = ':'.join([self.page_key, str(start)] + cursors)
+        return cache.get_or_set(key, lambda: self._fetch(start),
+                                PAGE_TIMEOUT)
+
+    def _fetch(self, start):
+        # курсор годится только для той страницы, на которую он выдан;
+        # переход по номеру страницы по-прежнему идёт через OFFSET
+        if start and start == self.cursor_start:
+            if self.after is not None:
+                pub_date, pk = self.after
+                seek = (Q(pub_date__lt=pub_date)
+                        | Q(pub_date=pub_date, pk__lt=pk))
+                return list(self.queryset.filter(seek)[:self.per_page])
+            if self.before is not None:
+                pub_date, pk = self.before
+                seek = (Q(pub_date__gt=pub_date)
+                        | Q(pub_date=pub_date, pk__gt=pk))
+                posts = self.queryset.filter(seek).reverse()
+                return list(posts[:self.per_page])[::-1]
+        # верхнюю границу не берём из Paginator: при устаревшем
+        # количестве в кэше она могла бы обрезать страницу
+        return list(self.queryset[start:start + self.per_page])
+
+
+def paginate(request, queryset, per_page, key=None, count_queryset=None,
+             page_key=None):
+    """Возвращает (paginator, page) для ленты записей.
+
+    count_queryset нужен, когда queryset ленты с аннотациями и считать
+    по нему COUNT(*) дороже, чем по исходному. С page_key записи
+    страницы кэшируются, ключ должен меняться вместе с данными
+    (см. posts.cache.data_version). В page добавляются
+    next_cursor и previous_cursor, которые paginator.html подставляет
+    в ссылки на соседние страницы.
+    """
+    number = request.GET.get('page')
+    try:
+        cursor_start = (int(number) - 1) * per_page
+    except (TypeError, ValueError):
+        cursor_start = None
+
+    object_list = KeysetList(queryset, per_page, key=key,
+                             cursor_start=cursor_start,
+                             after=decode_cursor(request.GET.get('after')),
+                             before=decode_cursor(request.GET.get('before')),
+                             count_queryset=count_queryset,
+                             page_key=page_key)
+    paginator = Paginator(object_list, per_page)
+    page = paginator.get_page(number)
+
+    page.next_cursor = page.previous_cursor = None
+    if page.object_list:
+        if page.has_next():
+            page.next_cursor = encode_cursor(page.object_list[-1])
+        if page.has_previous():
+            page.previous_cursor = encode_cursor(page.object_list[0])
+    return paginator, page
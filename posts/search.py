@@ -0,0 +1,234 @@
+"""Полнотекстовый поиск по записям.
+
+Индексируются текст записи и название с описанием её группы. На
+SQLite используется виртуальная таблица FTS5 posts_post_fts (её
+создаёт миграция 0014_post_fts), для остальных баз и для SQLite без
+FTS5 — инвертированный индекс в памяти процесса. Оба индекса
+обновляются сигналами Post и Group (см. posts.signals); сигналы
+приходят только в процесс, изменивший запись, поэтому индексы в
+памяти других процессов узнают об изменении по версии индекса в кэше
+и перестраиваются при следующем поиске.
+
+Результаты упорядочены по релевантности, следующая страница
+выбирается по курсору (ранг, id), а не через OFFSET.
+"""
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+from django.db import connection
+
+from posts.cache import bump_version, data_version
+from posts.models import Post
+
+FTS_TABLE = 'posts_post_fts'
+INDEX_VERSION_KEY = 'posts:search_index_version'
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def encode_cursor(rank, pk):
+    return f'{rank!r}_{pk}'
+
+
+def decode_cursor(value):
+    try:
+        rank, pk = value.split('_')
+        return float(rank), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _document(post):
+    group = post.group
+    return (post.text,
+            group.title if group else '',
+            group.description if group else '')
+
+
+class FtsBackend:
+    """Индекс FTS5; меньший bm25 означает более релевантную запись."""
+
+    def match(self, query):
+        # каждое слово в кавычках: пользовательский ввод не должен
+        # разбираться как синтаксис запросов FTS5
+        return ' '.join(f'"{token}"' for token in tokenize(query))
+
+    def search(self, query, limit, after=None):
+        match = self.match(query)
+        if not match:
+            return []
+        sql = (f'SELECT id, rank FROM ('
+               f'SELECT rowid AS id, bm25({FTS_TABLE}) AS rank '
+               f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s)')
+        params = [match]
+        if after is not None:
+            sql += ' WHERE rank > %s OR (rank = %s AND id > %s)'
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY rank, id LIMIT %s'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [limit])
+            return [(rank, pk) for pk, rank in cursor.fetchall()]
+
+    def filter(self, queryset, query):
+        match = self.match(query)
+        if not match:
+            return queryset.none()
+        return queryset.extra(
+            where=[f'posts_post.id IN (SELECT rowid FROM {FTS_TABLE} '
+                   f'WHERE {FTS_TABLE} MATCH %s)'],
+            params=[match])
+
+    def index(self, posts):
+        rows = [(post.pk,) + _document(post) for post in posts]
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s',
+                               [row[:1] for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE} '
+                f'(rowid, text, group_title, group_description) '
+                f'VALUES (%s, %s, %s, %s)', rows)
+
+    def remove(self, post_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s',
+                           [post_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} '
+                f'(rowid, text, group_title, group_description) '
+                f'SELECT p.id, p.text, '
+                f'COALESCE(g.title, \'\'), COALESCE(g.description, \'\') '
+                f'FROM posts_post p LEFT JOIN posts_group g '
+                f'ON p.group_id = g.id')
+
+
+class InvertedIndexBackend:
+    """Инвертированный индекс в памяти процесса, ранжирование TF-IDF.
+
+    Строится из базы при первом поиске, дальше обновляется сигналами.
+    Каждое изменение увеличивает версию индекса в кэше; если версия
+    изменилась не в этом процессе, индекс строится заново. Для этого
+    кэш должен быть общим для процессов: с LocMemCache каждый процесс
+    видит только свои изменения.
+    Ранг хранится со знаком минус, чтобы порядок совпадал с bm25.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = None
+        self.documents = {}
+        self.version = None
+
+    def _ensure_built(self):
+        # версию читаем до чтения базы: изменения, сделанные во время
+        # построения, вызовут ещё одно построение
+        version = data_version(INDEX_VERSION_KEY)
+        if self.postings is None or version != self.version:
+            self.postings = defaultdict(dict)
+            self.documents = {}
+            posts = Post.objects.select_related('group').order_by()
+            self._add(posts.iterator())
+            self.version = version
+
+    def _changed(self):
+        """Увеличивает версию; True, если индекс был актуален до этого."""
+        version = bump_version(INDEX_VERSION_KEY)
+        current = (self.postings is not None
+                   and self.version is not None
+                   and version == self.version + 1)
+        if current:
+            self.version = version
+        return current
+
+    def _add(self, posts):
+        for post in posts:
+            self._discard(post.pk)
+            terms = Counter(tokenize(' '.join(_document(post))))
+            for term, count in terms.items():
+                self.postings[term][post.pk] = count
+            self.documents[post.pk] = list(terms)
+
+    def _discard(self, post_id):
+        for term in self.documents.pop(post_id, ()):
+            self.postings[term].pop(post_id, None)
+
+    def _scores(self, query):
+        self._ensure_built()
+        tokens = tokenize(query)
+        if not tokens:
+            return {}
+        total = max(len(self.documents), 1)
+        scores = None
+        for token in set(tokens):
+            posting = self.postings.get(token, {})
+            idf = math.log(1 + total / (1 + len(posting)))
+            matched = {pk: tf * idf for pk, tf in posting.items()}
+            if scores is None:
+                scores = matched
+            else:
+                scores = {pk: scores[pk] + score
+                          for pk, score in matched.items() if pk in scores}
+        return scores
+
+    def search(self, query, limit, after=None):
+        with self.lock:
+            scores = self._scores(query)
+        ranked = sorted((-score, pk) for pk, score in scores.items())
+        if after is not None:
+            ranked = [item for item in ranked if item > tuple(after)]
+        return ranked[:limit]
+
+    def filter(self, queryset, query):
+        with self.lock:
+            return queryset.filter(pk__in=list(self._scores(query)))
+
+    def index(self, posts):
+        with self.lock:
+            if self._changed():
+                self._add(posts)
+
+    def remove(self, post_id):
+        with self.lock:
+            if self._changed():
+                self._discard(post_id)
+
+    def rebuild(self):
+        with self.lock:
+            bump_version(INDEX_VERSION_KEY)
+            self.postings = None
+            self._ensure_built()
+
+
+def fts_available():
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master "
+                       "WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    return FtsBackend() if fts_available() else InvertedIndexBackend()
+
+
+def search(query, limit, after=None):
+    """Возвращает (записи, курсор следующей страницы или None)."""
+    ranked = get_backend().search(query, limit + 1, after)
+    has_next = len(ranked) > limit
+    ranked = ranked[:limit]
+    posts = Post.objects.select_related('author', 'group').in_bulk(
+        [pk for _, pk in ranked])
+    found = [posts[pk] for _, pk in ranked if pk in posts]
+    cursor = encode_cursor(*ranked[-1]) if has_next else None
+    return found, cursor
@@ -0,0 +1,181 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.backends.signals import connection_created
+from django.db import transaction
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
+from django.dispatch import receiver
+
+from posts import db, events, follows, search, stats, tasks, timeline
+from posts.cache import bump_posts, bump_version
+from posts.models import Comment, Follow, Group, Post, UserStats
+from posts.paginator import count_key
+
+User = get_user_model()
+
+
+@receiver(pre_save, sender=Post)
+def remember_previous_group(sender, instance, update_fields=None,
+                            **kwargs):
+    # форма правки меняет group_id у записи до сохранения, а счётчик
+    # прежней группы тоже нужно сбросить
+    instance.previous_group_id = None
+    if instance._state.adding or (update_fields is not None
+                                  and 'group' not in update_fields):
+        return
+    instance.previous_group_id = (Post.objects.filter(pk=instance.pk)
+                                  .values_list('group_id', flat=True)
+                                  .first())
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def reset_post_counts(sender, instance, **kwargs):
+    """Сбрасывает закэшированное количество записей в лентах поста."""
+    if kwargs.get('created') is False:
+        # правка поста меняет количество только если сменилась группа
+        groups = {instance.group_id,
+                  getattr(instance, 'previous_group_id', None)}
+        cache.delete_many([count_key('group', group_id)
+                           for group_id in groups if group_id is not None])
+        return
+
+    keys = [count_key('index'), count_key('author', instance.author_id)]
+    if instance.group_id is not None:
+        keys.append(count_key('group', instance.group_id))
+    followers = Follow.objects.filter(author_id=instance.author_id)
+    for user_id in followers.values_list('user_id', flat=True):
+        keys.append(count_key('follow', user_id))
+    cache.delete_many(keys)
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def reset_follow_counts(sender, instance, **kwargs):
+    follows.forget(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def create_user_stats(sender, instance, created, **kwargs):
+    if created:
+        UserStats.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def count_posts(sender, instance, **kwargs):
+    created = kwargs.get('created')
+    if created is False:
+        return
+    delta = 1 if created else -1
+    stats.bump_user(instance.author_id, create=created, posts_count=delta)
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def count_follows(sender, instance, **kwargs):
+    created = kwargs.get('created')
+    if created is False:
+        return
+    delta = 1 if created else -1
+    stats.bump_user(instance.author_id, create=created,
+                    followers_count=delta)
+    stats.bump_user(instance.user_id, create=created,
+                    following_count=delta)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def count_comments(sender, instance, **kwargs):
+    created = kwargs.get('created')
+    if created is False:
+        return
+    stats.bump_comments(instance.post_id, 1 if created else -1)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def update_timelines(sender, instance, **kwargs):
+    created = kwargs.get('created')
+    if created:
+        tasks.enqueue(timeline.fan_out_post,
+                      dedup_key=f'timeline:{instance.pk}',
+                      post_id=instance.pk)
+    elif created is None:
+        timeline.get_store().discard(instance)
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def update_follower_timeline(sender, instance, **kwargs):
+    created = kwargs.get('created')
+    if created:
+        timeline.follow(instance.user_id, instance.author_id)
+    elif created is None:
+        timeline.unfollow(instance.user_id, instance.author_id)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def bump_data_version(sender, **kwargs):
+    bump_version()
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def bump_post_card(sender, instance, **kwargs):
+    bump_posts([instance.pk])
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def bump_commented_card(sender, instance, **kwargs):
+    bump_posts([instance.post_id])
+
+
+@receiver(post_save, sender=Post)
+def publish_new_post(sender, instance, created, **kwargs):
+    # без открытых потоков событий в этом процессе раздавать некому
+    if created and len(events.broker):
+        post_id = instance.pk
+        # подписчики увидят запись, только когда она появится в базе
+        transaction.on_commit(lambda: events.publish_post(post_id))
+
+
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, **kwargs):
+    search.get_backend().index([instance])
+
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    search.get_backend().remove(instance.pk)
+
+
+@receiver(pre_delete, sender=Group)
+def remember_group_posts(sender, instance, **kwargs):
+    # после удаления группы у её записей уже будет group=NULL
+    instance.post_ids = list(instance.posts_by_group.values_list('pk',
+                                                                 flat=True))
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def reindex_group_posts(sender, instance, **kwargs):
+    if kwargs.get('created'):
+        return
+    post_ids = getattr(instance, 'post_ids', None)
+    posts = (Post.objects.filter(pk__in=post_ids) if post_ids is not None
+             else Post.objects.filter(group=instance))
+    search.get_backend().index(posts.select_related('group').iterator())
+    # название и адрес группы выводятся в карточках её записей
+    bump_posts(posts.values_list('pk', flat=True))
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    db.apply_pragmas(connection)
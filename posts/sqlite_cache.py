@@ -0,0 +1,336 @@
+"""Кэш Django в файле SQLite, общий для всех процессов на машине.
+
+LocMemCache у каждого процесса свой: страницы лент и карточки записей
+хранятся в памяти столько раз, сколько запущено процессов, а версия
+данных (posts.cache) в каждом процессе своя, поэтому сброс кэша в
+одном процессе не виден остальным. SQLiteCache хранит всё в одном
+файле в режиме WAL: чтения не ждут записей, а запись из любого
+процесса сразу видна остальным.
+
+Размер ограничен числом записей (MAX_ENTRIES) и суммарным объёмом
+ключей и значений (MAX_BYTES). Оба числа поддерживают триггеры в
+строке cache_meta, так что проверка лимита — одно чтение. При
+превышении сначала удаляются просроченные записи, затем давно не
+читанные (LRU), пока не останется 90% лимита. Время чтения
+обновляется не чаще раза в ACCESS_RESOLUTION секунд, чтобы частые
+чтения одной записи не превращались в записи в файл.
+
+Попадания, промахи и вытеснения считаются в процессе и раз в
+STATS_FLUSH_INTERVAL секунд добавляются к общим счётчикам в
+cache_meta; stats() возвращает сумму по всем процессам.
+
+    CACHES = {'default': {
+        'BACKEND': 'posts.sqlite_cache.SQLiteCache',
+        'LOCATION': '/var/cache/yatube/cache.sqlite3',
+        'OPTIONS': {'MAX_ENTRIES': 200000, 'MAX_BYTES': 256 * 2 ** 20},
+    }}
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# запросов с IN (...) не длиннее лимита переменных SQLite
+CHUNK = 500
+# до какой доли лимитов вытеснять записи
+LOW_WATER = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entry (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_entry_accessed ON cache_entry (accessed);
+CREATE TABLE IF NOT EXISTS cache_meta (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    entries INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0,
+    evictions INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO cache_meta (id) VALUES (1);
+CREATE TRIGGER IF NOT EXISTS cache_entry_insert AFTER INSERT ON cache_entry
+BEGIN
+    UPDATE cache_meta SET entries = entries + 1, bytes = bytes + NEW.size
+    WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entry_delete AFTER DELETE ON cache_entry
+BEGIN
+    UPDATE cache_meta SET entries = entries - 1, bytes = bytes - OLD.size
+    WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entry_resize
+AFTER UPDATE OF size ON cache_entry
+BEGIN
+    UPDATE cache_meta SET bytes = bytes - OLD.size + NEW.size WHERE id = 1;
+END;
+"""
+
+UPSERT = """
+INSERT INTO cache_entry (key, value, size, expires, accessed)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET value = excluded.value,
+                                size = excluded.size,
+                                expires = excluded.expires,
+                                accessed = excluded.accessed
+"""
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK):
+        yield items[start:start + CHUNK]
+
+
+def _alive(expires, now):
+    return expires is None or expires > now
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.path = location
+        self._max_entries = int(options.get('MAX_ENTRIES', 100000))
+        self.max_bytes = int(options.get('MAX_BYTES', 128 * 2 ** 20))
+        self.access_resolution = options.get('ACCESS_RESOLUTION', 1.0)
+        self.stats_interval = options.get('STATS_FLUSH_INTERVAL', 10)
+        # сколько секунд ждать, пока другой процесс закончит запись
+        self.busy_timeout = options.get('BUSY_TIMEOUT', 20)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._flushed = time.monotonic()
+
+    def _connection(self):
+        # соединение своё у каждого потока и у каждого процесса: после
+        # fork унаследованным соединением пользоваться нельзя
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path,
+                                         timeout=self.busy_timeout,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode = wal')
+            connection.execute('PRAGMA synchronous = normal')
+            connection.executescript(f'BEGIN IMMEDIATE;{SCHEMA}COMMIT;')
+            self._local.connection = connection
+            self._local.pid = pid
+        return self._local.connection
+
+    @contextmanager
+    def _transaction(self, connection):
+        # IMMEDIATE сразу берёт блокировку записи: чтение и запись
+        # внутри блока не перемежаются с другими процессами
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+            due = time.monotonic() - self._flushed >= self.stats_interval
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Добавляет счётчики процесса к общим."""
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._flushed = time.monotonic()
+        if counts:
+            self._connection().execute(
+                'UPDATE cache_meta SET hits = hits + ?, '
+                'misses = misses + ?, evictions = evictions + ? '
+                'WHERE id = 1',
+                (counts['hits'], counts['misses'], counts['evictions']))
+
+    def stats(self):
+        """Размер кэша и счётчики всех процессов."""
+        self.flush_stats()
+        row = self._connection().execute(
+            'SELECT entries, bytes, hits, misses, evictions '
+            'FROM cache_meta WHERE id = 1').fetchone()
+        stats = dict(zip(('entries', 'bytes', 'hits', 'misses',
+                          'evictions'), row))
+        reads = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / reads, 4) if reads else None
+        return stats
+
+    def _expires(self, timeout):
+        expires = self.get_backend_timeout(timeout)
+        return None if expires is None else float(expires)
+
+    def _write(self, connection, key, value, timeout, now):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        connection.execute(UPSERT, (key, data, len(key) + len(data),
+                                    self._expires(timeout), now))
+
+    def _over_limit(self, connection, share=1.0):
+        entries, size = connection.execute(
+            'SELECT entries, bytes FROM cache_meta WHERE id = 1').fetchone()
+        return (entries > self._max_entries * share
+                or size > self.max_bytes * share)
+
+    def _cull(self, connection):
+        if not self._over_limit(connection):
+            return
+        evicted = 0
+        with self._transaction(connection):
+            connection.execute('DELETE FROM cache_entry WHERE expires <= ?',
+                               (time.time(),))
+            while self._over_limit(connection, LOW_WATER):
+                evicted += connection.execute(
+                    'DELETE FROM cache_entry WHERE key IN ('
+                    'SELECT key FROM cache_entry ORDER BY accessed LIMIT ?)',
+                    (max(self._max_entries // 100, 1),)).rowcount
+        if evicted:
+            self._count('evictions', evicted)
+
+    def _touch_read(self, connection, keys, now):
+        if keys:
+            connection.execute(
+                'UPDATE cache_entry SET accessed = ? WHERE key IN (%s)'
+                % ','.join('?' * len(keys)), [now] + keys)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT value, expires, accessed FROM cache_entry WHERE key = ?',
+            (key,)).fetchone()
+        now = time.time()
+        if row is None or not _alive(row[1], now):
+            self._count('misses')
+            return default
+        if now - row[2] > self.access_resolution:
+            self._touch_read(connection, [key], now)
+        self._count('hits')
+        return pickle.loads(row[0])
+
+    def get_many(self, keys, version=None):
+        names = {}
+        for key in keys:
+            name = self.make_key(key, version=version)
+            self.validate_key(name)
+            names[name] = key
+        connection = self._connection()
+        now = time.time()
+        found, stale = {}, []
+        for chunk in _chunks(names):
+            rows = connection.execute(
+                'SELECT key, value, expires, accessed FROM cache_entry '
+                'WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            for name, value, expires, accessed in rows:
+                if _alive(expires, now):
+                    found[names[name]] = pickle.loads(value)
+                    if now - accessed > self.access_resolution:
+                        stale.append(name)
+        for chunk in _chunks(stale):
+            self._touch_read(connection, chunk, now)
+        self._count('hits', len(found))
+        self._count('misses', len(names) - len(found))
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        connection = self._connection()
+        self._write(connection, key, value, timeout, time.time())
+        self._cull(connection)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        connection = self._connection()
+        now = time.time()
+        with self._transaction(connection):
+            for key, value in data.items():
+                key = self.make_key(key, version=version)
+                self.validate_key(key)
+                self._write(connection, key, value, timeout, now)
+        self._cull(connection)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        connection = self._connection()
+        now = time.time()
+        with self._transaction(connection):
+            row = connection.execute(
+                'SELECT expires FROM cache_entry WHERE key = ?',
+                (key,)).fetchone()
+            if row is not None and _alive(row[0], now):
+                return False
+            self._write(connection, key, value, timeout, now)
+        self._cull(connection)
+        return True
+
+    def incr(self, key, delta=1, version=None):
+        name = self.make_key(key, version=version)
+        self.validate_key(name)
+        connection = self._connection()
+        with self._transaction(connection):
+            row = connection.execute(
+                'SELECT value, expires FROM cache_entry WHERE key = ?',
+                (name,)).fetchone()
+            if row is None or not _alive(row[1], time.time()):
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            connection.execute(
+                'UPDATE cache_entry SET value = ?, size = ? WHERE key = ?',
+                (data, len(name) + len(data), name))
+        return value
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        now = time.time()
+        return bool(self._connection().execute(
+            'UPDATE cache_entry SET expires = ? WHERE key = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (self._expires(timeout), key, now)).rowcount)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._connection().execute(
+            'SELECT 1 FROM cache_entry WHERE key = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (key, time.time())).fetchone() is not None
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self._connection().execute(
+            'DELETE FROM cache_entry WHERE key = ?', (key,)).rowcount)
+
+    def delete_many(self, keys, version=None):
+        names = []
+        for key in keys:
+            name = self.make_key(key, version=version)
+            self.validate_key(name)
+            names.append(name)
+        connection = self._connection()
+        with self._transaction(connection):
+            for chunk in _chunks(names):
+                connection.execute(
+                    'DELETE FROM cache_entry WHERE key IN (%s)'
+                    % ','.join('?' * len(chunk)), chunk)
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache_entry')
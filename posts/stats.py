@@ -0,0 +1,118 @@
+"""Денормализованные счётчики подписок, записей и комментариев.
+
+Счётчики меняются F()-выражениями из сигналов (см. posts.signals),
+поэтому одновременные подписки и комментарии не теряют обновления.
+Если счётчики всё же разошлись с данными, их пересчитывает команда
+``python manage.py rebuild_stats``.
+"""
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from posts.models import Comment, Follow, Post, UserStats
+
+User = get_user_model()
+
+
+def _count(queryset, field):
+    """Подзапрос количества строк queryset на каждое значение field."""
+    counted = (queryset
+               .filter(**{field: OuterRef('pk')})
+               .order_by()
+               .values(field)
+               .annotate(total=Count('pk'))
+               .values('total'))
+    return Coalesce(Subquery(counted, output_field=IntegerField()), 0)
+
+
+def user_counts(users):
+    """Актуальные счётчики для queryset пользователей."""
+    return users.annotate(
+        followers_total=_count(Follow.objects, 'author'),
+        following_total=_count(Follow.objects, 'user'),
+        posts_total=_count(Post.objects, 'author'),
+    ).values_list('pk', 'followers_total', 'following_total', 'posts_total')
+
+
+def _stats_rows(users):
+    return [UserStats(user_id=pk,
+                      followers_count=followers,
+                      following_count=following,
+                      posts_count=posts)
+            for pk, followers, following, posts in user_counts(users)]
+
+
+def stats_for(user):
+    """Счётчики пользователя; при отсутствии строки она создаётся."""
+    try:
+        return user.stats
+    except UserStats.DoesNotExist:
+        stats = _stats_rows(User.objects.filter(pk=user.pk))[0]
+        UserStats.objects.bulk_create([stats], ignore_conflicts=True)
+        return stats
+
+
+def bump_user(user_id, create=False, **deltas):
+    """Сдвигает счётчики пользователя на deltas.
+
+    Строку создаём только при росте счётчиков (create=True): при
+    удалении пользователя каскадом удаляются и его подписки, и
+    создавать для него статистику в этот момент нельзя.
+    """
+    updates = {field: F(field) + delta for field, delta in deltas.items()}
+    updated = UserStats.objects.filter(user_id=user_id).update(**updates)
+    if not updated and create:
+        # строка пересчитывается уже с учётом текущего изменения
+        UserStats.objects.bulk_create(
+            _stats_rows(User.objects.filter(pk=user_id)),
+            ignore_conflicts=True)
+
+
+def bump_many(user_ids, create=False, **deltas):
+    """Как bump_user, но для многих пользователей одним UPDATE."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    updates = {field: F(field) + delta for field, delta in deltas.items()}
+    UserStats.objects.filter(user_id__in=user_ids).update(**updates)
+    if create:
+        existing = UserStats.objects.filter(user_id__in=user_ids)
+        missing = set(user_ids) - set(existing.values_list('user_id',
+                                                           flat=True))
+        if missing:
+            UserStats.objects.bulk_create(
+                _stats_rows(User.objects.filter(pk__in=missing)),
+                ignore_conflicts=True)
+
+
+def bump_comments(post_id, delta):
+    Post.objects.filter(pk=post_id).update(
+        comment_count=F('comment_count') + delta)
+
+
+def rebuild(batch_size=500):
+    """Пересчитывает все счётчики с нуля, возвращает число строк."""
+    Post.objects.update(comment_count=_count(Comment.objects, 'post'))
+
+    total = 0
+    last_pk = 0
+    while True:
+        pks = list(User.objects
+                   .filter(pk__gt=last_pk)
+                   .order_by('pk')
+                   .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return total
+        last_pk = pks[-1]
+        total += len(pks)
+
+        rows = _stats_rows(User.objects.filter(pk__in=pks))
+        existing = set(UserStats.objects
+                       .filter(user_id__in=pks)
+                       .values_list('user_id', flat=True))
+        UserStats.objects.bulk_update(
+            [row for row in rows if row.user_id in existing],
+            ['followers_count', 'following_count', 'posts_count'])
+        UserStats.objects.bulk_create(
+            [row for row in rows if row.user_id not in existing],
+            ignore_conflicts=True)
@@ -0,0 +1,243 @@
+"""Синтетические данные для замеров производительности.
+
+Слова берутся из словаря с распределением Ципфа: несколько слов
+встречаются почти в каждой записи, большинство — редко, как в
+настоящих текстах. Так же перекошены и остальные данные: немногие
+авторы пишут большую часть записей и собирают большую часть подписок,
+а комментарии достаются в основном популярным записям.
+
+Строки создаются bulk_create, то есть без сигналов: после генерации
+счётчики, поисковый индекс и ленты подписок нужно пересчитать, это
+делает populate().
+
+Команды замеров наполняют не настроенную базу, а временную
+(scratch_database): синтетические пользователи и записи не должны
+попасть на настоящий сайт. Войти под синтетическим пользователем
+нельзя, у него нет пароля.
+"""
+import itertools
+import os
+import random
+import tempfile
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test.utils import override_settings
+
+from posts import search, stats, timeline
+from posts.cache import bump_version
+from posts.models import Comment, Follow, Group, Post
+
+User = get_user_model()
+
+SYLLABLES = ['то', 'ло', 'ми', 'ра', 'ка', 'не', 'за', 'ву', 'лей', 'сон',
+             'дар', 'пе', 'ки', 'ню', 'шо', 'гра', 'сти', 'бе', 'мо', 'ты']
+
+
+@contextmanager
+def scratch_database():
+    """Временная база со всеми миграциями и пустой кэш вместо настроенных.
+
+    Зеркала основной базы (TEST MIRROR, например реплика) на время
+    блока смотрят во временную базу, как при прогоне тестов.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        if connection.vendor == 'sqlite':
+            # файл, а не база в памяти: миллион записей велик для неё
+            connection.settings_dict['TEST'] = dict(
+                connection.settings_dict.get('TEST') or {},
+                NAME=os.path.join(directory, 'scratch.sqlite3'))
+        # create_test_db возвращает имя новой базы, а не прежней
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        mirrors = {}
+        for alias in connections:
+            test = connections[alias].settings_dict.get('TEST') or {}
+            if test.get('MIRROR') == DEFAULT_DB_ALIAS:
+                mirrors[alias] = connections[alias].settings_dict['NAME']
+                connections[alias].close()
+                connections[alias].creation.set_as_test_mirror(
+                    connection.settings_dict)
+        # выбор поискового индекса зависит от базы
+        search.get_backend.cache_clear()
+        try:
+            # карточки и ленты временной базы не должны попасть в кэш
+            # настоящего сайта
+            with override_settings(CACHES={'default': {
+                    'BACKEND': 'django.core.cache.backends.locmem.'
+                               'LocMemCache',
+                    'LOCATION': 'scratch'}}):
+                yield
+        finally:
+            for alias, name in mirrors.items():
+                connections[alias].close()
+                connections[alias].settings_dict['NAME'] = name
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            search.get_backend.cache_clear()
+
+
+def vocabulary(size=5000):
+    """Детерминированный словарь из size слов по 2-3 слога."""
+    words = []
+    for length in (2, 3):
+        for parts in itertools.product(SYLLABLES, repeat=length):
+            words.append(''.join(parts))
+            if len(words) == size:
+                return words
+    return words
+
+
+def zipf_weights(count, exponent=1.0):
+    """Накопленные веса для random.choices: первый элемент самый частый."""
+    return list(itertools.accumulate(
+        1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+class TextGenerator:
+    def __init__(self, seed=0, size=5000):
+        self.rng = random.Random(seed)
+        self.words = vocabulary(size)
+        # вес слова обратно пропорционален его рангу (закон Ципфа)
+        self.weights = zipf_weights(len(self.words))
+
+    def text(self, min_words=5, max_words=40):
+        count = self.rng.randint(min_words, max_words)
+        return ' '.join(self.rng.choices(self.words,
+                                         cum_weights=self.weights,
+                                         k=count))
+
+
+def create_posts(count, authors, groups=(), seed=0, batch_size=5000,
+                 progress=None):
+    """Создаёт count записей пачками по batch_size.
+
+    Авторы в начале списка пишут чаще остальных.
+    """
+    generator = TextGenerator(seed)
+    rng = random.Random(seed)
+    weights = zipf_weights(len(authors))
+    groups = list(groups) + [None]
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        Post.objects.bulk_create([
+            Post(text=generator.text(),
+                 author=rng.choices(authors, cum_weights=weights)[0],
+                 group=rng.choice(groups))
+            for _ in range(size)
+        ])
+        created += size
+        if progress is not None:
+            progress(created)
+    return created
+
+
+def create_users(count, prefix='bench'):
+    """Создаёт пользователей prefix_0, prefix_1, ... без пароля."""
+    existing = User.objects.filter(username__startswith=f'{prefix}_').count()
+    User.objects.bulk_create([
+        User(username=f'{prefix}_{number}', password=make_password(None),
+             email=f'{prefix}_{number}@example.com')
+        for number in range(existing, count)
+    ])
+    return list(User.objects
+                .filter(username__startswith=f'{prefix}_')
+                .order_by('pk'))
+
+
+def create_groups(count, prefix='bench', seed=0):
+    generator = TextGenerator(seed)
+    existing = Group.objects.filter(slug__startswith=f'{prefix}-').count()
+    Group.objects.bulk_create([
+        Group(title=f'{prefix} {number}', slug=f'{prefix}-{number}',
+              description=generator.text())
+        for number in range(existing, count)
+    ])
+    return list(Group.objects
+                .filter(slug__startswith=f'{prefix}-')
+                .order_by('pk'))
+
+
+def create_comments(count, posts, authors, seed=0, batch_size=5000,
+                    progress=None):
+    """Создаёт count комментариев, больше всего — к первым записям."""
+    generator = TextGenerator(seed)
+    rng = random.Random(seed)
+    weights = zipf_weights(len(posts))
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        Comment.objects.bulk_create([
+            Comment(text=generator.text(max_words=15),
+                    post=rng.choices(posts, cum_weights=weights)[0],
+                    author=rng.choice(authors))
+            for _ in range(size)
+        ])
+        created += size
+        if progress is not None:
+            progress(created)
+    return created
+
+
+def create_follows(count, users, seed=0):
+    """Создаёт до count подписок, больше всего — на первых пользователей.
+
+    Повторные пары и подписки на себя пропускаются, поэтому подписок
+    может получиться меньше count.
+    """
+    rng = random.Random(seed)
+    weights = zipf_weights(len(users))
+    pairs = set()
+    for _ in range(count):
+        user = rng.choice(users)
+        author = rng.choices(users, cum_weights=weights)[0]
+        if user.pk != author.pk:
+            pairs.add((user.pk, author.pk))
+    Follow.objects.bulk_create(
+        [Follow(user_id=user_id, author_id=author_id)
+         for user_id, author_id in sorted(pairs)],
+        ignore_conflicts=True)
+    return sorted(pairs)
+
+
+def populate(users, groups, posts, comments, follows, prefix='bench',
+             seed=0, progress=None):
+    """Заполняет базу связанными данными и пересчитывает производные.
+
+    Записи и комментарии добавляются к уже созданным ранее, поэтому
+    повторный вызов продолжает наполнение, а не начинает заново.
+    """
+    def report(stage):
+        if progress is not None:
+            progress(stage)
+
+    authors = create_users(users, prefix)
+    report(f'пользователей: {len(authors)}')
+    bench_groups = create_groups(groups, prefix, seed)
+    report(f'групп: {len(bench_groups)}')
+
+    own_posts = Post.objects.filter(author__in=authors)
+    create_posts(max(posts - own_posts.count(), 0), authors, bench_groups,
+                 seed=seed)
+    report(f'записей: {own_posts.count()}')
+
+    # комментируют в основном свежие записи
+    post_list = list(own_posts.order_by('-pub_date', '-pk')[:10000])
+    own_comments = Comment.objects.filter(post__author__in=authors)
+    if post_list:
+        create_comments(max(comments - own_comments.count(), 0),
+                        post_list, authors, seed=seed)
+    report(f'комментариев: {own_comments.count()}')
+
+    pairs = create_follows(follows, authors, seed=seed)
+    for user_id, author_id in pairs:
+        timeline.follow(user_id, author_id)
+    report(f'подписок: {len(pairs)}')
+
+    stats.rebuild()
+    search.get_backend().rebuild()
+    bump_version()
+    report('счётчики и поисковый индекс пересчитаны')
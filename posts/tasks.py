@@ -0,0 +1,237 @@
+"""Очередь задач в базе для побочных действий после записи.
+
+Запрос, сохранивший запись, только кладёт задачу в таблицу Job. Если
+запись и enqueue выполняются в одном transaction.atomic() (так делают
+new_post и post_edit), задача фиксируется вместе с записью: она не
+теряется при падении процесса между ними и не выполняется для
+отменённой записи. Без общей транзакции задачу, поставленную после
+сохранения, падение может потерять. Выполняет задачи команда run_tasks
+в пуле потоков или процессов; ни Redis, ни RabbitMQ не нужны.
+
+Задача — функция с декоратором @task и именованными аргументами,
+которые переживают JSON. Обработчик забирает задачу одним UPDATE (см.
+claim) и держит её TASK_LEASE секунд: задачу упавшего обработчика
+после этого заберёт другой. Ошибка откладывает задачу на
+TASK_RETRY_DELAY * 2 ** (попытка - 1) секунд, после max_attempts
+попыток задача остаётся в таблице со статусом failed. Выполненные
+задачи удаляются.
+
+Задача может выполниться дважды (обработчик упал, не успев удалить
+её), поэтому повторное выполнение не должно ничего портить.
+
+dedup_key склеивает повторы: пока задача с ключом ждёт, новая с тем
+же ключом не ставится. Так несколько правок записи подряд дают одну
+перестройку миниатюры.
+
+При TASKS_INLINE = True (разработка и тесты) enqueue выполняет задачу
+сразу, без таблицы и обработчика.
+"""
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import (IntegrityError, close_old_connections, connections,
+                       transaction)
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from posts.models import Job
+
+logger = logging.getLogger(__name__)
+
+# функции задач по имени
+registry = {}
+
+
+def inline():
+    return getattr(settings, 'TASKS_INLINE', False)
+
+
+def lease():
+    return getattr(settings, 'TASK_LEASE', 5 * 60)
+
+
+def retry_delay():
+    return getattr(settings, 'TASK_RETRY_DELAY', 10)
+
+
+def poll_interval():
+    return getattr(settings, 'TASK_POLL_INTERVAL', 1)
+
+
+def task(func=None, attempts=3):
+    """Регистрирует функцию как задачу: @task или @task(attempts=5)."""
+    def register(func):
+        func.task_name = f'{func.__module__}.{func.__qualname__}'
+        func.max_attempts = attempts
+        registry[func.task_name] = func
+        return func
+    return register(func) if func is not None else register
+
+
+def resolve(name):
+    if name not in registry:
+        # модуль задачи мог ещё не импортироваться в этом процессе
+        try:
+            import_string(name)
+        except ImportError:
+            pass
+    try:
+        return registry[name]
+    except KeyError:
+        raise LookupError(f'Нет задачи {name}') from None
+
+
+def enqueue(func, dedup_key=None, delay=0, **kwargs):
+    """Ставит задачу в очередь, возвращает Job.
+
+    None — задача с таким dedup_key уже ждёт или выполнена сразу
+    (TASKS_INLINE).
+    """
+    if inline():
+        func(**kwargs)
+        return None
+    job = Job(name=func.task_name, payload=json.dumps(kwargs),
+              dedup_key=dedup_key, max_attempts=func.max_attempts,
+              run_at=timezone.now() + timedelta(seconds=delay))
+    try:
+        # точка сохранения: ошибка не портит транзакцию запроса
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        if dedup_key is None:
+            raise
+        return None
+    return job
+
+
+def _due(now):
+    return (Q(status=Job.PENDING, run_at__lte=now)
+            | Q(status=Job.RUNNING, locked_until__lt=now,
+                attempts__lt=F('max_attempts')))
+
+
+def claim(limit=1):
+    """Забирает до limit готовых задач для этого обработчика.
+
+    Задачи выбираются и помечаются одним UPDATE, поэтому два
+    обработчика одну задачу не получат.
+    """
+    now = timezone.now()
+    # задачи, чей обработчик упал на последней попытке
+    (Job.objects.filter(status=Job.RUNNING, locked_until__lt=now,
+                        attempts__gte=F('max_attempts'))
+     .update(status=Job.FAILED, last_error='Истёк срок выполнения'))
+
+    token = uuid.uuid4().hex
+    due = (Job.objects.filter(_due(now)).order_by('run_at', 'pk')
+           .values('pk')[:limit])
+    claimed = (Job.objects.filter(_due(now), pk__in=due)
+               .update(status=Job.RUNNING, token=token,
+                       locked_until=now + timedelta(seconds=lease()),
+                       attempts=F('attempts') + 1))
+    if not claimed:
+        return []
+    return list(Job.objects.filter(token=token, status=Job.RUNNING))
+
+
+def run(job):
+    """Выполняет взятую задачу; True, если она выполнена."""
+    try:
+        resolve(job.name)(**json.loads(job.payload))
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning('Задача %s не удалась:\n%s', job, error)
+        fields = {'last_error': error, 'token': '', 'locked_until': None}
+        if job.attempts >= job.max_attempts:
+            fields['status'] = Job.FAILED
+        else:
+            delay = retry_delay() * 2 ** (job.attempts - 1)
+            fields.update(status=Job.PENDING, run_at=timezone.now()
+                          + timedelta(seconds=delay))
+        try:
+            with transaction.atomic():
+                Job.objects.filter(pk=job.pk,
+                                   token=job.token).update(**fields)
+        except IntegrityError:
+            # пока задача выполнялась, такую же поставили заново
+            Job.objects.filter(pk=job.pk, token=job.token).delete()
+        return False
+    Job.objects.filter(pk=job.pk, token=job.token).delete()
+    return True
+
+
+def _run_in_thread(job):
+    try:
+        return run(job)
+    finally:
+        close_old_connections()
+
+
+def work(threads=1, once=False, stop=None):
+    """Выполняет задачи, возвращает число выполненных.
+
+    С threads > 1 задачи выполняются в пуле потоков, каждый со своим
+    соединением с базой. once — остановиться, когда готовых задач не
+    останется; иначе работать, пока не установят событие stop.
+    """
+    stop = stop or threading.Event()
+    pool = (ThreadPoolExecutor(max_workers=threads,
+                               thread_name_prefix='tasks')
+            if threads > 1 else None)
+    done = 0
+    try:
+        while not stop.is_set():
+            jobs = claim(threads)
+            if not jobs:
+                if once:
+                    break
+                # пока ждём, соединение с базой не держим
+                close_old_connections()
+                stop.wait(poll_interval())
+            elif pool is None:
+                done += sum(run(job) for job in jobs)
+            else:
+                done += sum(pool.map(_run_in_thread, jobs))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return done
+
+
+def _process_main(threads):
+    stop = threading.Event()
+    # terminate() просит процесс доделать текущие задачи и выйти
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    work(threads, stop=stop)
+
+
+def work_processes(processes, threads=1, stop=None):
+    """Запускает processes процессов-обработчиков и ждёт события stop."""
+    stop = stop or threading.Event()
+    # после fork у процессов не должно быть общих соединений с базой
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    children = [context.Process(target=_process_main, args=(threads,),
+                                name=f'tasks-{number}')
+                for number in range(processes)]
+    for child in children:
+        child.start()
+    try:
+        while not stop.is_set() and any(
+                child.is_alive() for child in children):
+            stop.wait(poll_interval())
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.join()
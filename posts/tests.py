@@ -1,16 +1,43 @@
+import asyncio
+import json
 import os
+import subprocess
+import sys
 import tempfile
+import time
 from datetime import datetime
+from io import BufferedReader, BytesIO, StringIO
+from unittest import mock
 
 from PIL import Image
 
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.test import TestCase
+from django.core.cache.utils import make_template_fragment_key
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.template.loader import render_to_string
+from django.conf import settings
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings)
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
 
-from posts.models import Comment, Follow, Group, Post
+from posts import (asgi, benchmark, events, follows, metrics,
+                   search as full_text, tasks, thumbnails, warmup)
+from posts.cache import POST_VERSION_KEY
+from posts.feeds import load_feed
+from posts.models import (Comment, Follow, Group, Job, Post, TimelineEntry,
+                          UserStats)
+from posts.search import FtsBackend, InvertedIndexBackend
+from posts.sqlite_cache import SQLiteCache
+from posts.search import get_backend as get_search_backend
+from posts.timeline import TRIM_SLACK
+from posts.uploads import ImageUploadHandler
 
 
 class TestPosts(TestCase):
@@ -240,10 +267,19 @@ class TestsFolowsImagesOthers(TestCase):
 
         self.assertTrue(timedelta2 < timedelta1)
 
+        # лента и карточки постов берутся из кэша: анонимному
+        # пользователю главная страница не стоит ни одного запроса
         cache.clear()
-        self.client.get(reverse('index'))
+        self.client_anonim.get(reverse('index'))
         with self.assertNumQueries(0):
-            self.client.get(reverse('index'))
+            self.client_anonim.get(reverse('index'))
+
+    def test_cache_shows_new_post_at_once(self):
+        self.client.get(reverse('index'))
+        self.client.post(reverse('new_post'), {'text': 'fresh note'})
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, 'fresh note')
+        self.assertContains(response, self.login_user_name)
 
     def test_user_can_follow_the_author(self):
         self.client_author.post(reverse('new_post'),
@@ -303,3 +339,1791 @@ class TestsFolowsImagesOthers(TestCase):
         self.assertEqual(1,
                          len(Comment.objects.all()),
                          msg='auth. user cant comment')
+
+
+class TestKeysetPaginator(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.author = User.objects.create_user('keyset_author',
+                                               'keyset@test.com',
+                                               'test_user_2020')
+        for number in range(10):
+            Post.objects.create(text=f'post {number}', author=self.author)
+
+    def walk_pages(self, url):
+        """Проходит ленту по ссылкам "Следующая" и собирает id записей."""
+        seen = []
+        query = ''
+        while True:
+            response = self.client.get(url + query)
+            page = response.context['page']
+            seen.extend(post.id for post in page.object_list)
+            if not page.has_next():
+                return seen
+            query = (f'?page={page.next_page_number()}'
+                     f'&after={page.next_cursor}')
+
+    def test_cursor_pages_match_offset_pages(self):
+        """Лента по курсорам совпадает с лентой по номерам страниц."""
+        expected = list(Post.objects.order_by('-pub_date', '-pk')
+                        .values_list('pk', flat=True))
+        self.assertEqual(expected, self.walk_pages(reverse('index')))
+
+        by_number = []
+        for number in range(1, 4):
+            response = self.client.get(reverse('index'), {'page': number})
+            by_number.extend(p.id for p in response.context['page'])
+        self.assertEqual(expected, by_number)
+
+    def test_cursor_page_does_not_use_offset(self):
+        """Страница по курсору выбирается без OFFSET и без COUNT(*)."""
+        response = self.client.get(reverse('index'))
+        cursor = response.context['page'].next_cursor
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('index'),
+                                       {'page': 2, 'after': cursor})
+        self.assertEqual(4, len(response.context['page']))
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('OFFSET', sql)
+        self.assertNotIn('COUNT(*)', sql)
+
+        previous = response.context['page'].previous_cursor
+        response = self.client.get(reverse('index'),
+                                   {'page': 1, 'before': previous})
+        self.assertEqual(4, len(response.context['page']))
+        self.assertFalse(response.context['page'].has_previous())
+
+    def test_new_post_resets_cached_count(self):
+        url = reverse('profile', args=[self.author.username])
+        self.client.get(url)
+        Post.objects.create(text='post 11', author=self.author)
+        response = self.client.get(url)
+        self.assertEqual(11, response.context['paginator'].count)
+
+    def test_moved_post_resets_both_group_counts(self):
+        old = Group.objects.create(title='old', slug='old', description='')
+        new = Group.objects.create(title='new', slug='new', description='')
+        Post.objects.filter(author=self.author).update(group=old)
+        post = Post.objects.filter(author=self.author).first()
+        urls = [reverse('group', args=['old']), reverse('group', args=['new'])]
+        for url in urls:
+            self.client.get(url)
+
+        self.client.force_login(self.author)
+        self.client.post(reverse('post_edit', args=[self.author.username,
+                                                    post.id]),
+                         {'text': post.text, 'group': new.id})
+        counts = [self.client.get(url).context['paginator'].count
+                  for url in urls]
+        self.assertEqual([9, 1], counts)
+
+
+class TestFeedQueries(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.author = User.objects.create_user('feed_author',
+                                               'feed@test.com',
+                                               'test_user_2020')
+        group = Group.objects.create(title='feed', slug='feed')
+        for number in range(16):
+            post = Post.objects.create(text=f'post {number}',
+                                       author=self.author,
+                                       group=group)
+            Comment.objects.create(post=post, author=self.author,
+                                   text='comment')
+
+    def render_feed(self, per_page):
+        request = self.factory.get('/')
+        request.user = self.author
+        with CaptureQueriesContext(connection) as queries:
+            paginator, page = load_feed(request, Post.objects.all(), per_page)
+            html = render_to_string('index.html',
+                                    {'page': page, 'paginator': paginator},
+                                    request=request)
+        self.assertEqual(per_page, html.count('Комментариев: 1'))
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        """Число запросов на страницу ленты не зависит от её размера."""
+        self.assertEqual(self.render_feed(2), self.render_feed(16))
+        self.assertEqual(2, self.render_feed(8))
+
+
+class TestCounters(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user('counter_user',
+                                             'counter@test.com',
+                                             'test_user_2020')
+        self.author = User.objects.create_user('counter_author',
+                                               'counter2@test.com',
+                                               'test_user_2020')
+        self.client.force_login(self.user)
+
+    def stats(self, user):
+        return UserStats.objects.get(user=user)
+
+    def test_views_update_counters(self):
+        self.client.get(reverse('profile_follow',
+                                args=[self.author.username]))
+        self.assertEqual(1, self.stats(self.author).followers_count)
+        self.assertEqual(1, self.stats(self.user).following_count)
+
+        self.client.post(reverse('new_post'), {'text': 'counted'})
+        post = Post.objects.get(author=self.user)
+        self.assertEqual(1, self.stats(self.user).posts_count)
+
+        self.client.post(reverse('add_comment',
+                                 args=[self.user.username, post.id]),
+                         {'text': 'comment'})
+        post.refresh_from_db()
+        self.assertEqual(1, post.comment_count)
+
+        self.client.get(reverse('profile_unfollow',
+                                args=[self.author.username]))
+        self.assertEqual(0, self.stats(self.author).followers_count)
+        self.assertEqual(0, self.stats(self.user).following_count)
+
+    def test_profile_reads_counters_in_one_query(self):
+        Follow.objects.create(user=self.user, author=self.author)
+        url = reverse('profile', args=[self.author.username])
+        # первый запрос кладёт в кэш количество записей ленты
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, 'Подписчиков: 1')
+        counts = [query['sql'] for query in queries.captured_queries
+                  if 'COUNT(' in query['sql']]
+        # подписки зрителя тоже взяты из кэша
+        self.assertEqual(0, len(counts))
+
+    def test_rebuild_command_fixes_drift(self):
+        post = Post.objects.create(text='drift', author=self.author)
+        Comment.objects.create(post=post, author=self.user, text='c')
+        UserStats.objects.filter(user=self.author).update(posts_count=7)
+        Post.objects.filter(pk=post.pk).update(comment_count=0)
+        UserStats.objects.filter(user=self.user).delete()
+
+        call_command('rebuild_stats', stdout=StringIO())
+
+        post.refresh_from_db()
+        self.assertEqual(1, post.comment_count)
+        self.assertEqual(1, self.stats(self.author).posts_count)
+        self.assertEqual(0, self.stats(self.user).posts_count)
+
+
+class TestTimeline(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.reader = User.objects.create_user('timeline_reader',
+                                               'reader@test.com',
+                                               'test_user_2020')
+        self.author = User.objects.create_user('timeline_author',
+                                               'author@test.com',
+                                               'test_user_2020')
+        self.client.force_login(self.reader)
+
+    def feed_ids(self):
+        response = self.client.get(reverse('follow_index'))
+        return [post.id for post in response.context['page']]
+
+    def check_fan_out(self):
+        old = Post.objects.create(text='before follow', author=self.author)
+        Follow.objects.create(user=self.reader, author=self.author)
+        new = Post.objects.create(text='after follow', author=self.author)
+        self.assertEqual([new.id, old.id], self.feed_ids())
+
+        Follow.objects.filter(user=self.reader).delete()
+        self.assertEqual([], self.feed_ids())
+
+    def test_fan_out_on_write(self):
+        self.check_fan_out()
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    @override_settings(TIMELINE_STORE='posts.timeline.MemoryTimelineStore')
+    def test_memory_store(self):
+        self.check_fan_out()
+
+    @override_settings(TIMELINE_LENGTH=3)
+    def test_timeline_is_capped(self):
+        Follow.objects.create(user=self.reader, author=self.author)
+        for number in range(3 + TRIM_SLACK + 1):
+            Post.objects.create(text=f'post {number}', author=self.author)
+        self.assertEqual(3, TimelineEntry.objects.count())
+
+    @override_settings(TIMELINE_FANOUT_LIMIT=0)
+    def test_popular_author_is_read_on_request(self):
+        Follow.objects.create(user=self.reader, author=self.author)
+        post = Post.objects.create(text='popular', author=self.author)
+        self.assertFalse(TimelineEntry.objects.exists())
+        self.assertEqual([post.id], self.feed_ids())
+
+
+class TestThumbnails(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('thumb_author',
+                                               'thumb@test.com',
+                                               'test_user_2020')
+        image = BytesIO()
+        Image.new('RGB', (500, 500), (255, 0, 0)).save(image, 'PNG')
+        self.post = Post.objects.create(
+            text='with image',
+            author=self.author,
+            image=SimpleUploadedFile('thumb.png', image.getvalue()))
+
+    def tearDown(self):
+        self.post.image.delete(save=False)
+
+    def test_generate_stores_thumbnail(self):
+        self.assertTrue(thumbnails.generate(self.post.pk))
+        self.post.refresh_from_db()
+        self.assertEqual((960, 339), (self.post.thumbnail_width,
+                                      self.post.thumbnail_height))
+
+        response = Client().get(reverse('index'))
+        self.assertContains(response, f'src="{self.post.thumbnail_url}"')
+
+    @override_settings(TASKS_INLINE=False)
+    def test_new_post_schedules_thumbnail(self):
+        client = Client()
+        client.force_login(self.author)
+        with open(self.post.image.path, 'rb') as img:
+            client.post(reverse('new_post'), {'text': 'new image',
+                                              'image': img})
+        post = Post.objects.get(text='new image')
+        self.assertEqual('', post.thumbnail_url)
+        job = Job.objects.get(name='posts.thumbnails.generate')
+        self.assertEqual(f'thumbnail:{post.pk}', job.dedup_key)
+
+        self.assertGreaterEqual(tasks.work(once=True), 1)
+        post.refresh_from_db()
+        self.assertTrue(post.thumbnail_url)
+        post.image.delete(save=False)
+
+
+class TestImageUploads(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.author = User.objects.create_user('upload_author',
+                                               'upload@test.com',
+                                               'test_user_2020')
+        self.client.force_login(self.author)
+
+    def upload(self, size, image_format='PNG'):
+        data = BytesIO()
+        Image.new('RGB', size, (0, 0, 255)).save(data, image_format)
+        data.name = f'upload.{image_format.lower()}'
+        data.seek(0)
+        return self.client.post(reverse('new_post'),
+                                {'text': 'upload', 'image': data})
+
+    @override_settings(POST_IMAGE_MAX_PIXELS=100)
+    def test_too_many_pixels_rejected(self):
+        response = self.upload((20, 20))
+        self.assertContains(response, 'Изображение слишком большое')
+        self.assertFalse(Post.objects.exists())
+
+    @override_settings(POST_IMAGE_MAX_BYTES=100)
+    def test_too_large_file_rejected(self):
+        response = self.upload((200, 200))
+        self.assertContains(response, 'Файл изображения слишком большой')
+        self.assertFalse(Post.objects.exists())
+
+    @override_settings(POST_IMAGE_FORMATS=('JPEG',))
+    def test_unsupported_format_rejected(self):
+        response = self.upload((20, 20))
+        self.assertContains(response, 'Загрузите правильное изображение')
+
+    @override_settings(POST_IMAGE_MAX_SIDE=50)
+    def test_large_image_downscaled(self):
+        self.upload((200, 100), 'JPEG')
+        post = Post.objects.get()
+        self.assertEqual((50, 25), (post.image.width, post.image.height))
+        post.image.delete(save=False)
+
+    def test_upload_streamed_to_disk(self):
+        request = RequestFactory().get('/')
+        handler = ImageUploadHandler(request)
+        handler.new_file('image', 'small.png', 'image/png', None)
+        data = BytesIO()
+        Image.new('RGB', (10, 10)).save(data, 'PNG')
+        handler.receive_data_chunk(data.getvalue(), 0)
+        uploaded = handler.file_complete(len(data.getvalue()))
+        self.assertTrue(os.path.exists(uploaded.temporary_file_path()))
+        self.assertIsNone(uploaded.upload_error)
+        uploaded.close()
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.author = User.objects.create_user('search_author',
+                                               'search@test.com',
+                                               'test_user_2020')
+        self.group = Group.objects.create(title='Кошки', slug='cats',
+                                          description='Всё про котов')
+        self.strong = Post.objects.create(text='кот кот кот спит',
+                                          author=self.author)
+        self.weak = Post.objects.create(
+            text='кот спит, а собака лает, и снова лает, и опять лает',
+            author=self.author)
+        self.other = Post.objects.create(text='собака', author=self.author,
+                                         group=self.group)
+
+    def found(self, query, **params):
+        response = self.client.get(reverse('search'), {'q': query, **params})
+        return response, [post.id for post in response.context['posts']]
+
+    def check_backend(self, backend):
+        self.assertEqual([self.strong.id, self.weak.id],
+                         [pk for _, pk in backend.search('кот', 10)])
+        first = backend.search('кот', 1)
+        self.assertEqual([self.weak.id],
+                         [pk for _, pk in backend.search('кот', 1,
+                                                         first[-1])])
+        # название группы тоже индексируется
+        self.assertEqual([self.other.id],
+                         [pk for _, pk in backend.search('кошки', 10)])
+
+    def test_fts_backend(self):
+        self.assertIsInstance(get_search_backend(), FtsBackend)
+        self.check_backend(get_search_backend())
+
+    def test_inverted_index_backend(self):
+        self.check_backend(InvertedIndexBackend())
+
+    def test_inverted_index_follows_other_processes(self):
+        # два индекса с общим кэшем — как в двух процессах
+        writer, reader = InvertedIndexBackend(), InvertedIndexBackend()
+        for backend in (writer, reader):
+            backend.search('кот', 10)
+        Post.objects.filter(pk=self.strong.pk).update(text='пёс')
+        self.strong.refresh_from_db()
+        writer.index([self.strong])
+
+        # свой индекс обновлён на месте, чужой строится заново
+        with self.assertNumQueries(0):
+            self.assertEqual([self.strong.id],
+                             [pk for _, pk in writer.search('пёс', 10)])
+        with self.assertNumQueries(1):
+            self.assertEqual([self.strong.id],
+                             [pk for _, pk in reader.search('пёс', 10)])
+
+        weak_id = self.weak.pk
+        self.weak.delete()
+        writer.remove(weak_id)
+        self.assertEqual([], reader.search('лает', 10))
+
+    def test_search_view_pages_by_cursor(self):
+        response, ids = self.found('кот')
+        self.assertEqual([self.strong.id, self.weak.id], ids)
+        self.assertIsNone(response.context['next_cursor'])
+
+        posts, cursor = full_text.search('кот', 1)
+        self.assertEqual([self.strong], posts)
+        response, ids = self.found('кот', after=cursor)
+        self.assertEqual([self.weak.id], ids)
+
+    def test_index_follows_changes(self):
+        self.strong.text = 'пёс'
+        self.strong.save()
+        self.other.delete()
+        self.assertEqual([self.weak.id], self.found('кот')[1])
+        self.assertEqual([self.weak.id], self.found('собака')[1])
+        self.assertEqual([self.strong.id], self.found('пёс')[1])
+
+    def test_admin_search_uses_index(self):
+        admin = User.objects.create_superuser('admin', 'a@test.com', 'pass')
+        self.client.force_login(admin)
+        response = self.client.get('/admin/posts/post/', {'q': 'кошки'})
+        self.assertEqual([self.other.id],
+                         [post.id for post in response.context['cl'].result_list])
+
+
+class TestFeedIndexes(TestCase):
+    def test_feed_queries_use_indexes(self):
+        """Запросы лент не сканируют таблицы и не сортируют в B-дереве."""
+        author = User.objects.create_user('plan_author', 'plan@test.com',
+                                          'test_user_2020')
+        reader = User.objects.create_user('plan_reader', 'plan2@test.com',
+                                          'test_user_2020')
+        group = Group.objects.create(title='plan', slug='plan')
+        for number in range(6):
+            Post.objects.create(text=f'plan {number}', author=author,
+                                group=group)
+        Follow.objects.create(user=reader, author=author)
+
+        out = StringIO()
+        call_command('explain_feeds', stdout=out)
+        self.assertIn('Все планы используют индексы', out.getvalue())
+
+
+class TestBenchmark(TestCase):
+    def test_every_route_has_scenario(self):
+        from posts.urls import urlpatterns as posts_urls
+        from users.urls import urlpatterns as users_urls
+
+        routes = {scenario.route for scenario in benchmark.SCENARIOS}
+        for pattern in posts_urls + users_urls:
+            self.assertIn(str(pattern.pattern), routes)
+
+    def test_command_writes_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'report.json')
+            call_command('benchmark', '--users', '4', '--groups', '2',
+                         '--posts', '12', '--comments', '20',
+                         '--follows', '6', '--requests', '2',
+                         '--concurrency', '1', '--output', output,
+                         '--yes-populate', stdout=StringIO())
+            with open(output) as report:
+                routes = json.load(report)['routes']
+
+        self.assertEqual({scenario.name for scenario in benchmark.SCENARIOS},
+                         set(routes))
+        for name, row in routes.items():
+            self.assertEqual(2, row['requests'])
+            self.assertEqual(0, row['errors'], name)
+        self.assertEqual(4, UserStats.objects.filter(
+            user__username__startswith='bench_').count())
+        self.assertFalse(any(user.has_usable_password() for user in
+                             User.objects.filter(
+                                 username__startswith='bench_')))
+
+    def test_compare_reports_regressions(self):
+        base = {'p95_ms': 10.0, 'queries_mean': 3, 'errors': 0}
+        same = dict(base, p95_ms=10.5)
+        slower = dict(base, p95_ms=20.0, queries_mean=5)
+        self.assertEqual([], benchmark.compare({'index': same},
+                                               {'index': base}))
+        self.assertEqual(2, len(benchmark.compare({'index': slower},
+                                                  {'index': base})))
+
+
+@override_settings(REQUEST_METRICS_SAMPLE_RATE=1)
+class TestRequestMetrics(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.recorder.reset()
+        self.client = Client()
+        self.author = User.objects.create_user('metrics_author',
+                                               'metrics@test.com',
+                                               'test_user_2020')
+        for number in range(3):
+            Post.objects.create(text=f'metrics {number}', author=self.author)
+
+    def test_request_is_recorded(self):
+        self.client.get(reverse('profile', args=[self.author.username]))
+        metrics.recorder.flush()
+
+        stats = metrics.collect()['posts.views.profile']
+        self.assertEqual(1, stats['count'])
+        self.assertEqual(1, stats['sampled'])
+        self.assertGreater(stats['sql'], 0)
+        self.assertGreater(stats['template'], 0)
+
+    def test_repeated_queries_are_reported(self):
+        """Одинаковый SQL несколько раз за запрос — кандидат в N+1."""
+        probe = metrics.Probe()
+        with connection.execute_wrapper(probe):
+            for post in Post.objects.all():
+                post.author.username
+        metrics.recorder.record('tests.n_plus_one', 0.01, probe)
+        metrics.recorder.flush()
+
+        row = next(row for row in metrics.report()
+                   if row['view'] == 'tests.n_plus_one')
+        self.assertEqual(4, row['sql_count'])
+        self.assertEqual(3, row['duplicates'][0]['count'])
+        self.assertIn('auth_user', row['duplicates'][0]['sql'])
+
+    def test_endpoint_is_for_staff_only(self):
+        url = reverse('request_metrics')
+        self.client.force_login(self.author)
+        self.assertEqual(302, self.client.get(url).status_code)
+
+        self.author.is_staff = True
+        self.author.save()
+        self.client.get(reverse('index'))
+        metrics.recorder.flush()
+        views = [row['view'] for row in self.client.get(url).json()['views']]
+        self.assertIn('posts.views.index', views)
+
+    def test_command_prints_report(self):
+        self.client.get(reverse('index'))
+        metrics.recorder.flush()
+        out = StringIO()
+        call_command('request_metrics', stdout=out)
+        self.assertIn('posts.views.index', out.getvalue())
+
+
+# выполняется в отдельном процессе с боевым профилем настроек
+PRODUCTION_DATABASE_CHECK = """
+import json
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import Client
+
+from posts.db import read_from_replica
+from posts.models import Post
+
+author = User.objects.create_user('replica_author')
+Post.objects.create(text='replica', author=author)
+
+def journal_mode(alias):
+    with connections[alias].cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        return cursor.fetchone()[0]
+
+replica_queries = []
+def count(execute, sql, params, many, context):
+    replica_queries.append(sql)
+    return execute(sql, params, many, context)
+
+client = Client()
+client.force_login(author)
+with connections['replica'].execute_wrapper(count):
+    feed_status = client.get('/replica_author/').status_code
+    feed_queries = len(replica_queries)
+    client.post('/new/', {'text': 'written'})
+    write_queries = len(replica_queries) - feed_queries
+
+try:
+    with connections['replica'].cursor() as cursor:
+        cursor.execute('DELETE FROM posts_post')
+    replica_writable = True
+except Exception:
+    replica_writable = False
+
+with read_from_replica():
+    before = Post.objects.all().db
+    Post.objects.create(text='after write', author=author)
+    after = Post.objects.all().db
+
+print(json.dumps({
+    'journal_mode': journal_mode('default'),
+    'replica_journal_mode': journal_mode('replica'),
+    'feed_status': feed_status,
+    'feed_queries': feed_queries,
+    'write_queries': write_queries,
+    'posts': Post.objects.count(),
+    'replica_writable': replica_writable,
+    'read_before_write': before,
+    'read_after_write': after,
+}))
+"""
+
+# файл базы в обычном журнале, и первым открывается соединение реплики
+ROLLBACK_JOURNAL_CHECK = """
+import json
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import Client
+
+User.objects.create_user('journal_author')
+with connections['default'].cursor() as cursor:
+    cursor.execute('PRAGMA journal_mode = delete')
+connections.close_all()
+
+status = Client().get('/journal_author/').status_code
+with connections['default'].cursor() as cursor:
+    cursor.execute('PRAGMA journal_mode')
+    mode = cursor.fetchone()[0]
+print(json.dumps({'status': status, 'journal_mode': mode}))
+"""
+
+# команды замеров не трогают настроенную базу
+SCRATCH_DATABASE_CHECK = """
+import io
+import json
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+call_command('benchmark', '--users', '3', '--groups', '1', '--posts', '6',
+             '--comments', '4', '--follows', '2', '--requests', '1',
+             '--concurrency', '1', '--only', 'index', 'profile', 'new_post',
+             stdout=io.StringIO())
+call_command('search_benchmark', '--posts', '20', '--repeat', '1',
+             stdout=io.StringIO())
+print(json.dumps({'users': User.objects.count()}))
+"""
+
+
+class TestProductionDatabase(SimpleTestCase):
+    def run_script(self, script):
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ,
+                       DJANGO_SETTINGS_MODULE='yatube.settings_production',
+                       YATUBE_DB_PATH=os.path.join(directory, 'db.sqlite3'),
+                       YATUBE_CACHE_PATH=os.path.join(directory,
+                                                      'cache.sqlite3'),
+                       PYTHONPATH=settings.BASE_DIR)
+            subprocess.run([sys.executable, 'manage.py', 'migrate', '-v0'],
+                           cwd=settings.BASE_DIR, env=env, check=True)
+            output = subprocess.run(
+                [sys.executable, '-c', script],
+                cwd=settings.BASE_DIR, env=env, check=True,
+                stdout=subprocess.PIPE).stdout
+        return json.loads(output)
+
+    def test_wal_and_replica_routing(self):
+        result = self.run_script(PRODUCTION_DATABASE_CHECK)
+
+        self.assertEqual('wal', result['journal_mode'])
+        self.assertEqual('wal', result['replica_journal_mode'])
+        self.assertEqual(200, result['feed_status'])
+        self.assertGreater(result['feed_queries'], 0)
+        self.assertEqual(0, result['write_queries'])
+        self.assertEqual(3, result['posts'])
+        self.assertFalse(result['replica_writable'])
+        self.assertEqual('replica', result['read_before_write'])
+        self.assertEqual('default', result['read_after_write'])
+
+    def test_benchmarks_use_scratch_database(self):
+        self.assertEqual({'users': 0},
+                         self.run_script(SCRATCH_DATABASE_CHECK))
+
+    def test_replica_opens_file_not_in_wal(self):
+        result = self.run_script(ROLLBACK_JOURNAL_CHECK)
+        self.assertEqual(200, result['status'])
+        # в WAL файл переводит соединение основной базы
+        self.assertEqual('wal', result['journal_mode'])
+
+
+class TestNdjson(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('ndjson_author',
+                                               'ndjson@test.com',
+                                               'test_user_2020')
+        self.reader = User.objects.create_user('ndjson_reader',
+                                               'ndjson2@test.com',
+                                               'test_user_2020')
+        group = Group.objects.create(title='ndjson', slug='ndjson',
+                                     description='группа')
+        image = BytesIO()
+        Image.new('RGB', (20, 20), (0, 0, 255)).save(image, 'PNG')
+        self.post = Post.objects.create(
+            text='с картинкой', author=self.author, group=group,
+            image=SimpleUploadedFile('ndjson.png', image.getvalue()))
+        Post.objects.create(text='без картинки', author=self.author)
+        Comment.objects.create(post=self.post, author=self.reader,
+                               text='комментарий')
+        Follow.objects.create(user=self.reader, author=self.author)
+
+    def tearDown(self):
+        for post in Post.objects.exclude(image=''):
+            post.image.delete(save=False)
+
+    def test_export_import_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.ndjson.gz')
+            media = os.path.join(directory, 'media')
+            call_command('export_ndjson', path, '--media-to', media,
+                         stdout=StringIO())
+            call_command('import_ndjson', path, '--media-from', media,
+                         stdout=StringIO())
+
+        # пользователи, группа и подписка совпали с существующими
+        self.assertEqual(2, User.objects.count())
+        self.assertEqual(1, Group.objects.count())
+        self.assertEqual(1, Follow.objects.count())
+
+        copy = Post.objects.exclude(pk=self.post.pk).get(text='с картинкой')
+        self.assertEqual(self.post.pub_date, copy.pub_date)
+        self.assertEqual(self.post.group_id, copy.group_id)
+        self.assertNotEqual(self.post.image.name, copy.image.name)
+        self.assertTrue(copy.image.storage.exists(copy.image.name))
+        self.assertEqual(1, copy.comment_count)
+        self.assertEqual(['комментарий'],
+                         [comment.text for comment in copy.comments.all()])
+        self.assertEqual(4, UserStats.objects.get(user=self.author)
+                         .posts_count)
+
+    def test_import_reaches_existing_followers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.ndjson')
+            call_command('export_ndjson', path, stdout=StringIO())
+            # подписчик, которого нет в файле
+            late = User.objects.create_user('ndjson_late', 'late@test.com',
+                                            'test_user_2020')
+            Follow.objects.create(user=late, author=self.author)
+            call_command('import_ndjson', path, stdout=StringIO())
+
+        self.assertEqual(set(Post.objects.values_list('pk', flat=True)),
+                         set(TimelineEntry.objects.filter(user=late)
+                             .values_list('post_id', flat=True)))
+
+    def test_broken_file_is_reported(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.ndjson')
+            with open(path, 'w') as dump:
+                dump.write('{"model": "post", "id": 1}\n')
+            with self.assertRaises(CommandError):
+                call_command('import_ndjson', path, stdout=StringIO())
+
+    def test_broken_line_rolls_back_import(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.ndjson')
+            media = os.path.join(directory, 'media')
+            call_command('export_ndjson', path, '--media-to', media,
+                         stdout=StringIO())
+            with open(path) as dump:
+                lines = dump.readlines()
+            lines.insert(len(lines) - 1, '{"model": "comment"}\n')
+            with open(path, 'w') as dump:
+                dump.writelines(lines)
+
+            folder = os.path.join(settings.MEDIA_ROOT, 'posts')
+            images = sorted(os.listdir(folder))
+            # пачка в одну строку: записи успевают записаться до ошибки
+            with self.assertRaisesMessage(CommandError,
+                                          f'строка {len(lines) - 1}'):
+                call_command('import_ndjson', path, '--media-from', media,
+                             '--batch-size', '1', stdout=StringIO())
+
+        self.assertEqual(2, Post.objects.count())
+        self.assertEqual(1, Comment.objects.count())
+        self.assertEqual(images, sorted(os.listdir(folder)))
+
+
+class TestFollowBatch(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.reader = User.objects.create_user('batch_reader',
+                                               'batch@test.com',
+                                               'test_user_2020')
+        self.authors = [
+            User.objects.create_user(f'batch_author_{number}',
+                                     f'batch{number}@test.com',
+                                     'test_user_2020')
+            for number in range(12)
+        ]
+        for author in self.authors:
+            Post.objects.create(text=f'by {author.username}', author=author)
+        self.client.force_login(self.reader)
+
+    def batch(self, follow=(), unfollow=()):
+        return self.client.post(reverse('follow_batch'),
+                                json.dumps({'follow': list(follow),
+                                            'unfollow': list(unfollow)}),
+                                content_type='application/json')
+
+    def names(self, count):
+        return [author.username for author in self.authors[:count]]
+
+    def followers(self, user):
+        return UserStats.objects.get(user=user).followers_count
+
+    def test_follow_and_unfollow(self):
+        feed = self.client.get(reverse('follow_index'))
+        self.assertEqual(0, feed.context['paginator'].count)
+
+        result = self.batch(self.names(3) + ['nobody', 'batch_reader'])
+        self.assertEqual(self.names(3), result.json()['followed'])
+        self.assertEqual(['nobody'], result.json()['not_found'])
+        self.assertEqual(3, Follow.objects.count())
+        self.assertEqual(3, UserStats.objects.get(user=self.reader)
+                         .following_count)
+        self.assertEqual(1, self.followers(self.authors[0]))
+        feed = self.client.get(reverse('follow_index'))
+        self.assertEqual(3, feed.context['paginator'].count)
+
+        # повторная подписка ничего не меняет
+        result = self.batch(self.names(3))
+        self.assertEqual([], result.json()['followed'])
+        self.assertEqual(1, self.followers(self.authors[0]))
+
+        result = self.batch(unfollow=self.names(2) + [self.names(12)[-1]])
+        self.assertEqual(self.names(2), result.json()['unfollowed'])
+        self.assertEqual({'batch_author_0': False,
+                          'batch_author_1': False,
+                          'batch_author_11': False},
+                         result.json()['following'])
+        self.assertEqual(0, self.followers(self.authors[0]))
+        self.assertEqual(1, self.followers(self.authors[2]))
+        self.assertEqual(1, UserStats.objects.get(user=self.reader)
+                         .following_count)
+        self.assertEqual(1, TimelineEntry.objects.count())
+
+    def test_concurrent_apply_counts_once(self):
+        create = follows._create
+        raced = []
+
+        def racing_create(user_id, author_ids):
+            # второй запрос подписывается между SELECT и INSERT первого
+            if not raced:
+                raced.append(None)
+                raced[0] = follows.apply(self.reader, follow=self.names(2))
+            create(user_id, author_ids)
+
+        with mock.patch.object(follows, '_create', racing_create):
+            result = follows.apply(self.reader, follow=self.names(3))
+
+        self.assertEqual(self.names(2), raced[0]['followed'])
+        self.assertEqual(self.names(3)[2:], result['followed'])
+        self.assertTrue(all(result['following'].values()))
+        self.assertEqual(3, Follow.objects.count())
+        self.assertEqual(3, UserStats.objects.get(user=self.reader)
+                         .following_count)
+        for author in self.authors[:3]:
+            self.assertEqual(1, self.followers(author))
+        self.assertEqual(3, TimelineEntry.objects.count())
+
+    def test_follow_set_is_forgotten_after_commit(self):
+        key = follows.following_key(self.reader.pk)
+        follows.following_ids(self.reader.pk)
+        with transaction.atomic():
+            follows.apply(self.reader, follow=self.names(2))
+            # до фиксации другие запросы видят старые подписки
+            self.assertEqual(frozenset(), cache.get(key))
+        self.assertIsNone(cache.get(key))
+        self.assertEqual({author.pk for author in self.authors[:2]},
+                         follows.following_ids(self.reader.pk))
+
+    def test_query_count_does_not_depend_on_batch_size(self):
+        def queries(names, unfollow=False):
+            with CaptureQueriesContext(connection) as captured:
+                if unfollow:
+                    self.batch(unfollow=names)
+                else:
+                    self.batch(names)
+            return len(captured)
+
+        few, many = self.names(2), self.names(12)[2:]
+        self.assertEqual(queries(few), queries(many))
+        self.assertEqual(queries(few, True), queries(many, True))
+
+    def test_bad_requests(self):
+        url = reverse('follow_batch')
+        self.assertEqual(405, self.client.get(url).status_code)
+        self.assertEqual(400, self.client.post(
+            url, 'not json', content_type='application/json').status_code)
+        too_many = [str(number) for number in range(101)]
+        self.assertEqual(400, self.batch(too_many).status_code)
+        self.client.logout()
+        self.assertEqual(401, self.batch(self.names(1)).status_code)
+
+
+class TestFollowState(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.reader = User.objects.create_user('state_reader',
+                                               'state@test.com',
+                                               'test_user_2020')
+        self.authors = [
+            User.objects.create_user(f'state_author_{number}',
+                                     f'state{number}@test.com',
+                                     'test_user_2020')
+            for number in range(3)
+        ]
+        self.posts = [Post.objects.create(text=f'by {author.username}',
+                                          author=author)
+                      for author in self.authors]
+        self.client.force_login(self.reader)
+
+    def follow_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        return response, [query['sql'] for query in captured.captured_queries
+                          if 'posts_follow' in query['sql']]
+
+    def test_one_query_per_page_then_cached(self):
+        Follow.objects.create(user=self.reader, author=self.authors[0])
+        response, queries = self.follow_queries(reverse('index'))
+        self.assertEqual(1, len(queries))
+        self.assertContains(response, 'Отписаться', count=1)
+        self.assertContains(response, 'Подписаться', count=2)
+
+        for url in (reverse('index'),
+                    reverse('profile', args=[self.authors[0].username]),
+                    reverse('post', args=[self.authors[0].username,
+                                          self.posts[0].id])):
+            response, queries = self.follow_queries(url)
+            self.assertEqual([], queries)
+            self.assertTrue(response.context['followed']
+                            .follows(self.authors[0]))
+
+    def test_follow_and_unfollow_reset_state(self):
+        profile = reverse('profile', args=[self.authors[1].username])
+        self.assertFalse(self.client.get(profile).context['following'])
+
+        self.client.get(reverse('profile_follow',
+                                args=[self.authors[1].username]))
+        self.assertTrue(self.client.get(profile).context['following'])
+
+        self.client.get(reverse('profile_unfollow',
+                                args=[self.authors[1].username]))
+        self.assertFalse(self.client.get(profile).context['following'])
+
+        self.client.post(reverse('follow_batch'),
+                         json.dumps({'follow': [self.authors[1].username]}),
+                         content_type='application/json')
+        self.assertTrue(self.client.get(profile).context['following'])
+
+    def test_anonymous_follows_nobody(self):
+        self.client.logout()
+        response, queries = self.follow_queries(reverse('index'))
+        self.assertEqual([], queries)
+        self.assertFalse(response.context['followed']
+                         .follows(self.authors[0]))
+        self.assertNotContains(response, 'Подписаться')
+
+
+@override_settings(COMMENTS_PAGE_SIZE=5, COMMENTS_PAGE_MAX=8)
+class TestCommentPages(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.author = User.objects.create_user('thread_author',
+                                               'thread@test.com',
+                                               'test_user_2020')
+        self.post = Post.objects.create(text='viral', author=self.author)
+        readers = [User.objects.create_user(f'thread_reader_{number}',
+                                            f'reader{number}@test.com',
+                                            'test_user_2020')
+                   for number in range(4)]
+        self.comments = [
+            Comment.objects.create(post=self.post,
+                                   author=readers[number % 4],
+                                   text=f'comment {number}')
+            for number in range(13)
+        ]
+        self.url = reverse('post_comments', args=[self.author.username,
+                                                  self.post.id])
+
+    def test_post_page_renders_first_page(self):
+        url = reverse('post', args=[self.author.username, self.post.id])
+        response = self.client.get(url)
+        self.assertEqual(self.comments[:5],
+                         list(response.context['comments']))
+        self.assertContains(response, 'Показать ещё комментарии')
+
+        response = self.client.get(url, {
+            'after': response.context['comments_next']})
+        self.assertEqual(self.comments[5:10],
+                         list(response.context['comments']))
+
+    def test_json_pages_walk_whole_thread(self):
+        # одинаковое время создания: порядок решает id
+        Comment.objects.update(created=self.comments[0].created)
+        texts, after = [], None
+        while True:
+            data = self.client.get(self.url, {'after': after or ''}).json()
+            texts += [comment['text'] for comment in data['comments']]
+            after = data['next']
+            if after is None:
+                break
+        self.assertEqual([comment.text for comment in self.comments], texts)
+
+    def test_authors_in_one_query_and_limit_is_capped(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get(self.url, {'limit': 1000}).json()
+        self.assertEqual(8, len(data['comments']))
+        self.assertEqual('thread_reader_1', data['comments'][1]['author'])
+        # запись, комментарии с авторами и проверка следующей страницы
+        self.assertEqual(3, len(queries))
+
+        data = self.client.get(self.url, {'after': 'broken'}).json()
+        self.assertEqual('comment 0', data['comments'][0]['text'])
+
+
+class TestCommentWrites(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.author = User.objects.create_user('write_author',
+                                               'write@test.com',
+                                               'test_user_2020')
+        self.post = Post.objects.create(text='discussed', author=self.author)
+        self.client.force_login(self.author)
+        self.post_url = reverse('post', args=[self.author.username,
+                                              self.post.id])
+        self.add_url = reverse('add_comment', args=[self.author.username,
+                                                    self.post.id])
+
+    def test_post_redirects_to_thread(self):
+        token = self.client.get(self.post_url).context['comment_token']
+        for url in (self.post_url, self.add_url):
+            response = self.client.post(url, {'text': f'via {url}'})
+            self.assertRedirects(response, self.post_url)
+        self.assertEqual(2, Comment.objects.count())
+        self.assertNotEqual(token,
+                            self.client.get(self.post_url)
+                            .context['comment_token'])
+
+    def test_resubmit_and_duplicate_text_are_ignored(self):
+        token = self.client.get(self.post_url).context['comment_token']
+        for _ in range(2):
+            self.client.post(self.add_url, {'text': 'once', 'token': token})
+            self.client.post(self.add_url, {'text': 'same  text'})
+            self.client.post(self.add_url, {'text': 'same text'})
+        self.assertEqual(['once', 'same  text'],
+                         [comment.text for comment in
+                          Comment.objects.order_by('pk')])
+        self.post.refresh_from_db()
+        self.assertEqual(2, self.post.comment_count)
+
+    def test_token_from_cached_page_keeps_new_text(self):
+        # страница из кэша отдаёт тот же токен для следующего комментария
+        token = self.client.get(self.post_url).context['comment_token']
+        for text in ('first', 'second', 'second'):
+            self.client.post(self.add_url, {'text': text, 'token': token})
+        self.assertEqual(['first', 'second'],
+                         [comment.text for comment in
+                          Comment.objects.order_by('pk')])
+
+    @override_settings(COMMENT_RATE_LIMIT=2)
+    def test_rate_limit(self):
+        for number in range(2):
+            self.client.post(self.add_url, {'text': f'comment {number}'})
+        response = self.client.post(self.add_url, {'text': 'spam',
+                                                   'token': 'spam'})
+        self.assertEqual(429, response.status_code)
+        self.assertEqual('spam', response.context['comment_token'])
+        self.assertEqual(2, Comment.objects.count())
+
+        # отклонённый комментарий не считается повтором
+        with override_settings(COMMENT_RATE_LIMIT=0):
+            self.client.post(self.add_url, {'text': 'spam', 'token': 'spam'})
+        self.assertEqual(3, Comment.objects.count())
+
+    def test_anonymous_cannot_comment(self):
+        self.client.logout()
+        response = self.client.post(self.post_url, {'text': 'anonymous'})
+        self.assertEqual(302, response.status_code)
+        self.assertFalse(Comment.objects.exists())
+
+
+class TestPostCards(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.author = User.objects.create_user('card_author',
+                                               'card@test.com',
+                                               'test_user_2020')
+        self.group = Group.objects.create(title='cards', slug='cards')
+        self.edited, self.other = [
+            Post.objects.create(text=f'card {number}', author=self.author,
+                                group=self.group)
+            for number in range(2)
+        ]
+
+    def version(self, post):
+        return cache.get(POST_VERSION_KEY.format(post.pk))
+
+    def cached(self, post):
+        key = make_template_fragment_key('post_item',
+                                         [post.pk, self.version(post)])
+        return cache.get(key) is not None
+
+    def test_cards_are_shared_between_feeds(self):
+        self.client.get(reverse('index'))
+        self.assertTrue(self.cached(self.edited))
+        self.assertTrue(self.cached(self.other))
+
+        other_version = self.version(self.other)
+        self.edited.text = 'card edited'
+        self.edited.save()
+        self.assertFalse(self.cached(self.edited))
+        # правка одной записи не трогает карточки остальных
+        self.assertEqual(other_version, self.version(self.other))
+        self.assertTrue(self.cached(self.other))
+
+        response = self.client.get(reverse('profile',
+                                           args=[self.author.username]))
+        self.assertContains(response, 'card edited')
+
+    def test_comment_and_group_change_card(self):
+        self.client.get(reverse('index'))
+        version = self.version(self.other)
+        Comment.objects.create(post=self.other, author=self.author,
+                               text='comment')
+        self.assertNotEqual(version, self.version(self.other))
+
+        self.group.title = 'renamed cards'
+        self.group.save()
+        response = self.client.get(reverse('group', args=['cards']))
+        self.assertContains(response, '#renamed cards', count=2)
+
+
+PRODUCTION_TEMPLATES_CHECK = """
+import json
+from django.template import engines
+from yatube.wsgi import application
+
+loader = engines['django'].engine.template_loaders[0]
+print(json.dumps({
+    'loader': type(loader).__module__,
+    'cached': sorted(loader.get_template_cache),
+}))
+"""
+
+
+class TestTemplateWarmup(SimpleTestCase):
+    def test_production_parses_templates_at_startup(self):
+        env = dict(os.environ,
+                   DJANGO_SETTINGS_MODULE='yatube.settings_production',
+                   PYTHONPATH=settings.BASE_DIR)
+        # каталог шаблонов в боевом профиле не зависит от текущего
+        output = subprocess.run(
+            [sys.executable, '-c', PRODUCTION_TEMPLATES_CHECK],
+            cwd=tempfile.gettempdir(), env=env, check=True,
+            stdout=subprocess.PIPE).stdout
+        result = json.loads(output)
+
+        self.assertEqual('django.template.loaders.cached', result['loader'])
+        for name in ('base.html', 'index.html', 'includes/post_item.html',
+                     'signup.html'):
+            self.assertIn(name, result['cached'])
+
+    def test_warm_command_reports_every_template(self):
+        output = StringIO()
+        call_command('warm_templates', stdout=output)
+        self.assertIn('includes/post_item.html', output.getvalue())
+        self.assertIn(f'шаблонов: {len(warmup.project_templates())}',
+                      output.getvalue())
+
+    def test_render_benchmark(self):
+        report = benchmark.render_templates(sizes=(2, 5), rounds=2)
+        self.assertEqual({'uncached', 'cached'}, set(report))
+        self.assertEqual({2, 5}, set(report['cached']))
+        self.assertGreater(report['uncached'][5]['mean_ms'], 0)
+
+
+SHARED_CACHE_CHECK = """
+import sys
+from posts.sqlite_cache import SQLiteCache
+
+cache = SQLiteCache(sys.argv[1], {})
+cache.incr('shared')
+cache.set('from_child', 'привет')
+"""
+
+
+class TestSQLiteCache(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache.sqlite3')
+
+    def backend(self, **options):
+        options.setdefault('STATS_FLUSH_INTERVAL', 0)
+        return SQLiteCache(self.path, {'OPTIONS': options})
+
+    def test_cache_api(self):
+        cache = self.backend()
+        cache.set('a', {'value': 1})
+        self.assertEqual({'value': 1}, cache.get('a'))
+        self.assertFalse(cache.add('a', 2))
+        self.assertTrue(cache.add('counter', 1, None))
+        self.assertEqual(3, cache.incr('counter', 2))
+        self.assertEqual(2, cache.decr('counter'))
+        with self.assertRaises(ValueError):
+            cache.incr('missing')
+        self.assertEqual({'a': {'value': 1}, 'counter': 2},
+                         cache.get_many(['a', 'counter', 'missing']))
+
+        cache.set('expired', 1, 0)
+        self.assertIsNone(cache.get('expired'))
+        self.assertTrue(cache.add('expired', 2))
+        cache.delete_many(['a', 'expired'])
+        self.assertFalse(cache.has_key('a'))
+        self.assertEqual(2, cache.get_or_set('counter', 5))
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(4, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        cache.clear()
+        self.assertEqual((0, 0), (cache.stats()['entries'],
+                                  cache.stats()['bytes']))
+
+    def test_least_recently_read_are_evicted(self):
+        cache = self.backend(MAX_ENTRIES=10, ACCESS_RESOLUTION=0)
+        for number in range(10):
+            cache.set(number, number)
+        cache.get(0)
+        cache.set(10, 10)
+        self.assertEqual(0, cache.get(0))
+        self.assertIsNone(cache.get(1))
+        self.assertLessEqual(cache.stats()['entries'], 9)
+        self.assertGreater(cache.stats()['evictions'], 0)
+
+        small = self.backend(MAX_BYTES=4000)
+        for number in range(10):
+            small.set(f'big:{number}', 'x' * 1000)
+        self.assertLessEqual(small.stats()['bytes'], 3600)
+        self.assertIsNotNone(small.get('big:9'))
+
+    def test_shared_between_processes(self):
+        cache = self.backend()
+        cache.set('shared', 1)
+        subprocess.run([sys.executable, '-c', SHARED_CACHE_CHECK, self.path],
+                       cwd=settings.BASE_DIR, check=True,
+                       env=dict(os.environ, PYTHONPATH=settings.BASE_DIR))
+        self.assertEqual(2, cache.get('shared'))
+        self.assertEqual('привет', cache.get('from_child'))
+
+    def test_benchmark(self):
+        report = benchmark.run_cache(('locmem', 'sqlite'), threads=2,
+                                     operations=50, keys=20)
+        self.assertEqual({'locmem', 'sqlite'}, set(report))
+        self.assertEqual(0, report['sqlite']['errors'])
+        self.assertEqual(100, report['sqlite']['operations'])
+        stats = report['sqlite']['stats']
+        self.assertEqual(20, stats['entries'])
+        self.assertGreater(stats['hits'], stats['misses'])
+
+
+@override_settings(API_PAGE_SIZE=3, API_PAGE_MAX=5)
+class TestJsonApi(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.author = User.objects.create_user('api_author',
+                                               'api@test.com',
+                                               'test_user_2020')
+        self.reader = User.objects.create_user('api_reader',
+                                               'api2@test.com',
+                                               'test_user_2020')
+        self.group = Group.objects.create(title='api', slug='api',
+                                          description='группа')
+        self.posts = [Post.objects.create(text=f'api {number}',
+                                          author=self.author,
+                                          group=self.group)
+                      for number in range(7)]
+        Comment.objects.create(post=self.posts[0], author=self.reader,
+                               text='first')
+
+    def walk(self, url):
+        ids, after = [], ''
+        while after is not None:
+            data = self.client.get(url, {'after': after}).json()
+            ids += [post['id'] for post in data['posts']]
+            after = data['next']
+        return ids
+
+    def test_feeds(self):
+        newest_first = [post.id for post in reversed(self.posts)]
+        self.assertEqual(newest_first, self.walk(reverse('api_posts')))
+        self.assertEqual(newest_first,
+                         self.walk(reverse('api_group', args=['api'])))
+
+        data = self.client.get(reverse('api_posts'), {'limit': 100}).json()
+        self.assertEqual(5, len(data['posts']))
+        self.assertEqual({'id': self.posts[6].id, 'text': 'api 6',
+                          'pub_date': self.posts[6].pub_date.isoformat(),
+                          'author': 'api_author', 'group': 'api',
+                          'image': None, 'thumbnail': None, 'comments': 0},
+                         data['posts'][0])
+
+        data = self.client.get(reverse('api_profile',
+                                       args=['api_author'])).json()
+        self.assertEqual(7, data['profile']['posts'])
+        data = self.client.get(reverse('api_comments',
+                                       args=[self.posts[0].id])).json()
+        self.assertEqual(['first'], [row['text'] for row in data['comments']])
+        self.assertEqual(['api'], [row['slug'] for row in
+                                   self.client.get(reverse('api_groups'))
+                                   .json()['groups']])
+
+        for url in (reverse('api_group', args=['missing']),
+                    reverse('api_profile', args=['missing']),
+                    reverse('api_comments', args=[10 ** 6])):
+            self.assertEqual(404, self.client.get(url).status_code)
+
+    def test_unchanged_feed_is_not_modified(self):
+        url = reverse('api_posts')
+        response = self.client.get(url)
+        etag = response['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.content)
+        # дата последней записи уже в кэше
+        self.assertEqual(0, len(queries))
+
+        self.assertNotIn('Last-Modified', response)
+
+        self.posts[0].text = 'edited'
+        self.posts[0].save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_if_modified_since_alone_is_not_trusted(self):
+        url = reverse('api_posts')
+        # дата из будущего: по ней одной лента «не менялась» бы всегда
+        since = http_date(time.time() + 60)
+
+        Comment.objects.create(post=self.posts[6], author=self.reader,
+                               text='новый')
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, response.json()['posts'][0]['comments'])
+
+        self.posts[6].delete()
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.posts[5].id, response.json()['posts'][0]['id'])
+
+        response = self.client.get(
+            reverse('api_comments', args=[self.posts[0].id]),
+            HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(200, response.status_code)
+
+    def test_follow_feed(self):
+        url = reverse('api_follow')
+        self.assertEqual(401, self.client.get(url).status_code)
+
+        self.client.force_login(self.reader)
+        response = self.client.get(url)
+        self.assertEqual([], response.json()['posts'])
+        Follow.objects.create(user=self.reader, author=self.author)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, len(response.json()['posts']))
+
+
+class TestConditionalPages(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.author = User.objects.create_user('etag_author',
+                                               'etag@test.com',
+                                               'test_user_2020')
+        self.reader = User.objects.create_user('etag_reader',
+                                               'etag2@test.com',
+                                               'test_user_2020')
+        self.group = Group.objects.create(title='etag', slug='etag',
+                                          description='группа')
+        self.post = Post.objects.create(text='etag', author=self.author,
+                                        group=self.group)
+        self.urls = [reverse('index'),
+                     reverse('group', args=['etag']),
+                     reverse('profile', args=['etag_author']),
+                     reverse('post', args=['etag_author', self.post.id])]
+
+    def test_unchanged_pages_are_not_modified(self):
+        for url in self.urls:
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            with CaptureQueriesContext(connection) as queries:
+                repeat = self.client.get(
+                    url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(304, repeat.status_code, url)
+            # ключ свежести из кэша и счётчики автора, без ленты
+            self.assertLessEqual(len(queries), 1, url)
+
+    def test_headers_depend_on_viewer(self):
+        for url in self.urls:
+            anonymous = self.client.get(url)
+            self.assertIn('public', anonymous['Cache-Control'])
+            self.assertIn('Cookie', anonymous['Vary'])
+
+        self.client.force_login(self.reader)
+        for url in self.urls:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=anonymous[
+                'ETag'] if url == self.urls[-1] else '"other"')
+            self.assertEqual(200, response.status_code, url)
+            self.assertIn('private', response['Cache-Control'])
+            self.assertIn('Cookie', response['Vary'])
+
+    def test_changes_make_new_etag(self):
+        url = self.urls[-1]
+        self.client.force_login(self.reader)
+        etag = self.client.get(url)['ETag']
+
+        Follow.objects.create(user=self.reader, author=self.author)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+
+        Comment.objects.create(post=self.post, author=self.reader,
+                               text='новый')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, 'новый')
+
+        index = self.client.get(self.urls[0])
+        Post.objects.create(text='ещё запись', author=self.author)
+        response = self.client.get(self.urls[0],
+                                   HTTP_IF_NONE_MATCH=index['ETag'])
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, 'ещё запись')
+
+    def test_deleted_post_is_not_hidden_by_date(self):
+        older = Post.objects.create(text='старая', author=self.author,
+                                    group=self.group)
+        Post.objects.filter(pk=older.pk).update(
+            pub_date=self.post.pub_date.replace(year=2000))
+        response = self.client.get(self.urls[0])
+        self.assertNotIn('Last-Modified', response)
+
+        self.post.delete()
+        # дата, которую клиент мог запомнить раньше, ответ не отменяет
+        response = self.client.get(
+            self.urls[0], HTTP_IF_MODIFIED_SINCE=http_date(time.time()))
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, 'старая')
+
+    def test_comment_post_is_not_conditional(self):
+        self.client.force_login(self.reader)
+        url = self.urls[-1]
+        etag = self.client.get(url)['ETag']
+        response = self.client.post(url, {'text': 'через post_view'},
+                                    HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(302, response.status_code)
+        self.assertTrue(Comment.objects.filter(text='через post_view')
+                        .exists())
+
+
+class TestAsgi(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('asgi_author',
+                                               'asgi@test.com',
+                                               'test_user_2020')
+        self.reader = User.objects.create_user('asgi_reader',
+                                               'asgi2@test.com',
+                                               'test_user_2020')
+        self.post = Post.objects.create(text='через asgi',
+                                        author=self.author)
+        Follow.objects.create(user=self.reader, author=self.author)
+
+    def test_environ(self):
+        scope = {'type': 'http', 'method': 'GET', 'path': '/тест/',
+                 'query_string': b'page=2', 'headers': [
+                     (b'content-type', b'text/plain'),
+                     (b'cookie', b'a=1'), (b'cookie', b'b=2'),
+                     (b'x-forwarded-for', b'1.1.1.1')],
+                 'client': ('127.0.0.1', 5000)}
+        environ = asgi.environ_for(scope, BytesIO())
+        self.assertEqual('/тест/'.encode().decode('latin1'),
+                         environ['PATH_INFO'])
+        self.assertEqual('page=2', environ['QUERY_STRING'])
+        self.assertEqual('text/plain', environ['CONTENT_TYPE'])
+        self.assertEqual('a=1; b=2', environ['HTTP_COOKIE'])
+        self.assertEqual('1.1.1.1', environ['HTTP_X_FORWARDED_FOR'])
+        self.assertEqual('127.0.0.1', environ['REMOTE_ADDR'])
+
+    def test_body_is_read_on_demand(self):
+        messages = [{'type': 'http.request', 'body': b'ab',
+                     'more_body': True},
+                    {'type': 'http.request', 'body': b'cd'}]
+
+        async def receive():
+            return messages.pop(0)
+
+        def call(coroutine):
+            try:
+                coroutine.send(None)
+            except StopIteration as result:
+                return result.value
+
+        body = BufferedReader(asgi.RequestBody(receive, call))
+        self.assertEqual(b'abc', body.read(3))
+        self.assertEqual(b'd', body.read())
+        self.assertEqual(b'', body.read())
+
+    def test_slow_clients_do_not_hold_threads(self):
+        def echo(environ, start_response):
+            body = environ['wsgi.input'].read()
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'got:' + body]
+
+        def scope(body):
+            return {'type': 'http', 'method': 'POST', 'path': '/',
+                    'headers': [(b'content-length', str(len(body)).encode())]}
+
+        async def scenario(handler):
+            slow = asyncio.Event()
+            sent = {'reader': [], 'uploader': [], 'fast': []}
+
+            def receive_of(body, wait=None):
+                async def receive():
+                    if wait is not None:
+                        await wait.wait()
+                    return {'type': 'http.request', 'body': body}
+                return receive
+
+            def send_to(name, wait=None):
+                async def send(message):
+                    if wait is not None:
+                        await wait.wait()
+                    sent[name].append(message)
+                return send
+
+            # клиент, который не читает ответ, и клиент, который не
+            # присылает тело
+            reader = asyncio.ensure_future(handler(
+                scope(b'ab'), receive_of(b'ab'), send_to('reader', slow)))
+            uploader = asyncio.ensure_future(handler(
+                scope(b'cd'), receive_of(b'cd', slow), send_to('uploader')))
+            await asyncio.sleep(0.05)
+            # единственный поток пула свободен для третьего запроса
+            await asyncio.wait_for(handler(scope(b'ef'), receive_of(b'ef'),
+                                           send_to('fast')), 5)
+            self.assertFalse(reader.done() or uploader.done())
+            slow.set()
+            await asyncio.wait_for(asyncio.gather(reader, uploader), 5)
+            return {name: messages[-1]['body']
+                    for name, messages in sent.items()}
+
+        handler = asgi.ASGIHandler(echo, threads=1)
+        try:
+            bodies = asyncio.run(scenario(handler))
+        finally:
+            handler.close()
+        self.assertEqual({'reader': b'got:ab', 'uploader': b'got:cd',
+                          'fast': b'got:ef'}, bodies)
+
+    def test_large_response_arrives_whole(self):
+        chunks = [bytes([number]) * 100000 for number in range(10)]
+
+        def large(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return iter(chunks)
+
+        async def scenario(handler):
+            received = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                # медленный клиент: буфер ответа заполняется
+                await asyncio.sleep(0.001)
+                received.append(message)
+
+            await handler({'type': 'http', 'method': 'GET', 'path': '/',
+                           'headers': []}, receive, send)
+            return received
+
+        handler = asgi.ASGIHandler(large, threads=1)
+        try:
+            received = asyncio.run(scenario(handler))
+        finally:
+            handler.close()
+        self.assertEqual(200, received[0]['status'])
+        self.assertEqual(b''.join(chunks),
+                         b''.join(message.get('body', b'')
+                                  for message in received[1:]))
+        self.assertFalse(received[-1].get('more_body', False))
+
+    def test_pages_through_server(self):
+        transport = benchmark.AsgiServerTransport(threads=2)
+        try:
+            anonymous = transport.session(None)
+            self.assertEqual(200, anonymous('GET', reverse('index'),
+                                            None)[0])
+            self.assertEqual(404, anonymous('GET', '/missing/page/',
+                                            None)[0])
+            reader = transport.session('asgi_reader')
+            self.assertEqual(200, reader('GET', reverse('follow_index'),
+                                         None)[0])
+            url = reverse('add_comment', args=['asgi_author', self.post.id])
+            self.assertEqual(302, reader('POST', url, {'text': 'тело'})[0])
+        finally:
+            transport.close()
+        self.assertTrue(Comment.objects.filter(text='тело').exists())
+
+
+@override_settings(EVENTS_KEEPALIVE=0.01)
+class TestPostEvents(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.author = User.objects.create_user('events_author',
+                                               'events@test.com',
+                                               'test_user_2020')
+        self.reader = User.objects.create_user('events_reader',
+                                               'events2@test.com',
+                                               'test_user_2020')
+        self.group = Group.objects.create(title='events', slug='events')
+        Follow.objects.create(user=self.reader, author=self.author)
+
+    def tearDown(self):
+        # потоки, которые тест не дочитал
+        for subscription in list(events.broker._subscriptions):
+            subscription.close()
+
+    def open(self, query='', **headers):
+        response = self.client.get(reverse('post_events') + query,
+                                   **headers)
+        self.assertEqual('text/event-stream', response['Content-Type'])
+        chunks = iter(response.streaming_content)
+        self.assertIn(b'retry:', next(chunks))
+        return response, chunks
+
+    def next_event(self, chunks):
+        for chunk in chunks:
+            if not chunk.startswith(b':'):
+                return chunk.decode()
+
+    def post(self, text, **fields):
+        post = Post.objects.create(text=text, author=fields.pop(
+            'author', self.author), **fields)
+        # TestCase не фиксирует транзакцию, раздаём запись сами
+        events.publish_post(post.pk)
+        return post
+
+    def test_new_post_is_pushed_with_card(self):
+        response, chunks = self.open()
+        post = self.post('живая запись')
+        event = self.next_event(chunks)
+        self.assertIn(f'id: {post.pk}', event)
+        self.assertIn('event: post', event)
+        data = json.loads(event.split('data: ', 1)[1])
+        self.assertEqual(post.pk, data['id'])
+        self.assertIn('живая запись', data['html'])
+        response.close()
+        self.assertEqual(0, len(events.broker))
+
+    def test_feeds_are_scoped(self):
+        other = User.objects.create_user('events_other', 'e3@test.com',
+                                         'test_user_2020')
+        _, group_chunks = self.open('?group=events')
+        self.client.force_login(self.reader)
+        _, follow_chunks = self.open('?feed=follow')
+
+        self.post('чужая запись', author=other)
+        in_group = self.post('в группе', author=other, group=self.group)
+        followed = self.post('от автора')
+        self.assertIn(f'id: {in_group.pk}', self.next_event(group_chunks))
+        self.assertIn(f'id: {followed.pk}', self.next_event(follow_chunks))
+
+        self.assertEqual(404, self.client.get(
+            reverse('post_events') + '?group=missing').status_code)
+        self.client.logout()
+        self.assertEqual(401, self.client.get(
+            reverse('post_events') + '?feed=follow').status_code)
+
+    @override_settings(EVENTS_QUEUE_SIZE=2)
+    def test_slow_client_gets_overflow(self):
+        _, chunks = self.open()
+        for number in range(4):
+            self.post(f'запись {number}')
+        self.assertIn('event: overflow', self.next_event(chunks))
+        latest = self.post('после переполнения')
+        self.assertIn(f'id: {latest.pk}', self.next_event(chunks))
+
+    def test_reconnect_replays_missed_posts(self):
+        seen = self.post('уже показана')
+        missed = [self.post(f'пропущена {number}') for number in range(2)]
+        _, chunks = self.open(HTTP_LAST_EVENT_ID=str(seen.pk))
+        self.assertIn(f'id: {missed[0].pk}', self.next_event(chunks))
+        self.assertIn(f'id: {missed[1].pk}', self.next_event(chunks))
+
+    @override_settings(EVENTS_MAX_CONNECTIONS=1)
+    def test_connections_are_capped(self):
+        first, _ = self.open()
+        response = self.client.get(reverse('post_events'))
+        self.assertEqual(503, response.status_code)
+        self.assertIn('Retry-After', response)
+        first.close()
+        self.open()
+
+    @override_settings(EVENTS_MAX_AGE=0)
+    def test_stream_ends_after_max_age(self):
+        _, chunks = self.open()
+        self.assertEqual([], list(chunks))
+        self.assertEqual(0, len(events.broker))
+
+
+calls = []
+
+
+@tasks.task(attempts=2)
+def record_call(value, fail=False):
+    calls.append(value)
+    if fail:
+        raise ValueError('сбой задачи')
+
+
+@override_settings(TASKS_INLINE=False, TASK_RETRY_DELAY=0)
+class TestTasks(TestCase):
+    def setUp(self):
+        calls.clear()
+        self.author = User.objects.create_user('tasks_author',
+                                               'tasks@test.com',
+                                               'test_user_2020')
+
+    def test_job_runs_once_and_is_deleted(self):
+        job = tasks.enqueue(record_call, value=1)
+        self.assertEqual('posts.tests.record_call', job.name)
+        claimed, = tasks.claim(5)
+        self.assertEqual((job.pk, 1), (claimed.pk, claimed.attempts))
+        self.assertEqual([], tasks.claim(5))
+        self.assertTrue(tasks.run(claimed))
+        self.assertEqual([1], calls)
+        self.assertFalse(Job.objects.exists())
+
+    def test_dedup_key_keeps_one_pending_job(self):
+        self.assertIsNotNone(tasks.enqueue(record_call, dedup_key='k',
+                                           value=1))
+        self.assertIsNone(tasks.enqueue(record_call, dedup_key='k',
+                                        value=2))
+        # пока задача выполняется, новая с тем же ключом ставится
+        tasks.claim()
+        self.assertIsNotNone(tasks.enqueue(record_call, dedup_key='k',
+                                           value=3))
+        self.assertEqual(2, Job.objects.count())
+
+    def test_failed_job_is_retried_then_kept(self):
+        tasks.enqueue(record_call, value=1, fail=True)
+        with self.assertLogs('posts.tasks', 'WARNING'):
+            self.assertEqual(0, tasks.work(once=True))
+        job = Job.objects.get()
+        self.assertEqual((Job.FAILED, 2), (job.status, job.attempts))
+        self.assertIn('сбой задачи', job.last_error)
+        self.assertEqual([1, 1], calls)
+
+    @override_settings(TASK_RETRY_DELAY=60)
+    def test_retry_waits(self):
+        tasks.enqueue(record_call, value=1, fail=True)
+        with self.assertLogs('posts.tasks', 'WARNING'):
+            tasks.work(once=True)
+        job = Job.objects.get()
+        self.assertEqual(Job.PENDING, job.status)
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertEqual([], tasks.claim())
+
+    def test_expired_lease_is_reclaimed(self):
+        tasks.enqueue(record_call, value=1)
+        tasks.claim()
+        self.assertEqual([], tasks.claim())
+        Job.objects.update(locked_until=timezone.now())
+        job, = tasks.claim()
+        self.assertEqual(2, job.attempts)
+        Job.objects.update(locked_until=timezone.now())
+        self.assertEqual([], tasks.claim())
+        self.assertEqual(Job.FAILED, Job.objects.get().status)
+
+    def test_new_post_fans_out_in_worker(self):
+        reader = User.objects.create_user('tasks_reader', 'tr@test.com',
+                                          'test_user_2020')
+        Follow.objects.create(user=reader, author=self.author)
+        post = Post.objects.create(text='через очередь', author=self.author)
+        self.assertFalse(TimelineEntry.objects.filter(post=post).exists())
+
+        out = StringIO()
+        call_command('run_tasks', '--once', stdout=out)
+        self.assertIn('Выполнено задач: 1', out.getvalue())
+        self.assertTrue(TimelineEntry.objects.filter(user=reader,
+                                                     post=post).exists())
@@ -0,0 +1,51 @@
+"""Заранее подготовленные миниатюры изображений записей.
+
+Раньше миниатюру 960x339 создавал тег sorl {% thumbnail %} при первом
+показе ленты, прямо внутри запроса. Теперь new_post и post_edit
+ставят её создание в очередь задач (posts.tasks) вместе с записью, а
+адрес и размеры готовой миниатюры записываются в Post, так что лента
+не обращается ни к PIL, ни к хранилищу ключей sorl.
+"""
+from sorl.thumbnail import get_thumbnail
+
+from posts.cache import bump_posts, bump_version
+from posts.models import Post
+from posts.tasks import enqueue, task
+
+# параметры должны совпадать с тегом {% thumbnail %} в post_item.html
+GEOMETRY = '960x339'
+OPTIONS = {'crop': 'center', 'upscale': True}
+
+
+@task
+def generate(post_id):
+    """Создаёт миниатюру записи и сохраняет её адрес и размеры."""
+    post = Post.objects.filter(pk=post_id).only('pk', 'image').first()
+    if post is None:
+        return False
+    if not post.image:
+        Post.objects.filter(pk=post_id).update(thumbnail_url='',
+                                               thumbnail_width=None,
+                                               thumbnail_height=None)
+        return False
+
+    thumbnail = get_thumbnail(post.image, GEOMETRY, **OPTIONS)
+    # если пока мы работали картинку заменили, строка не обновится,
+    # а миниатюру новой картинки создаст следующая задача
+    updated = Post.objects.filter(pk=post_id, image=post.image.name).update(
+        thumbnail_url=thumbnail.url,
+        thumbnail_width=thumbnail.width,
+        thumbnail_height=thumbnail.height)
+    if updated:
+        bump_version()
+        bump_posts([post_id])
+    return bool(updated)
+
+
+def schedule(post):
+    """Ставит создание миниатюры в очередь задач вместе с записью."""
+    Post.objects.filter(pk=post.pk).update(thumbnail_url='',
+                                           thumbnail_width=None,
+                                           thumbnail_height=None)
+    # правки подряд, пока задача ждёт, дают одну миниатюру
+    enqueue(generate, dedup_key=f'thumbnail:{post.pk}', post_id=post.pk)
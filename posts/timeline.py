@@ -0,0 +1,216 @@
+"""Материализованные ленты подписок (fan-out-on-write).
+
+При публикации записи её id раскладывается в ленты всех подписчиков
+автора, и follow_index читает готовую ленту вместо JOIN по Follow.
+Лента ограничена TIMELINE_LENGTH записями, при подписке заполняется
+последними записями автора, при отписке чистится от них. Записи
+авторов, у которых подписчиков больше TIMELINE_FANOUT_LIMIT, не
+раскладываются, а подмешиваются при чтении (fan-out-on-read).
+
+Новая запись раскладывается задачей fan_out_post (posts.tasks), а не
+в запросе: у автора могут быть тысячи подписчиков.
+
+Хранилище выбирается настройкой TIMELINE_STORE: таблица в базе
+(DatabaseTimelineStore) или словарь в памяти процесса
+(MemoryTimelineStore) для разработки и тестов; с ним задачи должны
+выполняться в том же процессе (TASKS_INLINE).
+"""
+import bisect
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Count, Q
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from posts.models import Follow, Post, TimelineEntry, UserStats
+from posts.tasks import task
+
+# лента может перерасти предел на столько записей, прежде чем её обрежут
+TRIM_SLACK = 50
+
+
+def timeline_length():
+    return getattr(settings, 'TIMELINE_LENGTH', 500)
+
+
+def fanout_limit():
+    return getattr(settings, 'TIMELINE_FANOUT_LIMIT', 1000)
+
+
+class DatabaseTimelineStore:
+    """Ленты в таблице TimelineEntry."""
+
+    def push(self, post, user_ids):
+        TimelineEntry.objects.bulk_create(
+            [TimelineEntry(user_id=user_id, post=post, pub_date=post.pub_date)
+             for user_id in user_ids],
+            ignore_conflicts=True)
+        self.trim(user_ids)
+
+    def backfill(self, user_id, posts):
+        TimelineEntry.objects.bulk_create(
+            [TimelineEntry(user_id=user_id, post=post, pub_date=post.pub_date)
+             for post in posts],
+            ignore_conflicts=True)
+        self.trim([user_id])
+
+    def remove_authors(self, user_id, author_ids):
+        TimelineEntry.objects.filter(user_id=user_id,
+                                     post__author_id__in=author_ids).delete()
+
+    def discard(self, post):
+        # строки ленты удаляются каскадом вместе с записью
+        pass
+
+    def post_ids(self, user_id):
+        return (TimelineEntry.objects
+                .filter(user_id=user_id)
+                .values('post_id'))
+
+    def trim(self, user_ids):
+        length = timeline_length()
+        overgrown = (TimelineEntry.objects
+                     .filter(user_id__in=user_ids)
+                     .values('user_id')
+                     .annotate(total=Count('pk'))
+                     .filter(total__gt=length + TRIM_SLACK)
+                     .values_list('user_id', flat=True))
+        for user_id in overgrown:
+            entries = TimelineEntry.objects.filter(user_id=user_id)
+            oldest_kept = (entries.order_by('-pub_date')
+                           .values_list('pub_date', flat=True)[length - 1])
+            entries.filter(pub_date__lt=oldest_kept).delete()
+
+
+class MemoryTimelineStore:
+    """Ленты в памяти процесса: список (pub_date, id) по возрастанию."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timelines = {}
+
+    def _insert(self, user_id, items):
+        timeline = self.timelines.setdefault(user_id, [])
+        for item in items:
+            index = bisect.bisect_left(timeline, item)
+            if index == len(timeline) or timeline[index] != item:
+                timeline.insert(index, item)
+        del timeline[:-timeline_length()]
+
+    def push(self, post, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self._insert(user_id, [(post.pub_date, post.pk)])
+
+    def backfill(self, user_id, posts):
+        with self.lock:
+            self._insert(user_id, [(post.pub_date, post.pk) for post in posts])
+
+    def remove_authors(self, user_id, author_ids):
+        with self.lock:
+            timeline = self.timelines.get(user_id, [])
+            own = set(Post.objects
+                      .filter(author_id__in=author_ids,
+                              pk__in=[pk for _, pk in timeline])
+                      .values_list('pk', flat=True))
+            timeline[:] = [item for item in timeline if item[1] not in own]
+
+    def discard(self, post):
+        item = (post.pub_date, post.pk)
+        with self.lock:
+            for timeline in self.timelines.values():
+                if item in timeline:
+                    timeline.remove(item)
+
+    def post_ids(self, user_id):
+        with self.lock:
+            return [pk for _, pk in self.timelines.get(user_id, [])]
+
+
+@lru_cache(maxsize=None)
+def get_store():
+    path = getattr(settings, 'TIMELINE_STORE',
+                   'posts.timeline.DatabaseTimelineStore')
+    return import_string(path)()
+
+
+@receiver(setting_changed)
+def reset_store(setting, **kwargs):
+    if setting.startswith('TIMELINE_'):
+        get_store.cache_clear()
+
+
+def is_popular(author_id):
+    return UserStats.objects.filter(
+        user_id=author_id,
+        followers_count__gt=fanout_limit()).exists()
+
+
+def fan_out(post):
+    """Раскладывает новую запись по лентам подписчиков автора."""
+    if is_popular(post.author_id):
+        return
+    followers = (Follow.objects
+                 .filter(author_id=post.author_id)
+                 .values_list('user_id', flat=True))
+    get_store().push(post, list(followers))
+
+
+@task
+def fan_out_post(post_id):
+    """Задача: раскладывает запись, если её ещё не удалили."""
+    post = Post.objects.filter(pk=post_id).only('pk', 'author_id',
+                                                'pub_date').first()
+    if post is not None:
+        fan_out(post)
+
+
+def follow(user_id, author_id):
+    follow_many(user_id, [author_id])
+
+
+def follow_many(user_id, author_ids):
+    """Добавляет в ленту записи авторов одним запросом.
+
+    author_ids может быть и queryset'ом; популярные авторы пропускаются.
+    """
+    popular = UserStats.objects.filter(
+        followers_count__gt=fanout_limit()).values('user_id')
+    posts = (Post.objects
+             .filter(author_id__in=author_ids)
+             .exclude(author_id__in=popular)
+             .only('pk', 'pub_date')
+             .order_by('-pub_date')[:timeline_length()])
+    get_store().backfill(user_id, posts)
+
+
+def unfollow(user_id, author_id):
+    get_store().remove_authors(user_id, [author_id])
+
+
+def unfollow_many(user_id, author_ids):
+    get_store().remove_authors(user_id, list(author_ids))
+
+
+def rebuild(user_ids):
+    """Заполняет ленты пользователей по их подпискам.
+
+    Нужно после bulk_create подписок, которые не отправляют сигналов.
+    Каждая лента собирается одним запросом по всем авторам сразу.
+    """
+    for user_id in user_ids:
+        follow_many(user_id, Follow.objects.filter(user_id=user_id)
+                    .values('author_id'))
+
+
+def follow_feed(user):
+    """Записи ленты подписок пользователя."""
+    popular = (Follow.objects
+               .filter(user=user,
+                       author__stats__followers_count__gt=fanout_limit())
+               .values('author_id'))
+    return Post.objects.filter(Q(pk__in=get_store().post_ids(user.pk))
+                               | Q(author__in=popular))
@@ -0,0 +1,153 @@
+"""Потоковая загрузка изображений записей.
+
+Стандартные обработчики Django держат небольшие файлы в памяти, а
+forms.ImageField проверяет картинку, полностью декодируя её Pillow.
+Для new_post и post_edit загрузка пишется на диск кусками, формат и
+размер в пикселях читаются из заголовка по первым килобайтам, и
+слишком большие файлы или "бомбы декомпрессии" отбрасываются до того,
+как кто-то попытается их декодировать. Картинки больше
+POST_IMAGE_MAX_SIDE по большей стороне уменьшаются и пересохраняются.
+"""
+import warnings
+from functools import wraps
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from PIL import Image
+
+# столько байт начала файла хватает на заголовок с размерами (JPEG
+# кладёт их после EXIF, который бывает в десятки килобайт)
+HEADER_SIZE = 64 * 1024
+
+
+def max_bytes():
+    return getattr(settings, 'POST_IMAGE_MAX_BYTES', 10 * 1024 * 1024)
+
+
+def max_pixels():
+    return getattr(settings, 'POST_IMAGE_MAX_PIXELS', 40 * 1000 * 1000)
+
+
+def allowed_formats():
+    return getattr(settings, 'POST_IMAGE_FORMATS',
+                   ('JPEG', 'PNG', 'GIF', 'WEBP'))
+
+
+def read_header(fileobj):
+    """Формат и размеры картинки без декодирования пикселей.
+
+    Возвращает (format, width, height) или None, если заголовок не
+    удалось разобрать. Image.open читает только заголовок.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', Image.DecompressionBombWarning)
+            image = Image.open(fileobj)
+            return image.format, image.width, image.height
+    except (Image.DecompressionBombWarning, Image.DecompressionBombError):
+        return 'BOMB', 0, 0
+    except Exception:
+        return None
+
+
+def check_header(header):
+    """Код ошибки для заголовка картинки или None, если он в порядке."""
+    if header is None:
+        return 'invalid_image'
+    image_format, width, height = header
+    if image_format == 'BOMB' or width * height > max_pixels():
+        return 'too_many_pixels'
+    if image_format not in allowed_formats():
+        return 'invalid_image'
+    return None
+
+
+class ImageUploadHandler(TemporaryFileUploadHandler):
+    """Пишет файл во временный файл и проверяет его по ходу загрузки.
+
+    При ошибке остаток файла не записывается, а код ошибки сохраняется
+    в upload_error загруженного файла, откуда его берёт поле формы.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.header = b''
+        self.checked = False
+        self.received = 0
+        self.error = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.error:
+            return None
+        self.received += len(raw_data)
+        if self.received > max_bytes():
+            self.error = 'too_large'
+            return None
+        if not self.checked:
+            self.header += raw_data
+            self.check(final=len(self.header) >= HEADER_SIZE)
+            if self.error:
+                return None
+        return super().receive_data_chunk(raw_data, start)
+
+    def check(self, final):
+        header = read_header(BytesIO(self.header))
+        if header is None and not final:
+            # заголовок пришёл не целиком, ждём следующий кусок
+            return
+        self.checked = True
+        self.header = b''
+        self.error = check_header(header)
+
+    def file_complete(self, file_size):
+        if not self.checked and not self.error:
+            self.check(final=True)
+        uploaded = super().file_complete(file_size)
+        uploaded.upload_error = self.error
+        return uploaded
+
+
+def stream_image_uploads(view):
+    """Включает ImageUploadHandler для view с формой записи.
+
+    Обработчики загрузки можно заменить только до чтения request.POST,
+    а CsrfViewMiddleware читает его раньше view, поэтому проверка CSRF
+    переносится внутрь декоратора.
+    """
+    protected = csrf_protect(view)
+
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers = [ImageUploadHandler(request)]
+        return protected(request, *args, **kwargs)
+    return wrapper
+
+
+def downscale(uploaded, max_side):
+    """Уменьшает картинку до max_side по большей стороне.
+
+    Возвращает новый файл или исходный, если уменьшать не нужно.
+    """
+    uploaded.seek(0)
+    image = Image.open(uploaded)
+    image_format = image.format
+    if max(image.size) <= max_side:
+        uploaded.seek(0)
+        return uploaded
+
+    # для JPEG draft() уменьшает картинку уже при декодировании
+    image.draft('RGB', (max_side, max_side))
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    output = BytesIO()
+    image.save(output, image_format)
+    resized = SimpleUploadedFile(uploaded.name, output.getvalue(),
+                                 uploaded.content_type)
+    resized.image = image
+    return resized
@@ -6,11 +6,21 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('404/', views.page_not_found),
     path('500/', views.server_error),
+    path('api/posts/', views.api_posts, name='api_posts'),
+    path('api/posts/<int:post_id>/comments/', views.api_comments, name='api_comments'),
+    path('api/groups/', views.api_groups, name='api_groups'),
+    path('api/groups/<slug:slug>/', views.api_group, name='api_group'),
+    path('api/profiles/<str:username>/', views.api_profile, name='api_profile'),
+    path('api/follow/', views.api_follow, name='api_follow'),
+    path('events/', views.post_events, name='post_events'),
     path('follow/', views.follow_index, name='follow_index'),
+    path('follow/batch/', views.follow_batch, name='follow_batch'),
     path('group/<slug:slug>/', views.group_posts, name='group'),
     path('new/', views.new_post, name='new_post'),
+    path('search/', views.search, name='search'),
     path('<str:username>/', views.profile, name='profile'),
     path('<str:username>/<int:post_id>/', views.post_view, name='post'),
+    path('<str:username>/<int:post_id>/comments/', views.post_comments, name='post_comments'),
     path('<str:username>/<int:post_id>/comment/', views.add_comment, name='add_comment'),
     path('<str:username>/<int:post_id>/edit/', views.post_edit, name='post_edit'),
     path('<str:username>/follow/', views.profile_follow, name='profile_follow'),
@@ -1,24 +1,37 @@
+import json
+
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.core.paginator import Paginator
-from django.http import HttpResponseRedirect
+from django.db import transaction
+from django.http import (Http404, HttpResponseRedirect, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
-from django.views.decorators.cache import cache_page
+from django.views.decorators.http import require_POST
 
+from posts import (api, comments as threads, events, follows, freshness,
+                   metrics, search as full_text, thumbnails)
+from posts.cache import post_versions
+from posts.db import replica_view
 from posts.forms import CommentForm, PostForm
-from posts.models import Follow, Group, Post
+from posts.feeds import feed_posts, load_feed
+from posts.models import Comment, Follow, Group, Post
+from posts.paginator import count_key
+from posts.stats import stats_for
+from posts.timeline import follow_feed
+from posts.uploads import stream_image_uploads
 
 
-@cache_page(20, key_prefix='index_page')
+@replica_view
+@freshness.conditional(freshness.index_modified, per_viewer=True)
 def index(request):
     """Главная страница"""
 
-    post_list = Post.objects.select_related('group').all()
+    post_list = Post.objects.all()
 
-    paginator = Paginator(post_list, 4)
-    page_number = request.GET.get('page')
-    page = paginator.get_page(page_number)
+    paginator, page = load_feed(request, post_list, 4, count_key('index'),
+                                cache_pages=True)
 
     return render(request, 'index.html', {
                            'page': page,
@@ -26,13 +39,14 @@ def index(request):
                  })
 
 
+@replica_view
+@freshness.conditional(freshness.group_modified, per_viewer=True)
 def group_posts(request, slug):
     group = get_object_or_404(Group, slug=slug)
     posts = group.posts_by_group.all()
 
-    pag = Paginator(posts, 4)
-    page_number = request.GET.get('page')
-    page = pag.get_page(page_number)
+    pag, page = load_feed(request, posts, 4, count_key('group', group.pk),
+                          cache_pages=True)
 
     return render(request, 'group.html',
                   {'group': group,
@@ -41,14 +55,35 @@ def group_posts(request, slug):
                    'page': page})
 
 
+@replica_view
+def search(request):
+    """Полнотекстовый поиск по записям и группам"""
+
+    query = request.GET.get('q', '').strip()
+    after = full_text.decode_cursor(request.GET.get('after'))
+    posts, next_cursor = [], None
+    if query:
+        posts, next_cursor = full_text.search(query, 10, after)
+        post_versions(posts)
+
+    return render(request, 'search.html', {'query': query,
+                                           'posts': posts,
+                                           'next_cursor': next_cursor})
+
+
 @login_required
+@stream_image_uploads
 def new_post(request):
     form = PostForm(request.POST or None, files=request.FILES or None)
 
     if form.is_valid():
         new_post = form.save(commit=False)
         new_post.author = request.user
-        new_post.save()
+        # запись и её задачи (posts.tasks) фиксируются вместе
+        with transaction.atomic():
+            new_post.save()
+            if new_post.image:
+                thumbnails.schedule(new_post)
         return redirect('index')
 
     return render(request, 'new_post.html', {'form': form,
@@ -56,63 +91,76 @@ def new_post(request):
                                              'button': 'Отправить'})
 
 
+@replica_view
+@freshness.conditional(freshness.profile_modified,
+                       freshness.profile_counters, per_viewer=True)
 def profile(request, username):
 
     user_post = get_object_or_404(User, username=username)
     post_list = user_post.posts_by_author.all()
 
-    pag = Paginator(post_list, 4)
-    page_number = request.GET.get('page')
-    page = pag.get_page(page_number)
-
-    # проверим, подписан ли пользователь на автора поста
-    if request.user.is_authenticated:
-        count = Follow.objects.filter(user=request.user,
-                                      author__username=username).count()
-        follows = True if count > 0 else False
-    else:
-        follows = False
+    pag, page = load_feed(request, post_list, 4,
+                          count_key('author', user_post.pk),
+                          cache_pages=True)
+    following = follows.state_for(request).follows(user_post)
 
     return render(request,
                   'profile.html',
                   {'page': page,
-                   'following': follows,
+                   'following': following,
                    'paginator': pag,
-                   'author': user_post})
+                   'author': user_post,
+                   'stats': stats_for(user_post)})
 
 
+@replica_view
+@freshness.conditional(freshness.post_modified, freshness.post_counters,
+                       per_viewer=True)
 def post_view(request, username, post_id):
-    post = get_object_or_404(Post, id=post_id, author__username=username)
-
-    all_comments = post.comments.all()
+    if request.method == 'POST':
+        # комментарии сохраняются только через add_comment
+        return add_comment(request, username, post_id)
 
-    comment_form = CommentForm(request.POST or None)
-
-    if comment_form.is_valid():
-        new_comment = comment_form.save(commit=False)
-        new_comment.author = request.user
-        new_comment.post = post
-        new_comment.save()
+    post = get_object_or_404(feed_posts(Post.objects),
+                             id=post_id,
+                             author__username=username)
 
     comment_form = CommentForm()
-
-    # проверим, подписан ли пользователь на автора поста
-    if request.user.is_authenticated:
-        count = Follow.objects.filter(user=request.user,
-                                      author__username=username).count()
-        follows = True if count > 0 else False
-    else:
-        follows = False
+    following = follows.state_for(request).follows(post.author_id)
+    comments, comments_next = threads.thread_page(post,
+                                                  request.GET.get('after'))
 
     return render(request, 'post.html',
                            {'post': post,
                             'author': post.author,
                             'form': comment_form,
-                            'following': follows,
-                            'comments': all_comments
+                            'comment_token': threads.new_token(),
+                            'following': following,
+                            'comments': comments,
+                            'comments_next': comments_next,
+                            'stats': stats_for(post.author)
                             })
 
 
+@replica_view
+def post_comments(request, username, post_id):
+    """Следующая страница комментариев записи в JSON"""
+
+    post = get_object_or_404(Post.objects.only('pk'),
+                             id=post_id,
+                             author__username=username)
+    try:
+        limit = int(request.GET.get('limit', threads.page_size()))
+    except ValueError:
+        limit = threads.page_size()
+    comments, next_cursor = threads.thread_page(post,
+                                                request.GET.get('after'),
+                                                limit)
+    return JsonResponse({'comments': [threads.as_json(comment)
+                                      for comment in comments],
+                         'next': next_cursor})
+
+
 @login_required
 def add_comment(request, username, post_id):
 
@@ -121,22 +169,31 @@ def add_comment(request, username, post_id):
                                     author__username=username)
 
     comment_form = CommentForm(request.POST or None)
+    status = 200
 
     if comment_form.is_valid():
-        new_comment = comment_form.save(commit=False)
-        new_comment.author = request.user
-        new_comment.post = post_parent
-        new_comment.save()
-        return redirect('post', username=username, post_id=post_id)
-
-    return render(request, 'new_comment.html', {'form': comment_form,
-                                                'post': post_parent,
-                                                'author': post_parent.author,
-                                                'title': 'Новый комментарий',
-                                                'button': 'Отправить'})
+        try:
+            threads.add(request.user, post_parent, comment_form,
+                        request.POST.get('token'))
+        except threads.RateLimited:
+            comment_form.add_error(None, 'Слишком много комментариев, '
+                                         'попробуйте чуть позже')
+            status = 429
+        else:
+            # повтор уже сохранённого комментария ведёт туда же
+            return redirect('post', username=username, post_id=post_id)
+
+    return render(request, 'new_comment.html', {
+        'form': comment_form,
+        'comment_token': request.POST.get('token') or threads.new_token(),
+        'post': post_parent,
+        'author': post_parent.author,
+        'title': 'Новый комментарий',
+        'button': 'Отправить'}, status=status)
 
 
 @login_required
+@stream_image_uploads
 def post_edit(request, username, post_id):
 
     if request.user.username != username:
@@ -144,35 +201,37 @@ def post_edit(request, username, post_id):
 
     the_post = get_object_or_404(Post, id=post_id, author__username=username)
 
-    # проверим, подписан ли пользователь на автора поста
-    count = Follow.objects.filter(user=request.user,
-                                  author__username=username).count()
-    follows = True if count > 0 else False
-
     edit_form_post = PostForm(request.POST or None,
                               files=request.FILES or None,
                               instance=the_post)
 
     if edit_form_post.is_valid():
-        edit_form_post.save()
+        # сохраняем только поля формы, чтобы не затереть счётчик
+        # комментариев, изменившийся после загрузки записи
+        the_post = edit_form_post.save(commit=False)
+        with transaction.atomic():
+            the_post.save(update_fields=PostForm.Meta.fields)
+            if 'image' in edit_form_post.changed_data:
+                thumbnails.schedule(the_post)
         return redirect('post', username=username, post_id=post_id)
 
+    following = follows.state_for(request).follows(the_post.author_id)
     return render(request, 'new_post.html', {'form': edit_form_post,
                                              'post': the_post,
-                                             'following': follows,
+                                             'following': following,
                                              'title': 'Редактировать заись',
                                              'button': 'Внести изменения'})
 
 
 @login_required
+@replica_view
 def follow_index(request):
     """Выводит посты авторов, на которые подписан пользователь"""
 
-    follow_posts = Post.objects.filter(author__following__user=request.user)
+    follow_posts = follow_feed(request.user)
 
-    pag = Paginator(follow_posts, 10)
-    page_number = request.GET.get('page')
-    page = pag.get_page(page_number)
+    pag, page = load_feed(request, follow_posts, 10,
+                          count_key('follow', request.user.pk))
 
     return render(request,
                   'follow.html',
@@ -206,7 +265,162 @@ def profile_unfollow(request, username):
     return HttpResponseRedirect(reverse('profile', args=[username]))
 
 
-def page_not_found(request, exception):
+def post_events(request):
+    """Поток новых записей ленты (server-sent events).
+
+    ?group=<slug> — записи группы, ?feed=follow — записи авторов, на
+    которых подписан зритель, без параметров — все новые записи.
+    """
+    group, authors = request.GET.get('group') or None, None
+    if request.GET.get('feed') == 'follow':
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Нужно войти'}, status=401)
+        authors = follows.following_ids(request.user.pk)
+    elif group is not None and not Group.objects.filter(slug=group).exists():
+        raise Http404
+
+    try:
+        last_id = int(request.META.get('HTTP_LAST_EVENT_ID', ''))
+    except ValueError:
+        last_id = None
+
+    subscription = events.broker.subscribe(group, authors)
+    if subscription is None:
+        response = JsonResponse({'error': 'Слишком много открытых потоков'},
+                                status=503)
+        response['Retry-After'] = str(events.RETRY_MS // 1000)
+        return response
+
+    response = StreamingHttpResponse(
+        events.EventStream(request, subscription, last_id),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен копить поток в буфере
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@staff_member_required
+def request_metrics(request):
+    """Метрики запросов за последние minutes минут в JSON"""
+
+    try:
+        minutes = int(request.GET.get('minutes', metrics.window()))
+    except ValueError:
+        minutes = metrics.window()
+    sort = request.GET.get('sort', 'total')
+    if sort not in ('total', 'p95', 'sql'):
+        sort = 'total'
+    return JsonResponse({'minutes': minutes,
+                         'views': metrics.report(minutes, sort)})
+
+
+@require_POST
+def follow_batch(request):
+    """Подписка и отписка от многих авторов одним запросом.
+
+    Тело запроса — JSON {"follow": [имена], "unfollow": [имена]}.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Нужно войти'}, status=401)
+
+    try:
+        data = json.loads(request.body)
+        names = {key: data.get(key, []) for key in ('follow', 'unfollow')}
+    except (ValueError, AttributeError):
+        return JsonResponse({'error': 'Ожидается JSON-объект'}, status=400)
+    if not all(isinstance(value, list)
+               and all(isinstance(name, str) for name in value)
+               for value in names.values()):
+        return JsonResponse({'error': 'Ожидаются списки имён'}, status=400)
+    requested = set(names['follow']) | set(names['unfollow'])
+    if len(requested) > follows.BATCH_LIMIT:
+        return JsonResponse(
+            {'error': f'Не больше {follows.BATCH_LIMIT} авторов за раз'},
+            status=400)
+
+    return JsonResponse(follows.apply(request.user, **names))
+
+
+@replica_view
+@freshness.conditional(freshness.index_modified)
+def api_posts(request):
+    """Главная лента в JSON"""
+
+    posts, next_cursor = api.post_page(Post.objects,
+                                       request.GET.get('after'),
+                                       api.limit_from(request))
+    return JsonResponse({'posts': posts, 'next': next_cursor})
+
+
+@replica_view
+@freshness.conditional(lambda request: None)
+def api_groups(request):
+    """Все группы в JSON"""
+
+    groups = Group.objects.order_by('title').values(*api.GROUP_FIELDS)
+    return JsonResponse({'groups': list(groups)})
+
+
+@replica_view
+@freshness.conditional(freshness.group_modified)
+def api_group(request, slug):
+    """Группа и её записи в JSON"""
+
+    group = Group.objects.filter(slug=slug).values(*api.GROUP_FIELDS).first()
+    if group is None:
+        raise Http404
+    posts, next_cursor = api.post_page(
+        Post.objects.filter(group_id=group['id']),
+        request.GET.get('after'), api.limit_from(request))
+    return JsonResponse({'group': group, 'posts': posts, 'next': next_cursor})
+
+
+@replica_view
+@freshness.conditional(freshness.profile_modified,
+                       freshness.profile_counters)
+def api_profile(request, username):
+    """Профиль автора и его записи в JSON"""
+
+    profile = (User.objects.filter(username=username)
+               .values(*api.PROFILE_FIELDS).first())
+    if profile is None:
+        raise Http404
+    posts, next_cursor = api.post_page(
+        Post.objects.filter(author_id=profile['id']),
+        request.GET.get('after'), api.limit_from(request))
+    return JsonResponse({'profile': api.profile_json(profile),
+                         'posts': posts,
+                         'next': next_cursor})
+
+
+@replica_view
+@freshness.conditional(freshness.comments_modified)
+def api_comments(request, post_id):
+    """Комментарии записи в JSON, от старых к новым"""
+
+    if not Post.objects.filter(pk=post_id).exists():
+        raise Http404
+    comments, next_cursor = api.comment_page(
+        Comment.objects.filter(post_id=post_id),
+        request.GET.get('after'), api.limit_from(request))
+    return JsonResponse({'comments': comments, 'next': next_cursor})
+
+
+@api.login_required_json
+@replica_view
+@freshness.conditional(freshness.follow_modified,
+                       freshness.follow_authors)
+def api_follow(request):
+    """Лента подписок в JSON"""
+
+    posts, next_cursor = api.post_page(follow_feed(request.user),
+                                       request.GET.get('after'),
+                                       api.limit_from(request))
+    return JsonResponse({'posts': posts, 'next': next_cursor})
+
+
+def page_not_found(request, exception=None):
     # Переменная exception содержит отладочную информацию,
     # выводить её в шаблон пользователской страницы 404 мы не станем
     return render(
@@ -0,0 +1,53 @@
+"""Разбор шаблонов проекта при старте процесса.
+
+С кэширующим загрузчиком (боевой профиль, yatube.settings_production)
+шаблон разбирается при первом обращении и дальше берётся из памяти
+процесса. warm() обращается ко всем шаблонам проекта заранее, чтобы
+первые запросы после перезапуска не платили за разбор base.html,
+includes и post_item.html; заодно ошибка в шаблоне видна сразу при
+старте. Без кэширующего загрузчика warm() только измеряет время
+разбора.
+"""
+import os
+import time
+
+from django.conf import settings
+from django.template import engines
+
+
+def enabled():
+    return getattr(settings, 'TEMPLATE_WARMUP', False)
+
+
+def _loaders(engine):
+    for loader in engine.template_loaders:
+        # кэширующий загрузчик ищет файлы своими вложенными загрузчиками
+        yield from getattr(loader, 'loaders', [loader])
+
+
+def project_templates(engine=None):
+    """Имена шаблонов из каталогов проекта, без шаблонов библиотек."""
+    engine = engine or engines['django'].engine
+    root = os.path.abspath(settings.BASE_DIR)
+    names = set()
+    for loader in _loaders(engine):
+        for directory in loader.get_dirs():
+            directory = os.path.abspath(directory)
+            if os.path.commonpath([root, directory]) != root:
+                continue
+            for path, _, files in os.walk(directory):
+                for filename in files:
+                    names.add(os.path.relpath(os.path.join(path, filename),
+                                              directory).replace(os.sep, '/'))
+    return sorted(names)
+
+
+def warm(engine=None):
+    """Загружает шаблоны проекта, возвращает [(имя, секунды разбора)]."""
+    engine = engine or engines['django'].engine
+    timings = []
+    for name in project_templates(engine):
+        start = time.perf_counter()
+        engine.get_template(name)
+        timings.append((name, time.perf_counter() - start))
+    return timings
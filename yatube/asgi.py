@@ -0,0 +1,23 @@
+"""
+ASGI config for yatube project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``. Django 2.2 has no ASGI handler of its own, so the WSGI
+application runs in a thread pool, see posts.asgi.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'yatube.settings')
+
+wsgi_application = get_wsgi_application()
+
+from posts import warmup  # noqa: E402 (нужны настроенные приложения)
+from posts.asgi import ASGIHandler  # noqa: E402
+
+if warmup.enabled():
+    warmup.warm()
+
+application = ASGIHandler(wsgi_application)
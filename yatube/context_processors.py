@@ -1,6 +1,13 @@
 import datetime as dt
 
+from posts.follows import state_for
+
 
 def get_this_year(request):
     this_year = dt.datetime.now().year
     return {'this_year': this_year}
+
+
+def get_follow_state(request):
+    # подписки зрителя загрузятся, только если шаблон о них спросит
+    return {'followed': state_for(request)}
@@ -61,6 +61,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'posts.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,6 +85,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'yatube.context_processors.get_this_year',
+                'yatube.context_processors.get_follow_state',
             ],
         },
     },
@@ -170,3 +172,71 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
+
+# Разбирать все шаблоны проекта при старте WSGI-процесса, см.
+# posts.warmup; имеет смысл только с кэширующим загрузчиком
+TEMPLATE_WARMUP = False
+
+# Ленты подписок: хранилище, длина ленты и число подписчиков,
+# начиная с которого записи автора читаются без раскладки по лентам
+TIMELINE_STORE = 'posts.timeline.DatabaseTimelineStore'
+TIMELINE_LENGTH = 500
+TIMELINE_FANOUT_LIMIT = 1000
+
+# Комментарии на странице записи и наибольшее число комментариев,
+# которое можно запросить за раз, см. posts.comments
+COMMENTS_PAGE_SIZE = 50
+COMMENTS_PAGE_MAX = 200
+
+# Записей на странице JSON API по умолчанию и наибольшее, см. posts.api
+API_PAGE_SIZE = 20
+API_PAGE_MAX = 100
+
+# Сколько секунд обратный прокси и браузер могут хранить ленты для
+# анонимных посетителей без перепроверки, см. posts.freshness
+FEED_CACHE_MAX_AGE = 0
+
+# Защита от повторов и спама в комментариях: сколько секунд одинаковый
+# текст считается повтором, сколько комментариев можно оставить за
+# окно в секундах (0 — без ограничения)
+COMMENT_DUPLICATE_WINDOW = 5 * 60
+COMMENT_RATE_LIMIT = 10
+COMMENT_RATE_WINDOW = 60
+
+# Очередь задач (posts.tasks): в разработке и тестах задачи выполняются
+# сразу, в потоке запроса; иначе их выполняет команда run_tasks.
+# Сколько секунд задача принадлежит взявшему её обработчику, первая
+# задержка перед повтором и как часто обработчик проверяет очередь
+TASKS_INLINE = True
+TASK_LEASE = 5 * 60
+TASK_RETRY_DELAY = 10
+TASK_POLL_INTERVAL = 1
+
+# Потоки ASGI-приложения (yatube.asgi), в которых выполняется Django,
+# см. posts.asgi
+ASGI_THREADS = 8
+
+# Потоки новых записей (posts.events): сколько открытых потоков держит
+# один процесс, сколько событий ждёт медленного клиента, прежде чем он
+# получит overflow, раз в сколько секунд слать пустой комментарий,
+# через сколько секунд закрывать поток и сколько пропущенных записей
+# досылать после переподключения. Поток занимает поток сервера, так
+# что потоков событий должно быть заметно меньше ASGI_THREADS
+EVENTS_MAX_CONNECTIONS = 4
+EVENTS_QUEUE_SIZE = 20
+EVENTS_KEEPALIVE = 15
+EVENTS_MAX_AGE = 5 * 60
+EVENTS_REPLAY = 20
+
+# Ограничения на изображения записей, см. posts.uploads
+POST_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+POST_IMAGE_MAX_PIXELS = 40 * 1000 * 1000
+POST_IMAGE_MAX_SIDE = 2560
+POST_IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+
+# Метрики запросов, см. posts.metrics: доля запросов, у которых
+# измеряются SQL и шаблоны, окно отчёта в минутах и период сброса
+# накопленного в кэш в секундах
+REQUEST_METRICS_SAMPLE_RATE = 0.1
+REQUEST_METRICS_WINDOW = 60
+REQUEST_METRICS_FLUSH_INTERVAL = 10
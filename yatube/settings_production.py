@@ -0,0 +1,93 @@
+"""Боевой профиль: DJANGO_SETTINGS_MODULE=yatube.settings_production.
+
+SQLite работает в режиме WAL, соединения живут между запросами
+(CONN_MAX_AGE), а ленты читаются через алиас replica. Шаблоны
+разбираются один раз на процесс и заранее, при старте (posts.warmup).
+Кэш общий для всех процессов: файл SQLite (posts.sqlite_cache), путь
+задаётся переменной YATUBE_CACHE_PATH. По умолчанию
+реплика — тот же файл базы, открытый только на чтение: в WAL чтения не
+блокируют запись. Путь к отдельной копии базы (например, которую
+поддерживает litestream) задаётся переменной YATUBE_REPLICA_PATH.
+Задачи после записи (posts.tasks) выполняет отдельный процесс
+manage.py run_tasks.
+"""
+import os
+
+from yatube.settings import *  # noqa: F401,F403
+from yatube.settings import BASE_DIR, TEMPLATES
+
+DEBUG = False
+
+DATABASE_PATH = os.environ.get('YATUBE_DB_PATH',
+                               os.path.join(BASE_DIR, 'db.sqlite3'))
+REPLICA_PATH = os.environ.get('YATUBE_REPLICA_PATH', DATABASE_PATH)
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE_PATH,
+        'CONN_MAX_AGE': 600,
+        # сколько секунд ждать освобождения блокировки записи
+        'OPTIONS': {'timeout': 20},
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        # Django открывает SQLite с uri=True, mode=ro запрещает запись
+        'NAME': f'file:{REPLICA_PATH}?mode=ro',
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {'timeout': 20},
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['posts.db.ReplicaRouter']
+REPLICA_DATABASE = 'replica'
+
+# выполняются на каждом новом соединении, journal_mode — только на
+# основной базе, см. posts.db.apply_pragmas
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    # в WAL fsync при каждой фиксации не нужен для целостности базы
+    'synchronous': 'normal',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+
+# миниатюры и ленты подписок готовит run_tasks, а не запрос
+TASKS_INLINE = False
+
+# открытые потоки новых записей (posts.events) занимают не больше
+# половины потоков ASGI-приложения, остальные отвечают на запросы
+ASGI_THREADS = 64
+EVENTS_MAX_CONNECTIONS = 32
+
+# кэширующий загрузчик: каждый шаблон разбирается один раз на процесс
+TEMPLATES = [dict(
+    TEMPLATES[0],
+    DIRS=[os.path.join(BASE_DIR, 'templates')],
+    APP_DIRS=False,
+    OPTIONS=dict(TEMPLATES[0]['OPTIONS'], loaders=[
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]),
+)]
+TEMPLATE_WARMUP = True
+
+# один кэш на все процессы машины вместо LocMemCache в каждом
+CACHES = {
+    'default': {
+        'BACKEND': 'posts.sqlite_cache.SQLiteCache',
+        'LOCATION': os.environ.get('YATUBE_CACHE_PATH',
+                                   os.path.join(BASE_DIR, 'cache.sqlite3')),
+        'OPTIONS': {
+            'MAX_ENTRIES': 200000,
+            'MAX_BYTES': 256 * 2 ** 20,
+        },
+    }
+}
+
+# анонимные ленты прокси отдаёт сам, новые записи видны через минуту
+FEED_CACHE_MAX_AGE = 60
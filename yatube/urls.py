@@ -21,6 +21,8 @@ from django.urls import include, path
 from django.conf import settings
 from django.conf.urls.static import static
 
+from posts.views import request_metrics
+
 
 handler404 = "posts.views.page_not_found" # noqa
 handler500 = "posts.views.server_error" # noqa
@@ -29,6 +31,7 @@ urlpatterns = [
     path('about/', include('django.contrib.flatpages.urls')),
     path("auth/", include("users.urls")),
     path("auth/", include("django.contrib.auth.urls")),
+    path('admin/metrics/', request_metrics, name='request_metrics'),
     path('admin/', admin.site.urls),
     path("", include("posts.urls")),
 ]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'yatube.settings')
 
 application = get_wsgi_application()
+
+from posts import warmup  # noqa: E402 (нужны настроенные приложения)
+
+if warmup.enabled():
+    warmup.warm()